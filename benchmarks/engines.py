@@ -0,0 +1,62 @@
+"""
+    Compares the genetic algorithm with the greedy engine in speed and
+    playlist quality, using the songs in the csvfiles/ folder so no access
+    to the Spotify API is needed.
+
+    Run from the root of the repository:
+
+        python -m benchmarks.engines
+"""
+import time
+import numpy as np
+import pandas as pd
+import diversify.genetic as gen
+
+USERS = ['csvfiles/belzedufeatures.csv', 'csvfiles/biasusanfeatures.csv']
+CANDIDATES = 'csvfiles/songs_to_cluster.csv'
+
+
+def load(config):
+    users = [gen._user_frame(pd.read_csv(path), config) for path in USERS]
+    candidates = pd.read_csv(CANDIDATES).drop_duplicates('id').set_index('id')[gen._columns]
+    return users, candidates
+
+
+def measure(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def main(sizes=(100, 1000, 5000), repeats=5):
+    config = gen.GeneticConfig()
+    users, candidates = load(config)
+
+    print(f"{'pool':>6} {'engine':>8} {'seconds':>9} {'fitness':>9}")
+    for size in sizes:
+        nsongs = candidates.sample(min(size, len(candidates)), random_state=0)
+        optimizer = gen.PlaylistOptimizer.from_frames(users, nsongs, config, seed=0)
+
+        def genetic():
+            pop = optimizer.run(progress=False)
+            return optimizer.population_fitness(pop).max()
+
+        def refined():
+            pop = optimizer.run(progress=False)
+            indv = pop[optimizer.population_fitness(pop).argmax()]
+            return optimizer.fitness(optimizer.refine(indv))
+
+        def greedy():
+            return optimizer.fitness(optimizer.greedy())
+
+        for name, engine in [('genetic', genetic), ('refined', refined), ('greedy', greedy)]:
+            times, scores = [], []
+            for _ in range(repeats):
+                score, elapsed = measure(engine)
+                times.append(elapsed)
+                scores.append(score)
+            print(f"{size:>6} {name:>8} {np.median(times):>9.4f} {np.mean(scores):>9.4f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,293 @@
 import asyncio
+import random
+import threading
+import time
+import weakref
 import aiohttp
-from urllib.parse import urlparse
+from collections import deque
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import NamedTuple, Optional
+from urllib.parse import urlparse, urlencode
 
+from diversify.utils import DiversifyError, TokenManager
 
-async def gather_pages(spfy, paging_object):
+API_URL = 'https://api.spotify.com/v1'
+
+
+class APIError(DiversifyError):
+    """
+    A request to the Spotify API failed, even after retrying it.
+    """
+    def __init__(self, status, url):
+        super().__init__(f"Spotify API answered {status} for {url}")
+        self.status = status
+        self.url = url
+
+
+class TokenBucket:
+    """
+    Limits the rate of requests to rate per second, allowing bursts
+    of up to capacity requests.
+    """
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return now
+
+    def pause(self, seconds: float) -> None:
+        """
+        Stops handing out tokens for the next seconds, e.g. after
+        the API asked to retry later.
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self) -> None:
+        while True:
+            now = self._refill()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+            elif self._tokens >= 1:
+                self._tokens -= 1
+                return
+            else:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class AdaptiveLimiter:
+    """
+    Limits the requests in flight with additive increase and
+    multiplicative decrease (AIMD): every successful request raises the
+    limit by increase / limit, so it grows by about increase for each
+    full window of requests, and every throttled request multiplies it
+    by decrease.
+    """
+    def __init__(self, initial: float = 4, minimum: float = 1, maximum: float = 10,
+                 increase: float = 1.0, decrease: float = 0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.in_flight = 0
+        self._released = None
+
+    async def __aenter__(self):
+        if self._released is None:
+            self._released = asyncio.Condition()
+        async with self._released:
+            await self._released.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *args):
+        async with self._released:
+            self.in_flight -= 1
+            self._released.notify_all()
+
+    def success(self) -> None:
+        self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+
+    def throttled(self) -> None:
+        self.limit = max(self.minimum, self.limit * self.decrease)
+
+
+class RequestScheduler:
+    """
+    Schedules the requests to the Spotify API so they respect its rate
+    limit: a token bucket spaces the requests, an AIMD limiter adapts the
+    number of requests in flight to the throttling of the API, and
+    throttled (429) or failed (5xx) requests are retried after the time in
+    their Retry-After header or after an exponential backoff with jitter.
+
+    :param rate: requests per second allowed by the token bucket
+    :param burst: requests that can be made at once by the token bucket
+    :param concurrency: AdaptiveLimiter for the requests in flight
+    :param max_retries: retries of a request before giving up
+    :param backoff: base of the exponential backoff, in seconds
+    :param max_backoff: maximum wait between retries, in seconds
+    """
+    def __init__(self, rate: float = 20.0, burst: int = 20,
+                 concurrency: Optional[AdaptiveLimiter] = None, max_retries: int = 5,
+                 backoff: float = 0.5, max_backoff: float = 30.0):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency or AdaptiveLimiter()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retries = 0
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    @staticmethod
+    def retry_after(headers) -> Optional[float]:
+        """
+        Reads the Retry-After header, in seconds or as a HTTP date.
+        """
+        value = headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    async def request(self, session, url, headers, method='GET', json=None):
+        """
+        Makes a request, retrying it while the API is throttling or
+        failing. Only GET requests are retried after server errors, since
+        the others may have been applied before the API failed.
+
+        :return: the json object for the response
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            async with self.concurrency:
+                async with session.request(method, url, headers=headers, json=json) as resp:
+                    status = resp.status
+                    wait = self.retry_after(resp.headers)
+                    if status != 429 and (status < 500 or method != 'GET'):
+                        if status >= 400:
+                            raise APIError(status, url)
+                        self.concurrency.success()
+                        return await resp.json()
+
+            if status == 429:
+                self.concurrency.throttled()
+                if wait is not None:
+                    self.bucket.pause(wait)
+            if attempt < self.max_retries:
+                self.retries += 1
+                await asyncio.sleep(wait if wait is not None else self._backoff(attempt))
+
+        raise APIError(status, url)
+
+
+# The scheduler of each aiohttp session, so all requests made with a
+# session share the same rate limit
+_schedulers = weakref.WeakKeyDictionary()
+
+
+def scheduler_for(session) -> RequestScheduler:
+    """
+    Returns the RequestScheduler of the aiohttp session, creating one
+    with default parameters if it doesn't have any.
+    """
+    if session not in _schedulers:
+        _schedulers[session] = RequestScheduler(
+            concurrency=AdaptiveLimiter(maximum=getattr(session.connector, 'limit', 10) or 10))
+    return _schedulers[session]
+
+
+class PoolLimits(NamedTuple):
+    limit: int = 10  # Connections open at the same time
+    limit_per_host: int = 0  # Connections to the same host, 0 for no limit
+    ttl_dns_cache: Optional[int] = 300  # Seconds the DNS resolutions are kept
+    keepalive_timeout: float = 30.0  # Seconds an idle connection is kept open
+
+
+def _connector(limits):
+    return aiohttp.TCPConnector(
+        limit=limits.limit,
+        limit_per_host=limits.limit_per_host,
+        ttl_dns_cache=limits.ttl_dns_cache,
+        keepalive_timeout=limits.keepalive_timeout,
+    )
+
+
+def pooled_session(limits: Optional[PoolLimits] = None) -> aiohttp.ClientSession:
+    """
+    Opens an aiohttp session with a connection pool limited by limits.
+    It must be called from a running event loop.
+    """
+    return aiohttp.ClientSession(connector=_connector(limits or PoolLimits()))
+
+
+class AsyncClient:
+    """
+    An aiohttp session running in an event loop in a background thread,
+    so synchronous code can make concurrent requests that reuse the same
+    keep-alive connections and DNS cache, instead of creating a new event
+    loop and connection pool for every call.
+
+    :param limits: PoolLimits for the connection pool
+    :param scheduler: RequestScheduler for all requests made by the client
+    """
+    def __init__(self, limits: Optional[PoolLimits] = None,
+                 scheduler: Optional['RequestScheduler'] = None):
+        self.limits = limits or PoolLimits()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self.session = self.run(self._open())
+        if scheduler is not None:
+            _schedulers[self.session] = scheduler
+
+    async def _open(self):
+        return pooled_session(self.limits)
+
+    def run(self, coroutine):
+        """
+        Runs the coroutine in the client's event loop and waits for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def iterate(self, async_iterator):
+        """
+        Iterates over an async generator in the client's event loop,
+        waiting for one item at a time.
+        """
+        try:
+            while True:
+                try:
+                    yield self.run(async_iterator.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            if not self.closed:
+                self.run(async_iterator.aclose())
+
+    @property
+    def closed(self):
+        return self._loop.is_closed()
+
+    def close(self):
+        if self.closed:
+            return
+        self.run(self.session.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+@asynccontextmanager
+async def client_session(session=None, limit=10):
+    """
+    Uses the given aiohttp session, or opens a temporary one
+    limited to limit connections.
+    """
+    if session is not None:
+        yield session
+    else:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit)) as temporary:
+            yield temporary
+
+
+async def gather_pages(spfy, paging_object, session=None):
     """
     Obtains all pages from a Spotify's paged object concurrently.
     The pagination object is explained in:
@@ -11,6 +295,8 @@ async def gather_pages(spfy, paging_object):
 
     :param spfy: The Spotify Session Object
     :param paging_object: A paging object from Spotify Web API
+    :param session: aiohttp session used for the requests. If None, a new
+        one limited to 10 connections is used.
     :return: list with the json response for all pages
     """
     limit = paging_object['limit']
@@ -18,9 +304,7 @@ async def gather_pages(spfy, paging_object):
     url = paging_object['href']
 
     pages = [paging_object]
-    # Limits the parallel connections to 10
-    conn = aiohttp.TCPConnector(limit=10)
-    async with aiohttp.ClientSession(connector=conn) as session:
+    async with client_session(session) as session:
         tasks = [
             get(spfy, session, url) for url in offset_urls(url, total, limit)
         ]
@@ -30,21 +314,225 @@ async def gather_pages(spfy, paging_object):
     return pages
 
 
+async def _auth_headers(spfy):
+    """
+    OAuth headers of the spotipy session. Refreshing the token is a
+    blocking request, so it's made in another thread, off the event loop.
+    """
+    if isinstance(spfy.auth_manager, TokenManager) and spfy.auth_manager.expires_soon():
+        return await asyncio.get_running_loop().run_in_executor(None, spfy._auth_headers)
+    return spfy._auth_headers()
+
+
 async def get(spfy, session, url):
     """
     Makes a request to the Spotify API with the appropriate
-    OAuth headers.
+    OAuth headers, through the session's RequestScheduler.
+
+    :return: the json object for the response
+    """
+    headers = {
+        **(await _auth_headers(spfy)),
+        "Content-type": "application/json"
+    }
+
+    return await scheduler_for(session).request(session, url, headers)
+
+
+async def post(spfy, session, url, payload, method='POST'):
+    """
+    Sends a json payload to the Spotify API with the appropriate
+    OAuth headers, through the session's RequestScheduler.
 
+    :param method: POST, PUT or DELETE
     :return: the json object for the response
     """
     headers = {
-        **spfy._auth_headers(),
+        **(await _auth_headers(spfy)),
         "Content-type": "application/json"
     }
 
-    async with session.get(url, headers=headers) as resp:
-        response = await resp.json()
-        return response
+    return await scheduler_for(session).request(session, url, headers, method=method, json=payload)
+
+
+async def stream_pages(spfy, paging_object, limit=10, session=None):
+    """
+    Obtains all pages from a Spotify's paged object concurrently, yielding
+    them in order as they arrive. At most limit pages are requested ahead
+    of the one being yielded, so memory stays bounded however many pages
+    the object has.
+
+    :param spfy: The Spotify Session Object
+    :param paging_object: A paging object from Spotify Web API
+    :param limit: maximum number of requests in flight
+    :param session: aiohttp session used for the requests
+    :return: async iterator with the json response for all pages
+    """
+    yield paging_object
+
+    urls = offset_urls(paging_object['href'], paging_object['total'], paging_object['limit'])
+    window = deque()
+    async with client_session(session, limit) as session:
+        try:
+            for url in urls:
+                window.append(asyncio.ensure_future(get(spfy, session, url)))
+                if len(window) >= limit:
+                    yield await window.popleft()
+            while window:
+                yield await window.popleft()
+        finally:
+            for task in window:
+                task.cancel()
+
+
+async def gather_recommendations(spfy, seed_groups, target_size, max_requests,
+                                 country=None, limit=10, session=None):
+    """
+    Asks for recommendations from many groups of seed tracks concurrently,
+    until target_size distinct songs are found or max_requests were made.
+
+    The audio features of the new songs of each response are requested
+    as soon as the response arrives, in the same pipeline. The songs are
+    returned in the order of the requests rather than of the responses, so
+    the same recommendations always give the same songs.
+
+    :param spfy: The Spotify Session Object
+    :param seed_groups: iterator with lists of up to 5 seed track ids
+    :param target_size: number of distinct songs wanted
+    :param max_requests: maximum number of recommendation requests
+    :param country: ISO 3166-1 alpha-2 country code for the recommendations
+    :param limit: maximum number of requests in flight
+    :param session: aiohttp session used for the requests
+    :return: tuple with the list of tracks and the list of their audio features
+    """
+    seen = set()
+    responses, by_id = {}, {}
+    requests = iter(range(max_requests))
+    seed_groups = iter(seed_groups)
+
+    async def worker(session):
+        for index in requests:
+            seeds = next(seed_groups, None)
+            if seeds is None or len(by_id) >= target_size:
+                return
+            response = await get(spfy, session, recommendations_url(seeds, country))
+            responses[index] = response.get('tracks', [])
+
+            new = [track for track in responses[index] if track['id'] not in seen]
+            seen.update(track['id'] for track in new)
+            if not new:
+                continue
+
+            ids = ','.join(track['id'] for track in new)
+            response = await get(spfy, session, f'{API_URL}/audio-features?ids={ids}')
+            by_id.update((track['id'], (track, feat))
+                         for track, feat in zip(new, response.get('audio_features', []))
+                         if feat is not None)
+
+    async with client_session(session, limit) as session:
+        await asyncio.gather(*[worker(session) for _ in range(limit)])
+
+    songs = {}
+    for index in sorted(responses):
+        for track in responses[index]:
+            if len(songs) < target_size and track['id'] in by_id:
+                songs.setdefault(track['id'], by_id[track['id']])
+    tracks = [track for track, _ in songs.values()]
+    features = [feat for _, feat in songs.values()]
+    return tracks, features
+
+
+async def gather_features(spfy, trackids, batch=100, limit=10, session=None):
+    """
+    Requests the audio features of many tracks concurrently, in batches of
+    up to 100 ids, which is the maximum accepted by the Spotify API.
+
+    :param spfy: The Spotify Session Object
+    :param trackids: list with the ids of the tracks
+    :param batch: number of ids in each request
+    :param limit: maximum number of requests in flight
+    :param session: aiohttp session used for the requests
+    :return: list with the audio features for each id in the same order,
+        with None for the tracks unknown to Spotify
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def get_batch(session, ids):
+        async with semaphore:
+            return await get(spfy, session, f"{API_URL}/audio-features?ids={','.join(ids)}")
+
+    async with client_session(session, limit) as session:
+        tasks = [
+            get_batch(session, trackids[i:i + batch]) for i in range(0, len(trackids), batch)
+        ]
+        responses = await asyncio.gather(*tasks)
+
+    features = []
+    for start, response in zip(range(0, len(trackids), batch), responses):
+        found = response.get('audio_features') or []
+        size = len(trackids[start:start + batch])
+        features.extend(found[:size] + [None] * (size - len(found)))
+    return features
+
+
+async def stream_playlists(spfy, playlists, limit=10, page_size=100, session=None):
+    """
+    Requests the tracks of many playlists concurrently. The pages of all
+    playlists share the same limit of requests in flight, and the
+    playlists are yielded in the same order they were given as soon as
+    all their pages arrive, while the next ones are still being requested.
+
+    :param spfy: The Spotify Session Object
+    :param playlists: list with simplified playlist objects
+    :param limit: maximum number of requests in flight
+    :param page_size: number of tracks in each page, at most 100
+    :param session: aiohttp session used for the requests
+    :return: async iterator with tuples of (playlist, list with the json
+        response for all pages of its tracks)
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def get_page(session, url):
+        async with semaphore:
+            return await get(spfy, session, url)
+
+    async def get_playlist(session, playlist):
+        url = f"{API_URL}/playlists/{playlist['id']}/tracks?offset=0&limit={page_size}"
+        total = playlist.get('tracks', {}).get('total')
+        if total is None:
+            first = await get_page(session, url)
+            rest = await asyncio.gather(
+                *[get_page(session, url) for url in offset_urls(url, first['total'], page_size)])
+            return [first, *rest]
+
+        urls = [url, *offset_urls(url, total, page_size)] if total else []
+        return await asyncio.gather(*[get_page(session, url) for url in urls])
+
+    async with client_session(session, limit) as session:
+        tasks = [asyncio.ensure_future(get_playlist(session, playlist)) for playlist in playlists]
+        try:
+            for playlist, task in zip(playlists, tasks):
+                yield playlist, await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+async def gather_playlists(spfy, playlists, limit=10, page_size=100, session=None):
+    """
+    Requests the tracks of many playlists concurrently, as in stream_playlists.
+
+    :return: list with the pages of tracks of each playlist, in the same order
+    """
+    return [pages async for _, pages in
+            stream_playlists(spfy, playlists, limit, page_size, session=session)]
+
+
+def recommendations_url(seeds, country=None, limit=100):
+    query = {'seed_tracks': ','.join(seeds), 'limit': limit}
+    if country:
+        query['market'] = country
+    return f'{API_URL}/recommendations?{urlencode(query)}'
 
 
 def offset_urls(url, total, limit):
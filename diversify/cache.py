@@ -0,0 +1,133 @@
+"""
+    Persistent cache of audio features and playlist tracks, stored in a
+    SQLite database in the diversify config folder.
+
+    The audio features of a track never change for the same track id, so
+    after the first run most of the feature requests to the Spotify API
+    can be served from the disk instead.
+
+    The tracks of playlists are stored with the playlist's snapshot id,
+    which changes whenever the playlist is modified, so only the playlists
+    that changed since the last run need to be requested again.
+"""
+import os
+import json
+import time
+import sqlite3
+from pathlib import Path
+from typing import List, Dict, Iterable, Optional, Tuple
+
+import diversify.utils as utils
+from diversify.constants import DIVERSIFY_FOLDER
+from diversify.types import SongMetadata, AudioFeatures
+
+TRACK_CACHE = DIVERSIFY_FOLDER / 'tracks.sqlite'
+DEFAULT_TTL = 30 * 24 * 3600.0
+
+# SQLite limits the number of parameters in a query
+_chunk = 500
+
+
+class TrackCache:
+    """
+    Stores audio features by track id and the tracks of playlists by
+    playlist id.
+
+    :param path: path of the SQLite database
+    :param ttl: seconds after which an entry is considered expired,
+        None keeps the entries forever
+    """
+    _tables = ('features',)
+
+    def __init__(self, path: Path = TRACK_CACHE, ttl: Optional[float] = DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        # The async session uses the cache from its event loop thread, while
+        # the calls are still serialized by the sync session
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        with self._conn:
+            for table in self._tables:
+                self._conn.execute(
+                    f'CREATE TABLE IF NOT EXISTS {table} ('
+                    'id TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)'
+                )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS playlists ('
+                'id TEXT PRIMARY KEY, snapshot TEXT NOT NULL, data TEXT NOT NULL, '
+                'updated REAL NOT NULL)'
+            )
+
+    @classmethod
+    def default(cls) -> 'TrackCache':
+        """
+        Opens the cache in the diversify folder, with the TTL from the
+        DIVERSIFY_CACHE_TTL environment variable if it's set (e.g. 7d or 12h).
+        """
+        ttl = os.getenv('DIVERSIFY_CACHE_TTL')
+        DIVERSIFY_FOLDER.mkdir(parents=True, exist_ok=True)
+        return cls(TRACK_CACHE, utils.parse_duration(ttl) if ttl else DEFAULT_TTL)
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def _get(self, table: str, ids: Iterable[str]) -> Dict[str, dict]:
+        ids = list(dict.fromkeys(ids))
+        oldest = time.time() - self.ttl if self.ttl is not None else float('-inf')
+
+        result = {}
+        for start in range(0, len(ids), _chunk):
+            chunk = ids[start:start + _chunk]
+            marks = ','.join('?' * len(chunk))
+            rows = self._conn.execute(
+                f'SELECT id, data FROM {table} WHERE id IN ({marks}) AND updated >= ?',
+                (*chunk, oldest)
+            )
+            result.update((trackid, json.loads(data)) for trackid, data in rows)
+        return result
+
+    def _put(self, table: str, values: List[dict]) -> None:
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                f'INSERT OR REPLACE INTO {table} (id, data, updated) VALUES (?, ?, ?)',
+                [(value['id'], json.dumps(value), now) for value in values]
+            )
+
+    def get_features(self, ids: Iterable[str]) -> Dict[str, AudioFeatures]:
+        """
+        :return: dict from id to audio features for the ids that are cached
+            and not expired
+        """
+        return self._get('features', ids)
+
+    def put_features(self, features: List[AudioFeatures]) -> None:
+        self._put('features', features)
+
+    def get_playlists(self, ids: Iterable[str]) -> Dict[str, Tuple[str, List[SongMetadata]]]:
+        """
+        The snapshot id identifies the tracks of a playlist, so the
+        playlists never expire.
+
+        :return: dict from playlist id to a tuple of (snapshot id, list of
+            tracks) for the ids that are cached
+        """
+        ids = list(dict.fromkeys(ids))
+
+        result = {}
+        for start in range(0, len(ids), _chunk):
+            chunk = ids[start:start + _chunk]
+            marks = ','.join('?' * len(chunk))
+            rows = self._conn.execute(
+                f'SELECT id, snapshot, data FROM playlists WHERE id IN ({marks})', chunk
+            )
+            result.update((playlistid, (snapshot, json.loads(data)))
+                          for playlistid, snapshot, data in rows)
+        return result
+
+    def put_playlist(self, playlistid: str, snapshot: str, tracks: List[SongMetadata]) -> None:
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO playlists (id, snapshot, data, updated) '
+                'VALUES (?, ?, ?, ?)',
+                (playlistid, snapshot, json.dumps(tracks), time.time())
+            )
@@ -0,0 +1,268 @@
+"""
+    Record and replay of the responses of the Spotify WEB API, so a run of
+    diversify can be reproduced or profiled without network access.
+
+    In record mode, every response of the spotipy and aiohttp requests is
+    saved in a cassette, a gzipped JSON file. In replay mode the responses
+    are served from the cassette instead, optionally after a simulated
+    latency.
+
+    Audio features are stored by track id rather than by request, since
+    the ids grouped in each request change between runs. The other
+    requests are matched by method, url and payload. Only the endpoints
+    queried with random parameters, i.e. recommendations made from
+    randomly chosen seeds, fall back to the responses recorded for the
+    same endpoint.
+
+    The seed of the random choices of a run is kept in the cassette too, so
+    a replayed run asks for the same recommendations and writes the same
+    playlist as the recorded one.
+"""
+import json
+import gzip
+import time
+import asyncio
+import itertools
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import urlparse, parse_qs
+
+import spotipy
+
+import diversify.utils as utils
+from diversify.types import JsonObject
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+_features_path = '/v1/audio-features'
+# Endpoints whose queries change between runs, answered by any recorded response
+_random_paths = {'/v1/recommendations'}
+
+
+class CassetteMiss(utils.DiversifyError):
+    """
+    A request made in replay mode has no recorded response.
+    """
+    def __init__(self, method, url):
+        super().__init__(f"No response recorded for {method} {url}")
+
+
+def _endpoint(method: str, url: str) -> str:
+    parsed = urlparse(url)
+    return f'{method} {parsed.netloc}{parsed.path}'
+
+
+def _key(method: str, url: str, payload=None) -> str:
+    key = f'{method} {url}'
+    if payload is not None:
+        key += ' ' + json.dumps(payload, sort_keys=True)
+    return key
+
+
+def _feature_ids(method: str, url: str) -> Optional[List[str]]:
+    parsed = urlparse(url)
+    if method != 'GET' or parsed.path != _features_path:
+        return None
+    ids = parse_qs(parsed.query).get('ids', [''])[0]
+    return ids.split(',') if ids else []
+
+
+class Cassette:
+    """
+    Responses of the Spotify WEB API recorded in a file.
+
+    :param path: path of the cassette file
+    :param mode: RECORD to save the responses, REPLAY to serve them
+    :param latency: seconds waited before each replayed response
+    """
+    def __init__(self, path: Path, mode: str = REPLAY, latency: float = 0.0):
+        if mode not in (RECORD, REPLAY):
+            raise utils.DiversifyError(f"Unknown cassette mode: {mode}")
+
+        self.path = Path(path)
+        self.mode = mode
+        self.latency = latency
+        self._responses: Dict[str, List[JsonObject]] = {}
+        self._features: Dict[str, Optional[JsonObject]] = {}
+        self._replayed: Dict[str, int] = {}
+        self._endpoints: Dict[str, itertools.cycle] = {}
+        self.seed: Optional[int] = None
+
+        if mode == REPLAY:
+            self._load()
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == RECORD
+
+    def _load(self) -> None:
+        try:
+            with gzip.open(self.path, 'rt') as cassette:
+                data = json.load(cassette)
+        except FileNotFoundError:
+            raise utils.DiversifyError(f"Cassette {self.path} does not exist, record it first")
+        self._responses = data['responses']
+        self._features = data['features']
+        self.seed = data.get('seed')
+
+    def save(self) -> None:
+        """
+        Writes the recorded responses to the cassette file.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with gzip.open(self.path, 'wt') as cassette:
+            json.dump({'responses': self._responses, 'features': self._features,
+                       'seed': self.seed}, cassette, separators=(',', ':'))
+
+    def record(self, method: str, url: str, payload, response: JsonObject) -> None:
+        ids = _feature_ids(method, url)
+        if ids is not None:
+            for trackid, features in zip(ids, response.get('audio_features') or []):
+                self._features[trackid] = features
+            return
+        self._responses.setdefault(_key(method, url, payload), []).append(response)
+
+    def replay(self, method: str, url: str, payload=None) -> JsonObject:
+        """
+        Finds the recorded response for a request. Repeated requests get
+        the responses in the order they were recorded, repeating the last.
+
+        :raises CassetteMiss: if there is no response for the request
+        """
+        ids = _feature_ids(method, url)
+        if ids is not None:
+            if any(trackid not in self._features for trackid in ids):
+                raise CassetteMiss(method, url)
+            return {'audio_features': [self._features[trackid] for trackid in ids]}
+
+        key = _key(method, url, payload)
+        if key in self._responses:
+            count = self._replayed.get(key, 0)
+            self._replayed[key] = count + 1
+            responses = self._responses[key]
+            return responses[min(count, len(responses) - 1)]
+
+        if urlparse(url).path not in _random_paths:
+            raise CassetteMiss(method, url)
+        endpoint = _endpoint(method, url)
+        if endpoint not in self._endpoints:
+            similar = [responses for key, responses in self._responses.items()
+                       if _endpoint(*key.split(' ', 2)[:2]) == endpoint]
+            if not similar:
+                raise CassetteMiss(method, url)
+            self._endpoints[endpoint] = itertools.cycle(itertools.chain(*similar))
+        return next(self._endpoints[endpoint])
+
+    def spotify(self, spfy: Optional[spotipy.Spotify] = None) -> spotipy.Spotify:
+        """
+        Wraps the requests of a spotipy session. In replay mode no session
+        is needed, since nothing is requested.
+        """
+        if self.recording:
+            profile = getattr(spfy.auth_manager, 'profile', None)
+            if profile is not None:
+                # The session doesn't request a cached profile, but the replay will
+                self.record('GET', f'{spfy.prefix}me/', None, profile)
+            return CassetteSpotify(self, auth=spfy._auth, auth_manager=spfy.auth_manager)
+        return CassetteSpotify(self, auth='offline')
+
+    def wrap(self, session) -> 'CassetteSession':
+        """
+        Wraps the requests of an aiohttp session. In replay mode session
+        may be None, since nothing is requested.
+        """
+        return CassetteSession(self, session)
+
+
+class CassetteSpotify(spotipy.Spotify):
+    """
+    spotipy session whose requests are recorded in, or replayed from, a cassette.
+    """
+    def __init__(self, cassette: Cassette, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+    def _internal_call(self, method, url, payload, params):
+        full_url = url if url.startswith('http') else self.prefix + url
+        if params:
+            full_url += '?' + '&'.join(f'{key}={value}' for key, value in sorted(params.items())
+                                       if value is not None)
+
+        if not self.cassette.recording:
+            if self.cassette.latency:
+                time.sleep(self.cassette.latency)
+            return self.cassette.replay(method, full_url, payload)
+
+        response = super()._internal_call(method, url, payload, params)
+        self.cassette.record(method, full_url, payload, response)
+        return response
+
+
+class _Response:
+    def __init__(self, status: int, body, headers=None):
+        self.status = status
+        self.headers = headers or {}
+        self._body = body
+
+    async def json(self):
+        return self._body
+
+
+class _Request:
+    """
+    Async context manager with the response of a request, in the
+    same way as aiohttp's.
+    """
+    def __init__(self, cassette: Cassette, session, method: str, url: str, headers, payload):
+        self.cassette = cassette
+        self.session = session
+        self.request = (method, url, headers, payload)
+        self._response = None
+
+    async def __aenter__(self):
+        method, url, headers, payload = self.request
+        if not self.cassette.recording:
+            if self.cassette.latency:
+                await asyncio.sleep(self.cassette.latency)
+            return _Response(200, self.cassette.replay(method, url, payload))
+
+        self._response = self.session.request(method, url, headers=headers, json=payload)
+        resp = await self._response.__aenter__()
+        if resp.status >= 400:
+            # Throttling and errors are not reproducible, so they aren't recorded
+            return resp
+        body = await resp.json()
+        self.cassette.record(method, url, payload, body)
+        return _Response(resp.status, body, resp.headers)
+
+    async def __aexit__(self, *args):
+        if self._response is not None:
+            await self._response.__aexit__(*args)
+
+
+class CassetteSession:
+    """
+    aiohttp session whose requests are recorded in, or replayed from, a cassette.
+    """
+    def __init__(self, cassette: Cassette, session=None):
+        self.cassette = cassette
+        self.session = session
+
+    @property
+    def connector(self):
+        return self.session.connector if self.session is not None else None
+
+    @property
+    def closed(self) -> bool:
+        return self.session is None or self.session.closed
+
+    def request(self, method: str, url: str, headers=None, json=None) -> _Request:
+        return _Request(self.cassette, self.session, method, url, headers, json)
+
+    def get(self, url: str, headers=None) -> _Request:
+        return self.request('GET', url, headers=headers)
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
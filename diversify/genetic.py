@@ -1,151 +1,912 @@
+import heapq
+import time
 import warnings
-import random
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
 import pandas as pd
 import numpy as np
 import pprint
 import click
 
+from diversify.kdtree import KDTree
 from diversify.session import SpotifySession
+from diversify.store import FeatureStore
+from diversify.utils import DiversifyError
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
-population_size = 20
-genes_size = 20
-crossover_rate = 0.7
-maxiter = 50
-
 _columns = ['speechiness', 'liveness', 'danceability', 'loudness', 'acousticness',
             'instrumentalness', 'energy', 'tempo']
 
-_user1 = None  # Music list for first user
-_user2 = None  # Music list for second user
-_nsongs = None  # Random music list for mutations
-_twousers = False
 
+class GeneticConfig(NamedTuple):
+    population_size: int = 20
+    genes_size: int = 20
+    user_share: float = 0.5  # Fraction of the genes taken from the users' songs
+    crossover_rate: float = 0.7
+    mutation_rate: float = 0.01
+    mutation: str = 'guided'  # 'guided' mutations use neighbours of the songs, 'uniform' don't
+    neighbours: int = 10  # Neighbours considered by the guided mutation
+    local_search: int = 3  # Rounds of local search over the best individual, 0 disables it
+    maxiter: int = 50
+    cache_size: int = 4096
+    pool_size: int = 2000  # Recommended songs requested for the mutations
+    islands: int = 1  # Populations evolved in parallel processes
+    migration_interval: int = 10  # Generations between migrations in the island model
+    migrants: int = 2  # Best individuals sent from each island to the next one
+
+
+class FitnessCache:
+    """
+    Bounded memoization of fitness values with least recently used eviction.
 
-def generate_individual():
-    each = genes_size // 4 if _twousers else genes_size // 2
-    alreadyplaced = 2 * each if _twousers else each
+    The individuals are keyed by the set of their songs' ids, so the same
+    playlist is only scored once while it stays in the cache. The hit and
+    miss counters can be read after a run to check how effective it was.
+    """
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    @staticmethod
+    def fingerprint(ids):
+        return frozenset(ids)
+
+    def get(self, key):
+        try:
+            value = self._values[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._values.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._values[key] = value
+        self._values.move_to_end(key)
+        if len(self._values) > self.maxsize:
+            self._values.popitem(last=False)
+
+    def clear(self):
+        self.hits = 0
+        self.misses = 0
+        self._values.clear()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class StoppingPolicy:
+    """
+    Decides when the genetic algorithm can stop before maxiter generations.
+
+    :param patience: stops after this many generations without improving
+        the best fitness. None disables it.
+    :param min_delta: smallest increase of the best fitness that counts as
+        an improvement
+    :param time_budget: seconds the algorithm is allowed to run. None
+        disables it.
+    """
+    def __init__(self, patience=None, min_delta=0.0, time_budget=None):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.time_budget = time_budget
+        self.start()
+
+    def start(self):
+        self.best = -np.inf
+        self.stale = 0
+        self.generations = 0
+        self.deadline = time.time() + self.time_budget if self.time_budget is not None else None
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def update(self, best_fitness, generations=1):
+        """
+        Registers the best fitness after some generations.
+
+        :return: True if the algorithm should stop
+        """
+        self.generations += generations
+        if best_fitness > self.best + self.min_delta:
+            self.stale = 0
+        else:
+            self.stale += generations
+        self.best = max(self.best, best_fitness)
 
-    music1 = _user1.sample(each)
+        exhausted = self.patience is not None and self.stale >= self.patience
+        return exhausted or self.expired()
 
-    ransongs = _nsongs.sample(genes_size - alreadyplaced)
-    result = music1.append(ransongs)
-    if _twousers:
-        music2 = _user2.sample(each)
-        result = result.append(music2)
 
-    return result
+def standardize(songs):
+    """
+    Centers each column of the feature matrices and scales it to unit norm,
+    so the pearson correlation of two columns becomes their dot product.
+    Columns with no variance become zero, so they are ignored by the
+    correlation like pandas' corrwith does.
 
+    :param songs: array of shape (..., genes, features)
+    :return: array with the same shape as songs
+    """
+    centered = songs - songs.mean(axis=-2, keepdims=True)
+    norm = np.sqrt((centered ** 2).sum(axis=-2, keepdims=True))
+    return np.divide(centered, norm, out=np.zeros_like(centered), where=norm > 0)
 
-def generate_population():
-    return [generate_individual() for i in range(population_size)]
 
+def user_fitness(songs, reference):
+    """
+    Computes how much each individual of a population pleases each user,
+    as the sum of the pearson correlation between each of its columns and
+    the same column from the user's songs.
+
+    :param songs: features of the population, of shape (population, genes, features)
+    :param reference: users' features already passed through standardize,
+        of shape (users, genes, features)
+    :return: matrix of shape (users, population)
+    """
+    return np.einsum('pgf,ugf->up', standardize(songs), reference)
 
-def fitness(playlist):
-    result = correlation(playlist, _user1)
-    if _twousers:
-        result += correlation(playlist, _user2)
-        result /= 2
-    return result
 
+def batch_fitness(songs, reference):
+    """
+    Computes the fitness of a whole population in one call, which is the
+    user fitness averaged between all users.
 
-def correlation(indv1, indv2):
-    # Filtra o individuo para ficar apenas com valores int ou float
-    frame1 = indv1.select_dtypes(include=['float64', 'int64'])
-    frame2 = indv2.select_dtypes(include=['float64', 'int64'])
-    result = frame1.corrwith(frame2.set_index(frame1.index))
-    return result.sum()
+    :return: array with the fitness of each individual
+    """
+    return user_fitness(songs, reference).mean(axis=0)
 
 
-def select_parents(population, k=3):
-    parents = []
-    for tournament in range(len(population)):
-        competitors = [random.choice(population) for i in range(k)]
-        winner = max(competitors, key=fitness)
-        parents.append(winner)
-    return parents
+def correlation(indv1, indv2):
+    """
+    Sum of the pearson correlation between each column of both feature
+    matrices. Columns with no variance are ignored, like pandas' corrwith.
+    """
+    return batch_fitness(indv1[np.newaxis], standardize(indv2[np.newaxis]))[0]
 
 
-def remove_duplicates(indv):
-    result = indv.drop_duplicates(keep='first')
-    all_data = _user1.append(_nsongs)
+class FitnessStats:
+    """
+    Running sufficient statistics of one individual, to update its fitness
+    when a few songs are swapped without computing it from scratch.
+
+    For each column it keeps the sum and the sum of squares of the songs,
+    and for each user the sum of the cross products with the user's
+    standardized songs. Since the standardized songs have zero mean and unit
+    norm, the correlation of a column is the cross product divided by the
+    norm of the centered column of the individual. A swap updates the
+    statistics in O(users x features) instead of O(genes x features).
+
+    :param features: feature matrix of the songs
+    :param reference: users' features passed through standardize
+    :param individual: the songs of the individual, in order
+    """
+    def __init__(self, features, reference, individual):
+        self.features = features
+        self.reference = reference
+        self.individual = np.array(individual)
+
+        songs = features[self.individual]
+        self.sums = songs.sum(axis=0)
+        self.squares = (songs ** 2).sum(axis=0)
+        self.cross = np.einsum('gf,ugf->uf', songs, reference)
+
+    def _fitness(self, sums, squares, cross):
+        variance = squares - sums ** 2 / len(self.individual)
+        norm = np.sqrt(np.maximum(variance, 0))
+        # Columns with (almost) no variance are ignored, like in standardize
+        valid = norm > 1e-12 * np.maximum(np.sqrt(squares), 1)
+        correlations = np.divide(cross, norm, out=np.zeros_like(cross), where=valid)
+        return correlations.sum(axis=-1).mean(axis=-1)
+
+    @property
+    def fitness(self):
+        return self._fitness(self.sums, self.squares, self.cross)
+
+    def swap_fitness(self, position, songs):
+        """
+        Fitness the individual would have with each one of songs in the
+        given position, for many songs at once.
+
+        :param position: position of the song being replaced
+        :param songs: array with the candidate songs
+        :return: array with the fitness for each candidate
+        """
+        diff = self.features[songs] - self.features[self.individual[position]]
+        sums = self.sums + diff
+        squares = self.squares + self.features[songs] ** 2 \
+            - self.features[self.individual[position]] ** 2
+        cross = self.cross + diff[:, np.newaxis, :] * self.reference[:, position]
+        return self._fitness(sums[:, np.newaxis], squares[:, np.newaxis], cross)
+
+    def swap(self, position, song):
+        """
+        Puts song in the given position and updates the statistics.
+        """
+        new, old = self.features[song], self.features[self.individual[position]]
+        self.sums += new - old
+        self.squares += new ** 2 - old ** 2
+        self.cross += (new - old) * self.reference[:, position]
+        self.individual[position] = song
+
+
+def migrate(populations, scores, migrants):
+    """
+    Copies the best individuals of each island over the worst individuals
+    of the next island, in a ring.
+    """
+    best = [pop[np.argsort(score)[-migrants:]] for pop, score in zip(populations, scores)]
+    for i, (pop, score) in enumerate(zip(populations, scores)):
+        pop[np.argsort(score)[:migrants]] = best[i - 1]
+    return populations
 
-    if _twousers:
-        all_data.append(_user2)
 
-    while len(result.index) != 20:
-        songs = all_data.sample(population_size - len(result.index))
-        result = result.append(songs)
-        result.drop_duplicates(keep='first', inplace=True)
-    return result
+class FeatureMatrix:
+    """
+    Float matrix with the features of all songs known to the optimizers,
+    built once and shared by every playlist generated from it.
 
+    :param frames: DataFrames indexed by song id with the _columns features.
+        Songs present in more than one frame are kept once.
+    """
+    def __init__(self, frames):
+        alldata = pd.concat([frame[_columns] for frame in frames])
+        alldata = alldata[~alldata.index.duplicated(keep='first')]
 
-def generate_children(parents):
-    new_population = []
+        self.features = alldata.to_numpy(dtype='float64')
+        self.ids = alldata.index.to_numpy()
+        self._index = alldata.index
 
-    for i in range(population_size // 2):  # 2 parents generate 2 children
+    def __len__(self):
+        return len(self.features)
 
-        parent1 = random.choice(parents)
-        parent2 = random.choice(parents)
+    def rows(self, ids):
+        """
+        :return: the rows of the matrix with the songs in ids
+        """
+        return self._index.get_indexer(ids)
 
-        if random.random() < crossover_rate:
-            cut = random.randint(1, len(parent1) - 1)
-            child1 = parent1.sample(cut).append(parent2.sample(genes_size - cut))
-            child2 = parent2.sample(cut).append(parent1.sample(genes_size - cut))
-            child1 = remove_duplicates(child1)
-            child2 = remove_duplicates(child2)
-            if not child1.index.unique or not child2.index.unique:
-                new_population.extend([parent1, parent2])
+
+class PlaylistOptimizer:
+    """
+    Holds the state of one run of the genetic algorithm, so many playlists
+    can be generated in the same process.
+
+    The individuals are rows of indices into the optimizer's feature matrix,
+    so a population is an integer matrix of shape (population_size, genes_size).
+    The rows are kept sorted, which makes an individual behave like a set of songs.
+
+    :param matrix: FeatureMatrix with the songs of the users and candidates
+    :param users: for each user, the ids of the songs that represent the
+        user's taste. Only the first genes_size songs are used, and the
+        songs of users with fewer songs are repeated.
+    :param candidates: ids of the recommended songs used in mutations
+    :param config: GeneticConfig with the algorithm parameters
+    :param seed: seed for the optimizer's random generator
+    """
+    def __init__(self, matrix, users, candidates, config=None, seed=None):
+        self.config = config or GeneticConfig()
+        self.random = np.random.RandomState(seed)
+        self.fitness_cache = FitnessCache(self.config.cache_size)
+
+        genes = self.config.genes_size
+        users = [list(ids)[:genes] for ids in users]
+        sources = [matrix.rows(ids) for ids in users] + [matrix.rows(candidates)]
+        if any((rows < 0).any() for rows in sources):
+            raise DiversifyError("Some songs are missing from the feature matrix")
+
+        origin = np.concatenate([np.full(len(rows), i) for i, rows in enumerate(sources)])
+        rows, first = np.unique(np.concatenate(sources), return_index=True)
+        order = np.argsort(first)
+        rows, origin = rows[order], origin[first[order]]
+
+        self.features = matrix.features[rows]
+        self.ids = matrix.ids[rows]
+        self.pool = np.arange(len(rows))
+        self.user_pools = [np.flatnonzero(origin == i) for i in range(len(users))]
+        self.candidate_pool = np.flatnonzero(origin == len(users))
+
+        if len(self.pool) < genes:
+            raise DiversifyError(
+                f"Not enough songs to generate a playlist with {genes} songs")
+        # New individuals take the songs the users can't give from the
+        # recommendations, and mutations replace half of the songs with them
+        needed = max(genes - sum(self.gene_split()), (genes + 1) // 2)
+        if len(self.candidate_pool) < needed:
+            raise DiversifyError(
+                f"Only {len(self.candidate_pool)} recommended songs that are not in the "
+                f"users' songs, at least {needed} are needed, try a larger pool size")
+
+        self.reference = standardize(np.stack([self._reference(matrix, ids) for ids in users]))
+        self._tree = None
+
+    def _reference(self, matrix, ids):
+        """
+        Features of the songs of a user, one for each gene. The songs of
+        users with fewer songs than genes are repeated to fill them.
+        """
+        if not ids:
+            raise DiversifyError("Every user needs at least one song to generate a playlist")
+        rows = matrix.rows(ids)
+        return matrix.features[np.resize(rows, self.config.genes_size)]
+
+    @classmethod
+    def from_frames(cls, users, candidates, config=None, seed=None):
+        """
+        Builds an optimizer from DataFrames indexed by song id.
+        """
+        matrix = FeatureMatrix(list(users) + [candidates])
+        return cls(matrix, [user.index for user in users], candidates.index, config, seed)
+
+    def _sample(self, pool, nrows, k):
+        """
+        Draws k distinct elements of pool for each one of nrows rows.
+
+        :return: integer matrix of shape (nrows, k)
+        :raises DiversifyError: if pool has less than k elements
+        """
+        if k > len(pool):
+            raise DiversifyError(f"Can't draw {k} distinct songs from {len(pool)} songs")
+        keys = self.random.random_sample((nrows, len(pool)))
+        if 0 < k < len(pool):
+            keys = np.argpartition(keys, k - 1, axis=1)
+            return pool[keys[:, :k]]
+        return pool[np.argsort(keys, axis=1)[:, :k]]
+
+    def generate_individual(self):
+        return self.generate_population(1)[0]
+
+    def gene_split(self):
+        """
+        Number of genes taken from each user's songs in a new individual,
+        the remaining genes are taken from the recommended songs.
+
+        The user_share of the genes is divided between the users, the
+        first users get one more song when it can't be divided evenly.
+        """
+        nusers = len(self.user_pools)
+        each, extra = divmod(int(self.config.genes_size * self.config.user_share), nusers)
+        return [min(each + (i < extra), len(pool)) for i, pool in enumerate(self.user_pools)]
+
+    def generate_population(self, size=None):
+        size = self.config.population_size if size is None else size
+        split = self.gene_split()
+
+        parts = [self._sample(pool, size, each) for pool, each in zip(self.user_pools, split)]
+        parts.append(self._sample(self.candidate_pool, size, self.config.genes_size - sum(split)))
+
+        return self.repair(np.hstack(parts))
+
+    def fitness(self, playlist):
+        return batch_fitness(self.features[playlist][np.newaxis], self.reference)[0]
+
+    def population_fitness(self, population):
+        """
+        Fitness of every individual of the population, looked up in the
+        fitness cache before being computed.
+
+        The rows of the population are sorted, so the fitness of an individual
+        only depends on which songs it has, not on the order they were added.
+        """
+        scores = np.empty(len(population))
+        missing = {}
+        for i, indv in enumerate(population):
+            key = self.fitness_cache.fingerprint(self.ids[indv])
+            if key in missing:
+                missing[key].append(i)
+                continue
+            value = self.fitness_cache.get(key)
+            if value is None:
+                missing[key] = [i]
             else:
-                new_population.extend([child1, child2])
+                scores[i] = value
+
+        if missing:
+            first = [rows[0] for rows in missing.values()]
+            values = batch_fitness(self.features[population[first]], self.reference)
+            for (key, rows), value in zip(missing.items(), values):
+                scores[rows] = value
+                self.fitness_cache.put(key, value)
+        return scores
+
+    def select_parents(self, population, k=3):
+        scores = self.population_fitness(population)
+        competitors = self.random.randint(len(population), size=(len(population), k))
+        winners = competitors[np.arange(len(population)), scores[competitors].argmax(axis=1)]
+        return population[winners]
+
+    def repair(self, population):
+        """
+        Replaces the repeated songs of each individual by songs from the
+        candidate pool that are not in the individual yet.
+
+        The replacements of each individual are picked in a single draw
+        without replacement, with the songs already in the individual masked
+        out, so it always finishes as long as the pool has at least genes_size
+        songs.
+
+        :param population: integer matrix with one individual per row
+        :return: the population with sorted rows and no repeated songs
+        """
+        result = np.sort(population, axis=1)
+        repeated = np.zeros(result.shape, dtype=bool)
+        repeated[:, 1:] = result[:, 1:] == result[:, :-1]
+        broken = repeated.any(axis=1)
+        if not broken.any():
+            return result
+
+        rows = result[broken]
+        repeated = repeated[broken]
+        missing = repeated.sum(axis=1)
+        most = missing.max()
+
+        members = np.zeros((len(rows), len(self.pool)), dtype=bool)
+        members[np.arange(len(rows))[:, np.newaxis], rows] = True
+        keys = self.random.random_sample(members.shape)
+        keys[members] = np.inf
+
+        drawn = np.argpartition(keys, most - 1, axis=1)[:, :most]
+        # argpartition leaves the drawn songs unordered, and rows missing
+        # fewer songs than most must take the free ones first, before the
+        # members of the row with infinite keys
+        drawn = np.take_along_axis(
+            drawn, np.argsort(np.take_along_axis(keys, drawn, axis=1), axis=1), axis=1)
+        # The rows of drawn and repeated are both read from left to right
+        rows[repeated] = self.pool[drawn][np.arange(most) < missing[:, np.newaxis]]
+        result[broken] = np.sort(rows, axis=1)
+        return result
+
+    def generate_children(self, parents):
+        genes = self.config.genes_size
+        npairs = self.config.population_size // 2  # 2 parents generate 2 children
+
+        parent1 = parents[self.random.randint(len(parents), size=npairs)]
+        parent2 = parents[self.random.randint(len(parents), size=npairs)]
+
+        # Shuffling the genes makes the first genes of each parent a random sample
+        parent1 = np.take_along_axis(
+            parent1, self.random.random_sample(parent1.shape).argsort(axis=1), axis=1)
+        parent2 = np.take_along_axis(
+            parent2, self.random.random_sample(parent2.shape).argsort(axis=1), axis=1)
+
+        cut = self.random.randint(1, genes, size=(npairs, 1))
+        cut[self.random.random_sample(npairs) >= self.config.crossover_rate] = genes
+        first = np.arange(genes) < cut
+
+        child1 = np.where(first, parent1, parent2)
+        child2 = np.where(first, parent2, parent1)
+
+        return self.repair(np.vstack([child1, child2]))
+
+    def mutation(self, population, prob):
+        """
+        Replaces half of the songs of some individuals by recommended songs,
+        chosen at random or with the guided mutation depending on the config.
+        """
+        mutated = self.random.random_sample(len(population)) < prob
+        if not mutated.any():
+            return population
+
+        result = population.copy()
+        rows = result[mutated]
+        if self.config.mutation == 'guided':
+            rows[:, ::2] = self.neighbour_songs(rows[:, ::2])
         else:
-            new_population.extend([parent1, parent2])
+            rows[:, ::2] = self._sample(self.candidate_pool, len(rows), rows[:, ::2].shape[1])
+        result[mutated] = self.repair(rows)
+        return result
 
-    return new_population
+    def _index(self):
+        """
+        Builds, on first use, the KD-tree over the standardized features
+        of the recommended songs.
+        """
+        if self._tree is None:
+            songs = self.features[self.candidate_pool]
+            scale = songs.std(axis=0)
+            scale[scale == 0] = 1
+            self._center, self._scale = songs.mean(axis=0), scale
+            self._tree = KDTree((songs - self._center) / scale)
+            self._centroids = np.stack([
+                ((self.features[pool] - self._center) / scale).mean(axis=0)
+                for pool in self.user_pools
+            ])
+        return self._tree
+
+    def neighbour_songs(self, replaced):
+        """
+        Chooses a recommended song to replace each song in replaced, among
+        the nearest neighbours of either the song being replaced or the
+        centroid of a random user's songs, with the same chance.
+
+        :param replaced: integer array with the songs being replaced
+        :return: array with the same shape as replaced
+        """
+        tree = self._index()
+        targets = (self.features[replaced.ravel()] - self._center) / self._scale
+        to_centroid = self.random.random_sample(len(targets)) < 0.5
+        users = self.random.randint(len(self._centroids), size=to_centroid.sum())
+        targets[to_centroid] = self._centroids[users]
+
+        _, neighbours = tree.query(targets, self.config.neighbours)
+        picked = neighbours[np.arange(len(targets)),
+                            self.random.randint(neighbours.shape[1], size=len(targets))]
+        return self.candidate_pool[picked].reshape(replaced.shape)
+
+    def evolve(self, population, generations, deadline=None):
+        for _ in range(generations):
+            if deadline is not None and time.time() >= deadline:
+                break
+            parents = self.select_parents(population)
+            children = self.generate_children(parents)
+            population = self.mutation(children, self.config.mutation_rate)
+        return population
+
+    def _keep_best(self, population, best):
+        """
+        Puts the best individual found so far in the place of the
+        worst individual of the population, if it's not there already.
+        """
+        scores = self.population_fitness(population)
+        if best is not None and best[1] > scores.max():
+            population = population.copy()
+            population[scores.argmin()] = best[0]
+        return population
+
+    def run(self, stopping=None, progress=True):
+        """
+        Runs the genetic algorithm for maxiter generations, or until the
+        stopping policy decides it's not worth going further.
+
+        With more than one island, each island evolves its own population in a
+        separate process and the best individuals of each island replace the
+        worst ones of the next island every migration_interval generations.
+
+        :param stopping: StoppingPolicy for early stopping and time budget,
+            its time budget counts from the last call to its start method
+        :param progress: shows a progress bar in the terminal
+        :return: the final population of all islands, with the best
+            individual found during the run
+        """
+        stopping = stopping or StoppingPolicy()
+
+        if self.config.islands > 1:
+            return self.run_islands(stopping, progress)
+
+        pop = self.generate_population()
+        best = None
+
+        with _progressbar(range(self.config.maxiter), progress) as bar:
+            for _ in bar:
+                pop = self.evolve(pop, 1)
+                scores = self.population_fitness(pop)
+                if best is None or scores.max() > best[1]:
+                    best = pop[scores.argmax()], scores.max()
+                if stopping.update(scores.max()):
+                    break
+
+        return self._keep_best(pop, best)
+
+    def run_islands(self, stopping, progress=True):
+        islands = self.config.islands
+        interval = self.config.migration_interval
+        maxiter = self.config.maxiter
+
+        populations = [self.generate_population() for _ in range(islands)]
+        epochs = [interval] * (maxiter // interval)
+        if maxiter % interval:
+            epochs.append(maxiter % interval)
+        best = None
+
+        with ProcessPoolExecutor(islands, initializer=_init_island, initargs=(self,)) as executor:
+            with _progressbar(epochs, progress) as bar:
+                for generations in bar:
+                    seeds = self.random.randint(2 ** 31, size=islands)
+                    results = list(executor.map(
+                        _evolve_island, populations, [generations] * islands, seeds,
+                        [stopping.deadline] * islands))
+
+                    populations, scores = map(list, zip(*results))
+                    top = int(np.argmax([score.max() for score in scores]))
+                    if best is None or scores[top].max() > best[1]:
+                        best = populations[top][scores[top].argmax()], scores[top].max()
+                    if stopping.update(best[1], generations):
+                        break
+                    populations = migrate(populations, scores, self.config.migrants)
+
+        return self._keep_best(np.vstack(populations), best)
+
+    def frame(self, indv):
+        """
+        :return: the individual as a DataFrame of features indexed by the songs' ids
+        """
+        return pd.DataFrame(self.features[indv], index=pd.Index(self.ids[indv], name='id'),
+                            columns=_columns)
+
+    def best(self, population):
+        """
+        :return: the best individual of the population as a DataFrame
+        """
+        return self.frame(population[np.argmax(self.population_fitness(population))])
+
+    def refine(self, indv, rounds=None, deadline=None):
+        """
+        Local search over an individual, swapping one song at a time for
+        the song of the pool that most improves the fitness, until no swap
+        improves it or the rounds are over.
+
+        The fitness of all possible swaps of a position is computed at once
+        from the individual's running statistics, so each round costs
+        O(genes x pool x features) instead of computing the fitness of every
+        swap from scratch.
+
+        The positions of the songs are kept, so the result is not sorted
+        like the individuals of the population.
+
+        :param indv: the individual to be improved
+        :param rounds: maximum passes through all positions, defaults to
+            the local_search of the config
+        :param deadline: time.time() after which the search stops
+        :return: the improved individual
+        """
+        rounds = self.config.local_search if rounds is None else rounds
+        stats = FitnessStats(self.features, self.reference, indv)
+        members = np.zeros(len(self.pool), dtype=bool)
+        members[stats.individual] = True
+
+        for _ in range(rounds):
+            improved = False
+            for position in self.random.permutation(len(stats.individual)):
+                if deadline is not None and time.time() >= deadline:
+                    return stats.individual
+                candidates = self.pool[~members]
+                scores = stats.swap_fitness(position, candidates)
+                best = scores.argmax()
+                if scores[best] > stats.fitness + 1e-12:
+                    members[stats.individual[position]] = False
+                    members[candidates[best]] = True
+                    stats.swap(position, candidates[best])
+                    improved = True
+            if not improved:
+                break
+        return stats.individual
+
+    def optimize(self, stopping=None, progress=True):
+        """
+        Runs the genetic algorithm and refines its best individual with
+        local search.
+
+        :return: the best playlist as a DataFrame of features indexed by song id
+        """
+        stopping = stopping or StoppingPolicy()
+        pop = self.run(stopping, progress)
+        indv = pop[np.argmax(self.population_fitness(pop))]
+        if self.config.local_search:
+            indv = self.refine(indv, deadline=stopping.deadline)
+        return self.frame(indv)
+
+    def greedy(self):
+        """
+        Builds an individual by lazy greedy selection, as a fast alternative
+        to the genetic algorithm.
+
+        The fitness correlates the songs of the playlist with the users' songs
+        position by position, so each position of the playlist is a slot with
+        the standardized features of the users' songs at that position,
+        averaged between the users. A song covers the slots that are close to
+        it in the standardized feature space, and the objective is the
+        coverage of all slots. This objective is submodular, so the marginal
+        gain of a song only decreases as the playlist grows and most songs
+        never need to be evaluated again after the first pass. The number of
+        songs taken from each user's pool follows gene_split, like in the
+        genetic algorithm.
+
+        :return: array with the songs of the individual, in the order of
+            the slots they were assigned to
+        """
+        genes = self.config.genes_size
+        scale = self.features.std(axis=0)
+        scale[scale == 0] = 1
+        songs = (self.features - self.features.mean(axis=0)) / scale
+        slots = self.reference.mean(axis=0) * np.sqrt(genes)
+
+        distances = ((slots[:, np.newaxis, :] - songs[np.newaxis, :, :]) ** 2).sum(axis=2)
+        similarity = np.exp(-distances / songs.shape[1])
+
+        split = self.gene_split()
+        quota = split + [genes - sum(split)]
+        source = np.full(len(self.pool), len(self.user_pools))
+        for i, pool in enumerate(self.user_pools):
+            source[pool] = i
+
+        covered = np.zeros(genes)
+        heap = [(-gain, song) for song, gain in enumerate(similarity.sum(axis=0))]
+        heapq.heapify(heap)
+        chosen = []
+
+        while heap and len(chosen) < genes:
+            _, song = heapq.heappop(heap)
+            if quota[source[song]] == 0:
+                continue
+            gain = np.maximum(similarity[:, song] - covered, 0).sum()
+            if heap and gain < -heap[0][0]:
+                heapq.heappush(heap, (-gain, song))
+                continue
+            chosen.append(song)
+            quota[source[song]] -= 1
+            covered = np.maximum(covered, similarity[:, song])
+
+        if len(chosen) < genes:
+            # Pools smaller than their quota leave free slots for any song
+            free = np.setdiff1d(self.pool, chosen)
+            chosen.extend(self.random.choice(free, genes - len(chosen), replace=False))
+        return np.array(chosen)[self._assign_slots(similarity[:, chosen])]
+
+    @staticmethod
+    def _assign_slots(similarity):
+        """
+        Assigns each chosen song to a slot, taking the most similar
+        pairs first.
+
+        :param similarity: square matrix of slots x chosen songs
+        :return: the chosen song for each slot
+        """
+        assignment = np.full(len(similarity), -1)
+        used = np.zeros(similarity.shape[1], dtype=bool)
+        for pair in np.argsort(similarity, axis=None)[::-1]:
+            slot, song = divmod(pair, similarity.shape[1])
+            if assignment[slot] < 0 and not used[song]:
+                assignment[slot] = song
+                used[song] = True
+        return assignment
+
+
+def _progressbar(iterable, progress):
+    if progress:
+        return click.progressbar(iterable)
+    return _NoProgress(iterable)
+
+
+class _NoProgress:
+    def __init__(self, iterable):
+        self.iterable = iterable
+
+    def __enter__(self):
+        return self.iterable
+
+    def __exit__(self, *args):
+        return False
+
+
+# Optimizer of the island processes, sent once to each worker
+_island = None
+
+
+def _init_island(optimizer):
+    global _island
+    _island = optimizer
+    _island.fitness_cache.clear()
+
+
+def _evolve_island(population, generations, seed, deadline):
+    _island.random.seed(seed)
+    population = _island.evolve(population, generations, deadline)
+    return population, _island.population_fitness(population)
+
+
+def _user_frame(songs, config):
+    return songs.set_index('id')[:config.genes_size][_columns]
+
+
+def candidate_songs(spfy, users, pool_size=GeneticConfig().pool_size):
+    """
+    Asks the Spotify API for a pool of songs recommended from the songs
+    of all users, to be used in mutations.
 
+    :param users: DataFrames with the songs of each user in the id column
+    :param pool_size: number of recommended songs wanted
+    :return: DataFrame with the features of the recommended songs
+    """
+    tracks = [user[['id']].to_dict('records') for user in users]
+    pool = spfy.get_candidate_pool(tracks, target_size=pool_size)
+    return pd.DataFrame(pool.features, columns=['id'] + _columns).set_index('id')
 
-def mutation(indv, prob):
-    if np.random.random() < prob:
-        rest = _nsongs.sample(len(indv) // 2)
-        dropped = indv.drop(indv.index[::2])
-        result = dropped.append(rest)
-        result = remove_duplicates(result)
-        # if len(result) == 20:       # Gambiarra master
-        return result
-    return indv
 
+def _optimizer(spfy, users, user2, config, seed=None):
+    users = list(users) + ([user2] if user2 is not None else [])
+    if not users:
+        raise DiversifyError("At least one user is needed to generate a playlist")
+    nsongs = candidate_songs(spfy, users, config.pool_size)
+    users = [_user_frame(user, config) for user in users]
+    return PlaylistOptimizer.from_frames(users, nsongs, config, seed)
 
-def run():
-    pop = generate_population()
 
-    with click.progressbar(range(maxiter)) as bar:
-        for _ in bar:
-            parents = select_parents(pop)
-            children = generate_children(parents)
-            pop = [mutation(child, 0.01) for child in children]
+def start(spfy, *users, user2=None, config=None, stopping=None, seed=None):
+    """
+    Generates a playlist for any number of users.
+
+    :param spfy: SpotifySession used to get recommendations
+    :param users: DataFrames with the songs of each user
+    :param user2: songs of a second user, kept for compatibility
+    :param config: GeneticConfig with the algorithm parameters
+    :param stopping: StoppingPolicy for early stopping and time budget
+    :param seed: seed for the optimizer's random generator
+    :return: DataFrame with the features of the playlist indexed by song id
+    """
+    config = config or GeneticConfig()
+    stopping = stopping or StoppingPolicy()
+    stopping.start()
 
-    return pop
+    optimizer = _optimizer(spfy, users, user2, config, seed)
+    return optimizer.optimize(stopping)
 
 
-def start(spfy, user1, user2=None):
-    global _user1, _nsongs, _twousers, _user2
-    _user1 = user1.set_index('id')[:genes_size][_columns]
+def greedy_start(spfy, *users, user2=None, config=None, seed=None):
+    """
+    Generates a playlist for any number of users with greedy selection
+    instead of the genetic algorithm. Takes the same arguments as start,
+    and it's much faster, at the cost of some fitness.
+
+    The songs in the result are in the order of the slots they were
+    assigned to, which is the order used by the fitness.
+    """
+    optimizer = _optimizer(spfy, users, user2, config or GeneticConfig(), seed)
+    return optimizer.frame(optimizer.greedy())
+
+
+def _optimize(optimizer, stopping):
+    return optimizer.optimize(stopping, progress=False)
 
-    if user2 is not None:
-        _twousers = True
-        _user2 = user2.set_index('id')[:genes_size][_columns]
-        samples = _user1.sample(2).append(_user2.sample(2))
-    else:
-        samples = _user1.sample(4)
 
-    seeds = [{'id': value} for value in samples.index]
-    nsongs = spfy.get_new_songs(seeds)
-    _nsongs = pd.DataFrame(spfy.get_features(nsongs))
-    _nsongs.set_index('id', inplace=True)
+def optimize_many(spfy, requests, songs, config=None, stopping=None, max_workers=None):
+    """
+    Generates playlists for many groups of users in the same process.
+
+    The feature matrix with the songs of every user and every recommendation
+    is built only once, and the optimizations run concurrently in a pool
+    of processes.
+
+    :param spfy: SpotifySession used to get recommendations
+    :param requests: list of tuples with the ids of the users in each
+        playlist, e.g. (userid, friendid). None entries are ignored.
+    :param songs: dict from user id to a DataFrame with the user's songs
+    :param config: GeneticConfig shared by all optimizations
+    :param stopping: StoppingPolicy, its time budget is for the whole batch
+    :param max_workers: number of processes, defaults to the number of CPUs
+    :return: list with the playlist of each request, in the same order
+    """
+    config = config or GeneticConfig()
+    stopping = stopping or StoppingPolicy()
+    stopping.start()
+
+    groups = [[userid for userid in request if userid is not None] for request in requests]
+    candidates = [candidate_songs(spfy, [songs[userid] for userid in group], config.pool_size)
+                  for group in groups]
+    users = {userid: _user_frame(frame, config) for userid, frame in songs.items()}
 
-    pop = run()
-    return max(pop, key=fitness)
+    matrix = FeatureMatrix(list(users.values()) + candidates)
+    seeds = np.random.randint(2 ** 31, size=len(groups))
+    optimizers = [
+        PlaylistOptimizer(matrix, [users[userid].index for userid in group],
+                          nsongs.index, config, seed)
+        for group, nsongs, seed in zip(groups, candidates, seeds)
+    ]
+
+    with ProcessPoolExecutor(max_workers) as executor:
+        return list(executor.map(_optimize, optimizers, [stopping] * len(optimizers)))
 
 
 if __name__ == '__main__':
@@ -184,18 +945,15 @@ if __name__ == '__main__':
 
     pl_name = ' '.join(args.playlist_name)
 
-    indv1 = pd.read_csv('csvfiles/playlistfeatures.csv')
-    indv2 = pd.read_csv('csvfiles/maxmyllercarvalhofeatures.csv')
+    store = FeatureStore()
+    indv1 = store.read('playlist', columns=['id'] + _columns)
+    indv2 = store.read('maxmyllercarvalho', columns=['id'] + _columns)
 
     spfy = SpotifySession()
 
-    _user1 = indv1[:genes_size][_columns + ['id']]
-    _user2 = indv2[:genes_size][_columns + ['id']]
-    _twousers = True
-
     print(_columns)
 
-    result = start(spfy, _user1, user2=_user2)
+    result = start(spfy, indv1, user2=indv2)
 
     pprint.pprint(result)
     resultids = result.index.tolist()
@@ -0,0 +1,116 @@
+"""
+    A small KD-tree written with NumPy, used to find songs with similar
+    audio features without comparing against every song of the pool.
+
+    The tree is stored in flat arrays instead of node objects, and the
+    songs of each leaf are compared at once with vectorized distances.
+"""
+import numpy as np
+
+
+class KDTree:
+    """
+    KD-tree over the rows of a float matrix.
+
+    :param data: matrix of shape (points, dimensions)
+    :param leafsize: maximum number of points in a leaf
+    """
+    def __init__(self, data, leafsize=64):
+        self.data = np.asarray(data, dtype='float64')
+        self.leafsize = leafsize
+        self.indices = np.arange(len(self.data))
+
+        # Node i splits on dimension dims[i] at value splits[i]. Leaves have
+        # dims[i] == -1 and hold the points indices[starts[i]:ends[i]]
+        self.dims = []
+        self.splits = []
+        self.children = []
+        self.starts = []
+        self.ends = []
+        self._build()
+
+    def __len__(self):
+        return len(self.data)
+
+    def _new_node(self, start, end):
+        self.dims.append(-1)
+        self.splits.append(0.0)
+        self.children.append((-1, -1))
+        self.starts.append(start)
+        self.ends.append(end)
+        return len(self.dims) - 1
+
+    def _build(self):
+        stack = [self._new_node(0, len(self.data))]
+        while stack:
+            node = stack.pop()
+            start, end = self.starts[node], self.ends[node]
+            if end - start <= self.leafsize:
+                continue
+
+            points = self.data[self.indices[start:end]]
+            spread = points.max(axis=0) - points.min(axis=0)
+            dim = int(spread.argmax())
+            if spread[dim] == 0:
+                continue
+
+            middle = (end - start) // 2
+            order = np.argpartition(points[:, dim], middle)
+            self.indices[start:end] = self.indices[start:end][order]
+
+            self.dims[node] = dim
+            self.splits[node] = self.data[self.indices[start + middle], dim]
+            left = self._new_node(start, start + middle)
+            right = self._new_node(start + middle, end)
+            self.children[node] = (left, right)
+            stack.extend([left, right])
+
+    def query(self, points, k=1):
+        """
+        Finds the k nearest neighbours of each point.
+
+        :param points: matrix of shape (queries, dimensions)
+        :param k: number of neighbours for each point
+        :return: tuple with the distances and the indices of the neighbours,
+            both of shape (queries, k) and sorted by distance
+        """
+        points = np.atleast_2d(np.asarray(points, dtype='float64'))
+        k = min(k, len(self.data))
+        distances = np.empty((len(points), k))
+        indices = np.empty((len(points), k), dtype=int)
+
+        for i, point in enumerate(points):
+            distances[i], indices[i] = self._query_point(point, k)
+        return np.sqrt(distances), indices
+
+    def _query_point(self, point, k):
+        best_dist = np.full(k, np.inf)
+        best_idx = np.full(k, -1)
+        stack = [(0, 0.0)]
+
+        while stack:
+            node, bound = stack.pop()
+            if bound > best_dist[-1]:
+                continue
+
+            dim = self.dims[node]
+            if dim < 0:
+                members = self.indices[self.starts[node]:self.ends[node]]
+                dist = ((self.data[members] - point) ** 2).sum(axis=1)
+                closer = dist < best_dist[-1]
+                if not closer.any():
+                    continue
+                members, dist = members[closer], dist[closer]
+                alldist = np.concatenate([best_dist, dist])
+                allidx = np.concatenate([best_idx, members])
+                order = np.argsort(alldist, kind='stable')[:k]
+                best_dist, best_idx = alldist[order], allidx[order]
+                continue
+
+            diff = point[dim] - self.splits[node]
+            near, far = self.children[node] if diff < 0 else self.children[node][::-1]
+            # The far side is pushed first, so the near side is searched first
+            stack.append((far, max(bound, diff ** 2)))
+            stack.append((near, bound))
+
+        return best_dist, best_idx
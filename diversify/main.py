@@ -3,11 +3,15 @@ import click
 import sys
 import os
 import pprint
+import numpy as np
 import pandas as pd
 import diversify.genetic as gen
 import diversify.utils as utils
 
 from diversify.session import SpotifySession
+from diversify.cache import TrackCache
+from diversify.cassette import Cassette, RECORD, REPLAY
+from diversify.store import FeatureStore, FEATURES_FOLDER
 from diversify.constants import CACHE_FILE, DIVERSIFY_FOLDER
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -15,21 +19,128 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 twousers = False
 
 
+class Duration(click.ParamType):
+    """
+    Command line duration, like 1.5s or 200ms, converted to seconds.
+    """
+    name = 'duration'
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, float):
+            return value
+        try:
+            return utils.parse_duration(value)
+        except utils.DiversifyError as e:
+            self.fail(str(e), param, ctx)
+
+
 def get_songs(spfy, userid):
+    """
+    Loads the songs of the user from the feature store, where the songs
+    downloaded to csv files are kept, or from the user's playlists if they
+    were never downloaded. The playlists are read on every run, so their
+    changes are picked up, and only the playlists that changed are
+    requested again. Only the columns used by the playlist generators are
+    loaded.
+    """
+    columns = ['id'] + gen._columns
+    songs = FeatureStore().read(userid, columns=columns)
+    if songs is None:
+        result = spfy.get_user_playlists(userid, features=True, flat=True, unique=True)
+        songs = pd.DataFrame(result, columns=columns)
+    if songs.empty:
+        raise utils.DiversifyError(f"No songs found in the public playlists of {userid}")
+    return songs
+
+
+def open_session(record=None, replay=None, latency=0.0):
+    """
+    Opens a session with the cached login, which is closed
+    when the command finishes.
+
+    If record or replay is given, the responses of the API are recorded
+    in, or replayed from, the cassette in that path. The track cache is
+    not used with a cassette, so every response goes through it.
+    """
+    ctx = click.get_current_context()
+    if record and replay:
+        ctx.fail('--record and --offline cannot be used together')
+
+    cassette = None
     try:
-        return pd.read_csv('csvfiles/' + userid + 'features.csv')
-    except FileNotFoundError:
-        result = spfy.get_user_playlists(userid, features=True, flat=True)
-        return pd.DataFrame(result)
+        if record:
+            cassette = Cassette(record, RECORD)
+        elif replay:
+            cassette = Cassette(replay, REPLAY, latency)
+        cache = TrackCache.default() if cassette is None else None
+        spfy = SpotifySession(authenticate=False, cache=cache, cassette=cassette)
+    except utils.DiversifyError as e:
+        click.secho(str(e), fg='red')
+        sys.exit(1)
+
+    # The callbacks run in reverse order, so the cache is closed after the session
+    if cache is not None:
+        ctx.call_on_close(cache.close)
+    if cassette is not None and cassette.recording:
+        ctx.call_on_close(cassette.save)
+    ctx.call_on_close(spfy.close)
+    return spfy
+
+
+def random_seed(spfy, seed=None):
+    """
+    Seeds the random choices made to generate a playlist. A recorded cassette
+    keeps the seed of its run, so replaying it gives the same playlist.
+
+    :return: the seed used, None if the choices are not seeded
+    """
+    cassette = spfy._cassette
+    if cassette is not None and cassette.recording:
+        cassette.seed = seed if seed is not None else int(np.random.randint(2 ** 31))
+        seed = cassette.seed
+    elif cassette is not None and cassette.seed is not None:
+        seed = cassette.seed
+
+    if seed is not None:
+        np.random.seed(seed)
+    return seed
+
+
+def cassette_options(command):
+    """
+    Adds the options to record the responses of the API, or to replay
+    them without network access.
+    """
+    options = [
+        click.option('--record', type=click.Path(dir_okay=False),
+                     help='Records the responses of the API in this cassette file'),
+        click.option('--offline', 'replay', type=click.Path(dir_okay=False, exists=True),
+                     help='Replays the responses recorded in this cassette file'),
+        click.option('--latency', type=Duration(), default=0.0,
+                     help='Simulated latency of each replayed response, e.g. 50ms'),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
 
 
 def show_songs_info(songs):
     """
     Shows information about songs in a playlist
     """
+    for _ in shown(songs):
+        pass
+
+
+def shown(songs):
+    """
+    Shows information about songs as they are generated,
+    passing them along.
+    """
     print("song name {20* ' '}- artist {15 * ' '}- album")
     for song in songs:
         print(f"{song['name']:20} - {song['artist']:15} - {song['album']}")
+        yield song
 
 
 @click.group()
@@ -43,6 +154,12 @@ def diversify():
 
 @diversify.command()
 def login():
+    manager = utils.token_manager()
+    if manager and manager.profile and manager.usable():
+        name = manager.profile.get('display_name') or manager.profile['id']
+        click.secho(f"Already logged in as {name}", fg='green')
+        return
+
     try:
         utils.login_user()
         click.secho("Logged in successfully", fg='green')
@@ -59,10 +176,62 @@ def logout():
         click.secho("Already logged out", fg='yellow')
 
 
+@diversify.command(short_help="moves the csv files with songs to the feature store")
+@click.option('--folder', type=click.Path(file_okay=False), default=str(FEATURES_FOLDER),
+              show_default=True, help='Folder with the <userid>features.csv files')
+@click.option('--format', 'fmt', type=click.Choice(['parquet', 'feather', 'npz']),
+              help='Format of the store, parquet if pyarrow is installed, else npz')
+def migrate(folder, fmt):
+    """
+    Copies the songs in the <userid>features.csv files to the columnar
+    feature store, which loads much faster.
+    """
+    try:
+        users = FeatureStore(folder, fmt).migrate_all()
+    except utils.DiversifyError as e:
+        click.secho(str(e), fg='red')
+        sys.exit(1)
+
+    if users:
+        click.secho(f"Migrated the songs of {', '.join(users)}", fg='green')
+    else:
+        click.secho(f"No csv files with songs in {folder}", fg='yellow')
+
+
 @diversify.command(short_help="creates a playlist using you musical taste")
-@click.option('-f', '--friend', help='Your friend Spotify ID')
+@click.option('-f', '--friend', multiple=True,
+              help='Your friend Spotify ID, can be repeated for group playlists')
+@click.option('--user-share', default=gen.GeneticConfig().user_share, show_default=True,
+              type=click.FloatRange(0.0, 1.0),
+              help='Fraction of the playlist taken from the users\' songs')
+@click.option('--pool-size', default=gen.GeneticConfig().pool_size, show_default=True,
+              type=click.IntRange(min=1), help='Recommended songs considered for the playlist')
+@click.option('--engine', type=click.Choice(['genetic', 'greedy']), default='genetic',
+              show_default=True, help='Algorithm used to choose the songs')
+@click.option('--mutation', type=click.Choice(['guided', 'uniform']),
+              default=gen.GeneticConfig().mutation, show_default=True,
+              help='Mutations with neighbour songs or with random songs')
+@click.option('--islands', default=1, show_default=True, type=click.IntRange(min=1),
+              help='Number of populations evolved in parallel processes')
+@click.option('--migration-interval', default=gen.GeneticConfig().migration_interval,
+              show_default=True, type=click.IntRange(min=1),
+              help='Generations between migrations of the islands')
+@click.option('--patience', type=click.IntRange(min=1),
+              help='Stops after this many generations without improvement')
+@click.option('--min-delta', default=0.0, show_default=True,
+              help='Smallest fitness increase that counts as an improvement')
+@click.option('--time-budget', type=Duration(),
+              help='Maximum time to generate the playlist, e.g. 1.5s')
+@click.option('--seed', type=int,
+              help='Seed of the random choices, the one recorded is used with --offline')
+@click.option('--update/--new', default=True, show_default=True,
+              help='Updates the playlist diversify created with that name, '
+                   'instead of creating another one')
+@cassette_options
 @click.argument('playlist_name', nargs=-1, required=True)
-def playlist(friend, playlist_name):
+def playlist(friend, user_share, pool_size, engine, mutation, islands, migration_interval,
+             patience, min_delta, time_budget, seed, update, record, replay, latency,
+             playlist_name):
     """
 
         DIVERSIFY PLAYLIST GENERATOR
@@ -71,9 +240,16 @@ def playlist(friend, playlist_name):
 
         This program will create a new playlist in your account based on your
         saved songs and your friend's Spotify public playlists, trying to
-        please both of your musical tastes.
+        please both of your musical tastes. Repeat --friend to create a
+        playlist for a whole group of friends.
+
+        Runs recorded with --record are replayed with --offline using the
+        same seed, so they generate the same playlist, unless they were
+        stopped by --time-budget.
 
-        The playlist will be saved on your account.
+        The playlist will be saved on your account. If diversify already
+        created a playlist with the same name, its songs are replaced,
+        unless --new is given. Your own playlists are never changed.
 
         The app will redirect you to a page in your browser,
         where you will be asked to login into your spotify account.
@@ -95,35 +271,44 @@ def playlist(friend, playlist_name):
     """
     plistname = ' '.join(playlist_name)
 
+    spfy = open_session(record, replay, latency)
+    seed = random_seed(spfy, seed)
+
     try:
-        spfy = SpotifySession(authenticate=False)
+        current_user = spfy._current_user
+        my_songs = get_songs(spfy, current_user)
+
+        friends_songs = [get_songs(spfy, userid) for userid in friend]
+        if friend:
+            click.secho(f"\tGenerating playlist for you and {', '.join(friend)}", fg='green')
+        else:
+            click.secho("\tGenerating playlist for you", fg='green')
+
+        config = gen.GeneticConfig(user_share=user_share, pool_size=pool_size, mutation=mutation,
+                                   islands=islands, migration_interval=migration_interval)
+        if engine == 'greedy':
+            result = gen.greedy_start(spfy, my_songs, *friends_songs, config=config, seed=seed)
+        else:
+            stopping = gen.StoppingPolicy(patience, min_delta, time_budget)
+            result = gen.start(spfy, my_songs, *friends_songs, config=config, stopping=stopping,
+                               seed=seed)
+
+        trackids = result.index.tolist()
+        saved = spfy.tracks_to_playlist(trackids=trackids, name=plistname, update=update)
     except utils.DiversifyError as e:
         click.secho(str(e), fg='red')
         sys.exit(1)
 
-    current_user = spfy._current_user
-    my_songs = get_songs(spfy, current_user)
-
-    friend_songs = None
-    if friend:
-        friend_songs = get_songs(spfy, friend)
-        click.secho(f"\tGenerating playlist for you and {friend}", fg='green')
+    if saved.created:
+        click.secho("\tPlaylist created sucessfully", fg='green')
     else:
-        click.secho("\tGenerating playlist for you", fg='green')
-
-    if friend_songs is not None:
-        result = gen.start(spfy, my_songs, user2=friend_songs)
-    else:
-        result = gen.start(spfy, my_songs)
-
-    trackids = result.index.tolist()
-    spfy.tracks_to_playlist(trackids=trackids, name=plistname)
-    click.secho("\tPlaylist created sucessfully", fg='green')
+        click.secho("\tPlaylist updated sucessfully", fg='green')
 
 
 @diversify.command(short_help="downloads csv file with your saved songs")
+@cassette_options
 @click.argument('filename', type=click.Path())
-def download(filename):
+def download(record, replay, latency, filename):
     """
         This is a small sample code to test if your installation is sucessful.
 
@@ -135,15 +320,10 @@ def download(filename):
         sys.exit(0)
 
     click.echo(f"This is a sample program that will search for your saved songs and write them to {filename}")
-    try:
-        spfy = SpotifySession(authenticate=False)
-    except utils.DiversifyError as e:
-        click.secho(str(e), fg='red')
-        sys.exit(1)
+    spfy = open_session(record, replay, latency)
 
-    fsongs = spfy.get_favorite_songs(features=True)
-    show_songs_info(fsongs.songs)
-    spfy.playlist_to_csv(fsongs.features, filename=filename)
+    songs = shown(spfy.iter_favorite_songs())
+    spfy.features_to_csv(spfy.iter_features(songs), filename)
 
 
 if __name__ == '__main__':
@@ -18,22 +18,30 @@
 """
 import argparse
 import csv
+import math
 import os
 import json
 import asyncio
+import bisect
+import itertools
+import collections
+import aiohttp
 import spotipy
 import spotipy.util as util
 import numpy as np
 
 import diversify.utils as utils
-from diversify.asyncutils import gather_pages
+from diversify.cache import TrackCache
+from diversify.cassette import Cassette
+from diversify.asyncutils import gather_pages, gather_recommendations, gather_features, \
+    gather_playlists, stream_pages, recommendations_url, get, post, pooled_session, \
+    AsyncClient, PoolLimits, API_URL
 from diversify.types import SongMetadata, AudioFeatures, SongWithFeatures, \
         JsonObject, Playlist
 
-from typing import List, Callable, Any, Tuple, \
-    Dict, Union, Optional, Iterator
+from typing import List, Callable, Any, Tuple, NamedTuple, \
+    Dict, Union, Optional, Iterator, Iterable, AsyncIterator
 
-from diversify.constants import SCOPE
 
 
 _fields = ['id', 'speechiness', 'valence', 'mode', 'liveness', 'key',
@@ -42,15 +50,32 @@ _fields = ['id', 'speechiness', 'valence', 'mode', 'liveness', 'key',
 
 _limit = 50
 
+# Audio features kept by an AsyncSpotifySession to answer repeated requests
+_max_features = 50000
+
+# Written in the description of the playlists created by diversify, so
+# only those are updated instead of any playlist of the user with the same name
+PLAYLIST_MARKER = 'Created by diversify'
+_local_prefix = 'spotify:local:'
+
+
+def _get_session(
+        authenticate: bool = True,
+        cassette: Optional[Cassette] = None
+) -> spotipy.Spotify:
+    if cassette is not None:
+        if cassette.recording:
+            return cassette.spotify(_get_session(authenticate))
+        # Replaying needs no login, since nothing is requested
+        return cassette.spotify()
 
-def _get_session(authenticate: bool = True) -> spotipy.Spotify:
     if authenticate:
-        token = utils.login_user()
-    else:
-        token = utils.cached_token(scope=SCOPE)
+        utils.login_user()
+    # The token is shared by the spotipy and aiohttp requests
+    manager = utils.token_manager()
 
-    if token:
-        return spotipy.Spotify(auth=token)
+    if manager:
+        return spotipy.Spotify(auth_manager=manager)
     else:
         if authenticate:
             raise utils.DiversifyError(f"Unable to log in to your account")
@@ -60,24 +85,113 @@ def _get_session(authenticate: bool = True) -> spotipy.Spotify:
             )
 
 
-class SpotifySession:
-    def __init__(self, authenticate: bool = True):
-        """
-        Logs the user to the Spotify WEB API with permissions declared in
-        scope. Default permissions are 'user-library-read' and
-        'playlist-modify-private'.
+def _user_profile(spotify: spotipy.Spotify) -> JsonObject:
+    """
+    The profile of the logged user, which is requested only once
+    and then kept with the cached token.
+    """
+    manager = spotify.auth_manager
+    if isinstance(manager, utils.TokenManager):
+        if manager.profile is None:
+            manager.save_profile(spotify.current_user())
+        return manager.profile
+    return spotify.current_user()
 
-        If the authenticate is false, it'll get information from cache. In
-        other words, it assumes it's already logged.
+
+class AsyncSpotifySession:
+    """
+    Asynchronous version of SpotifySession, whose requests are all made
+    with aiohttp, so it can be used from a running event loop, e.g. to
+    serve the requests of many users concurrently in the same process.
+
+    Use AsyncSpotifySession.create to log in, or pass an already
+    authenticated spotipy session, which is only used for its OAuth headers.
+
+    :param spotify: authenticated spotipy session
+    :param userid: Spotify ID of the logged user
+    :param cache: TrackCache where tracks and audio features are kept
+        between runs. If None, everything is requested from the API.
+    :param pool_limits: limits of the connection pool, if session is None
+    :param session: aiohttp session used for all requests. If None, one is
+        opened on first use and closed by close().
+    :param cassette: Cassette where the responses of the opened session are
+        recorded or replayed from
+    """
+    def __init__(
+            self,
+            spotify: spotipy.Spotify,
+            userid: str,
+            cache: Optional[TrackCache] = None,
+            pool_limits: Optional[PoolLimits] = None,
+            session: Optional[aiohttp.ClientSession] = None,
+            cassette: Optional[Cassette] = None
+    ):
+        self._session = spotify
+        self._current_user = userid
+        self._cache = cache
+        self._pool_limits = pool_limits or PoolLimits()
+        self._http = session
+        self._owns_http = session is None
+        self._cassette = cassette
+        # Audio features requested in the session, by track id,
+        # from the least to the most recently used
+        self._features = collections.OrderedDict()
+        self._requests = set()
+
+    @classmethod
+    async def create(
+            cls,
+            authenticate: bool = True,
+            cache: Optional[TrackCache] = None,
+            pool_limits: Optional[PoolLimits] = None,
+            cassette: Optional[Cassette] = None
+    ) -> 'AsyncSpotifySession':
+        """
+        Logs the user to the Spotify WEB API as in SpotifySession.
 
         :param authenticate: If true, use web browser authentication,
             else cached info.
         """
+        spfy = cls(_get_session(authenticate, cassette), None, cache, pool_limits,
+                   cassette=cassette)
 
-        self._session = _get_session(authenticate)
-        self._current_user = self._session.current_user()['id']
+        manager = spfy._session.auth_manager
+        profile = manager.profile if isinstance(manager, utils.TokenManager) else None
+        if profile is None:
+            profile = await spfy._get(f'{API_URL}/me')
+            if isinstance(manager, utils.TokenManager):
+                manager.save_profile(profile)
+        spfy._current_user = profile['id']
+        return spfy
 
-    def _for_all(
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self) -> None:
+        """
+        Closes the connections kept open by the session, if it opened them.
+        """
+        if self._owns_http and self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    def _client_session(self) -> aiohttp.ClientSession:
+        if self._http is None:
+            self._http = pooled_session(self._pool_limits)
+            if self._cassette is not None:
+                self._http = self._cassette.wrap(self._http)
+        return self._http
+
+    async def _get(self, url: str) -> JsonObject:
+        return await get(self._session, self._client_session(), url)
+
+    async def _post(self, url: str, payload: JsonObject, method: str = 'POST') -> JsonObject:
+        return await post(self._session, self._client_session(), url, payload, method)
+
+    async def _for_all(
             self,
             json_response: JsonObject,
             func: Callable[[JsonObject], List[Any]]
@@ -89,7 +203,7 @@ class SpotifySession:
         :param func: Function that parses a pagination object into a list of objects
         :return: All the data gathered from all the pages
         """
-        jsons = asyncio.run(gather_pages(self._session, json_response))
+        jsons = await gather_pages(self._session, json_response, session=self._client_session())
 
         result = []
         for json in jsons:
@@ -97,26 +211,6 @@ class SpotifySession:
 
         return result
 
-    @staticmethod
-    def _write_csv(featarray: List[AudioFeatures], filename: str) -> None:
-        """
-        Write the filtered features in the file described by the
-        path in filename.
-
-        :param featarray: List with filtered features
-        :param filename: path where the features will be written
-        :return: None
-        """
-
-        with open(filename, 'w') as csvfile:
-            csvwriter = csv.DictWriter(csvfile, fieldnames=_fields)
-            csvwriter.writeheader()
-
-            for features in featarray:
-                csvwriter.writerow(features)
-
-            csvfile.close()
-
     @staticmethod
     def _get_song_info(json_response: JsonObject) -> List[SongMetadata]:
         fields = ['name', 'id', 'popularity', 'duration_ms']
@@ -146,10 +240,11 @@ class SpotifySession:
             ftrack = {field: track[field] for field in _fields}
             yield ftrack
 
-    def get_features(
+    async def get_features(
             self,
             tracks: List[SongMetadata],
-            limit: int = 10
+            limit: int = 100,
+            concurrency: int = 10
     ) -> List[AudioFeatures]:
         """
         Queries the spotify WEB API for the features of a list of songs
@@ -159,47 +254,150 @@ class SpotifySession:
         The returned object is filtered with the fields described in the
         _fields object of the module.
 
-        Quantity of requests per call = ceil( n° of saved songs / 100 )
+        Quantity of requests per call = ceil( n° of saved songs / limit ),
+        with up to concurrency requests made at the same time.
+
+        If the session has a TrackCache, only the songs that are not cached
+        or whose cache entry expired are requested.
+
+        The features of each song are requested at most once per session:
+        the songs already requested, or being requested by a concurrent call,
+        wait for that request instead of making a new one.
 
-        :param limit:
+        :param limit: number of songs per request, at most 100
+        :param concurrency: maximum number of requests in flight
         :param tracks: list with songs (dicts with id and name keys)
-        :return: A list with dicts representing audio features
+        :return: A list with dicts representing audio features, in the same
+            order as tracks. Songs without features in Spotify are left out.
         """
+        if limit > 100:
+            raise HighLimitException(f"The API accepts at most 100 songs per request, not {limit}")
 
-        local_limit = limit
         trackids = [track['id'] for track in tracks]
-        all_feat = []
+        loop = asyncio.get_running_loop()
+
+        futures, pending = {}, {}
+        for trackid in dict.fromkeys(trackids):
+            future = self._features.get(trackid)
+            # Requests that were cancelled or failed are made again
+            if future is None or future.cancelled() or \
+                    (future.done() and future.exception() is not None):
+                future = pending[trackid] = loop.create_future()
+                self._features[trackid] = future
+            self._features.move_to_end(trackid)
+            futures[trackid] = future
+
+        if pending:
+            # The request is shared with other callers, so it runs on its own
+            # and isn't cancelled with this call
+            request = asyncio.ensure_future(self._request_features(pending, limit, concurrency))
+            self._requests.add(request)
+            request.add_done_callback(self._requests.discard)
+
+        # For the same reason, cancelling this call must not cancel the futures
+        results = await asyncio.shield(asyncio.gather(*futures.values()))
+        self._forget_features()
+
+        by_id = dict(zip(futures, results))
+        return [by_id[trackid] for trackid in trackids if by_id[trackid] is not None]
+
+    def _forget_features(self) -> None:
+        """
+        Keeps at most _max_features resolved songs in the session, forgetting
+        the least recently used ones.
+        """
+        while len(self._features) > _max_features:
+            trackid, future = next(iter(self._features.items()))
+            if not future.done():
+                break
+            del self._features[trackid]
 
-        while trackids:
-            query, trackids = trackids[:local_limit], trackids[local_limit:]
-            feat = self._session.audio_features(query)
-            ffeat = list(self._filter_audio_features(feat))
-            all_feat.extend(ffeat)
+    async def _request_features(
+            self,
+            pending: Dict[str, asyncio.Future],
+            limit: int,
+            concurrency: int
+    ) -> None:
+        """
+        Requests the features of the songs in pending from the cache or
+        the API and sets them as the results of their futures, with None for
+        the songs without features. If it fails, the futures get the error
+        and are forgotten, so the songs can be requested again.
+        """
+        try:
+            trackids = list(pending)
+            cached = self._cache.get_features(trackids) if self._cache else {}
+            missing = [trackid for trackid in trackids if trackid not in cached]
+
+            all_feat = []
+            if missing:
+                feat = await gather_features(self._session, missing, limit, concurrency,
+                                             session=self._client_session())
+                all_feat = list(self._filter_audio_features(f for f in feat if f is not None))
+
+            if self._cache:
+                self._cache.put_features(all_feat)
+        except BaseException as error:
+            for trackid, future in pending.items():
+                if self._features.get(trackid) is future:
+                    del self._features[trackid]
+                if future.done():
+                    continue
+                if isinstance(error, Exception):
+                    future.set_exception(error)
+                    # The caller gets the error, the other waiters may not exist
+                    future.exception()
+                else:
+                    future.cancel()
+            return
 
-        return all_feat
+        by_id = {**cached, **{feat['id']: feat for feat in all_feat}}
+        for trackid, future in pending.items():
+            if not future.done():
+                future.set_result(by_id.get(trackid))
 
-    def get_favorite_songs(
+    async def get_favorite_songs(
         self,
         features: bool = False
     ) -> Union[List[SongMetadata], SongWithFeatures]:
         local_limit = 50
 
-        results = self._session.current_user_saved_tracks(local_limit)
+        results = await self._get(f'{API_URL}/me/tracks?limit={local_limit}')
 
-        songs = self._for_all(results, self._get_song_info)
+        songs = await self._for_all(results, self._get_song_info)
 
         if features:
-            song_features = self.get_features(songs)
+            song_features = await self.get_features(songs)
             return SongWithFeatures(songs, song_features)
         else:
             return songs
 
-    def get_user_playlists(
+    async def iter_favorite_songs(self, concurrency: int = 10) -> AsyncIterator[SongMetadata]:
+        """
+        Generator version of get_favorite_songs. The pages of saved songs
+        are requested concurrently, but only a few pages ahead of the songs
+        being yielded, so memory stays bounded for large libraries.
+
+        :param concurrency: maximum number of requests in flight
+        :return: the user's saved songs (Async generator)
+        """
+        local_limit = 50
+
+        results = await self._get(f'{API_URL}/me/tracks?limit={local_limit}')
+
+        pages = stream_pages(self._session, results, concurrency, session=self._client_session())
+        async for page in pages:
+            for song in self._get_song_info(page):
+                yield song
+
+    async def get_user_playlists(
             self,
             userid: Optional[str] = None,
             limit: int = 10,
             features: bool = False,
-            flat: bool = False
+            flat: bool = False,
+            concurrency: int = 10,
+            unique: bool = False
     ):
         """
             Queries the spotify WEB API for the musics in the public playlists
@@ -214,11 +412,20 @@ class SpotifySession:
             tuple of (name, list of songs (each being a dict with song info)).
 
             If flat is True, all playlists are going to be merged into one big list.
+            If unique is also True, songs in more than one playlist are kept only
+            where they first appear.
+
+            The tracks of all playlists are requested concurrently, with up to
+            concurrency requests in flight between all of them. If the session
+            has a TrackCache, only the playlists whose snapshot id changed
+            since they were cached are requested.
 
             :param userid:  The Spotify ID of the playlits' owner
             :param limit: limit for the pagination API
             :param features: If true, gets features instead of song data. default: False
             :param flat: flattens the result
+            :param concurrency: maximum number of requests in flight
+            :param unique: removes repeated songs from the flattened result
             :return: A list of tuples representing playlists for each public playlist of userid.
             """
 
@@ -228,26 +435,30 @@ class SpotifySession:
             userid = self._current_user
 
         # Returns a Spotify object (paging object) with playlists
-        playlist_query = self._session.user_playlists(userid, local_limit)
-
-        def _get_all_playlists(playlist_paging):
-            result = []
-            for playlist in playlist_paging['items']:
-                if playlist['owner']['id'] == userid:
-                    # return a playlist object
-                    response = self._session.user_playlist(
-                        userid, playlist['id'], fields="tracks,next")
-                    trackspo = response[
-                        'tracks']  # Array with information about the tracks in the playlist
-                    tracks = self._for_all(trackspo, self._get_song_info)
-                    result.append((playlist['name'], tracks,))
-            return result
+        playlist_query = await self._get(f'{API_URL}/users/{userid}/playlists?limit={local_limit}')
+        owned = [playlist for playlist in await self._for_all(playlist_query, lambda page: page['items'])
+                 if playlist['owner']['id'] == userid]
+
+        synced = self._synced_playlists(owned)
+        changed = [playlist for playlist in owned if playlist['id'] not in synced]
+        all_pages = await gather_playlists(self._session, changed, concurrency,
+                                           session=self._client_session())
+
+        for playlist, pages in zip(changed, all_pages):
+            tracks = [song for page in pages for song in self._get_song_info(page)]
+            synced[playlist['id']] = tracks
+            if self._cache and playlist.get('snapshot_id'):
+                self._cache.put_playlist(playlist['id'], playlist['snapshot_id'], tracks)
 
-        playlists = self._for_all(playlist_query, _get_all_playlists)
+        playlists = [(playlist['name'], synced[playlist['id']]) for playlist in owned]
 
         result = playlists
         if features:
-            result = [(name, self.get_features(playlist)) for name, playlist in playlists]
+            # The features of songs in many playlists are requested only once
+            all_songs = [song for _, playlist in playlists for song in playlist]
+            by_id = {feat['id']: feat for feat in await self.get_features(all_songs)}
+            result = [(name, [by_id[song['id']] for song in playlist if song['id'] in by_id])
+                      for name, playlist in playlists]
 
         if not flat:
             return result
@@ -255,25 +466,512 @@ class SpotifySession:
         flattened = []
         for name, playlist in result:
             flattened.extend(playlist)
+        if unique:
+            first = {}
+            for song in flattened:
+                first.setdefault(song['id'], song)
+            flattened = list(first.values())
         return flattened
 
-    def get_new_songs(self,
-                      seed_tracks: List[SongMetadata],
-                      country: Optional[str] = None,
-                      features: bool = False):
+    def _synced_playlists(self, playlists: List[JsonObject]) -> Dict[str, List[SongMetadata]]:
+        """
+        Finds the cached tracks of the playlists that didn't change since
+        they were cached.
+
+        :param playlists: list with simplified playlist objects
+        :return: dict from playlist id to its list of tracks
+        """
+        if not self._cache:
+            return {}
+
+        cached = self._cache.get_playlists(playlist['id'] for playlist in playlists)
+        return {
+            playlist['id']: cached[playlist['id']][1] for playlist in playlists
+            if playlist['id'] in cached and cached[playlist['id']][0] == playlist.get('snapshot_id')
+        }
+
+    async def get_new_songs(self,
+                            seed_tracks: List[SongMetadata],
+                            country: Optional[str] = None,
+                            features: bool = False):
         local_limit = 100
-        trackids = [track['id'] for track in seed_tracks]
-        fids = np.random.choice(trackids, 5)
-        result = self._session.recommendations(
-            seed_tracks=fids.tolist(), limit=local_limit, country=country)
+        trackids = list({track['id']: None for track in seed_tracks})
+        fids = np.random.choice(trackids, min(5, len(trackids)), replace=False)
+        result = await self._get(recommendations_url(fids.tolist(), country, local_limit))
         songs = [{field: track[field] for field in ['id', 'name', 'duration_ms', 'popularity']} for
                  track in result['tracks']]
 
         if features:
-            return self.get_features(songs)
+            return await self.get_features(songs)
         else:
             return songs
 
+    @staticmethod
+    def _seed_groups(
+            users_tracks: List[List[SongMetadata]],
+            size: int = 5
+    ) -> Iterator[List[str]]:
+        """
+        Generates groups of distinct seed track ids, taking the songs of
+        each user in turns. After all songs were used, they're shuffled
+        again into new groups.
+
+        :param users_tracks: list with the songs of each user
+        :param size: number of seeds in a group, the API accepts at most 5
+        """
+        users_ids = [list({track['id']: None for track in tracks}) for tracks in users_tracks]
+        users_ids = [ids for ids in users_ids if ids]
+        if not users_ids:
+            return
+
+        while True:
+            shuffled = [list(np.random.permutation(ids)) for ids in users_ids]
+            turns = []
+            for i in range(max(len(ids) for ids in shuffled)):
+                turns.extend(ids[i] for ids in shuffled if i < len(ids))
+
+            for start in range(0, len(turns), size):
+                group = list(dict.fromkeys(turns[start:start + size]))
+                yield group
+
+    async def get_candidate_pool(
+            self,
+            users_tracks: List[List[SongMetadata]],
+            target_size: int = 2000,
+            country: Optional[str] = None,
+            concurrency: int = 10
+    ) -> SongWithFeatures:
+        """
+        Builds a large pool of recommended songs for a group of users,
+        making many recommendation requests concurrently with different
+        groups of seeds taken from the songs of every user. The songs are
+        deduplicated and their audio features are requested as soon as each
+        recommendation arrives.
+
+        :param users_tracks: list with the songs of each user
+        :param target_size: number of distinct songs wanted in the pool
+        :param country: ISO 3166-1 alpha-2 country code for the recommendations
+        :param concurrency: maximum number of requests in flight
+        :return: The songs in the pool and their audio features, in the same order
+        """
+        # Each request returns at most 100 songs, some of them repeated
+        max_requests = 3 * math.ceil(target_size / 100)
+        groups = self._seed_groups(users_tracks)
+
+        tracks, features = await gather_recommendations(
+            self._session, groups, target_size, max_requests, country, concurrency,
+            session=self._client_session())
+
+        songs = [{field: track[field] for field in ['id', 'name', 'duration_ms', 'popularity']}
+                 for track in tracks]
+        features = list(self._filter_audio_features(features))
+        if self._cache:
+            self._cache.put_features(features)
+        return SongWithFeatures(songs, features)
+
+    async def _find_playlist(self, name: str) -> Optional[JsonObject]:
+        """
+        :return: the first playlist created by diversify for the user with
+            that name, if there's any
+        """
+        query = await self._get(f'{API_URL}/me/playlists?limit=50')
+        playlists = await self._for_all(query, lambda page: page['items'])
+        for playlist in playlists:
+            if playlist['owner']['id'] == self._current_user and playlist['name'] == name \
+                    and PLAYLIST_MARKER in (playlist.get('description') or ''):
+                return playlist
+        return None
+
+    async def tracks_to_playlist(
+            self,
+            trackids: List[str],
+            name: Optional[str] = None,
+            update: bool = True
+    ) -> 'SavedPlaylist':
+        """
+        Writes the songs in trackids to a private playlist of the user.
+
+        If update is True and diversify already created a playlist with that
+        name, e.g. in a previous run, its songs are replaced in place: only
+        the songs that changed are removed, moved or added, so little is
+        sent when the new songs are close to the old ones. Playlists made
+        by the user are never changed, a new playlist is created instead.
+        Local files can't be removed or moved through the API, so they're
+        kept where they are.
+
+        Songs are removed concurrently, up to 100 per request, which is the
+        API maximum. Moves and additions depend on the positions left by the
+        previous ones, so they're sent in order.
+
+        :param trackids: list with the ids or uris of the songs, in order
+        :param name: name of the playlist
+        :param update: replaces the songs of an existing playlist with that name
+        :return: the id of the playlist and whether it was created
+        """
+        if name is None:
+            name = 'Diversify playlist'
+        uris = [_track_uri(trackid) for trackid in trackids]
+
+        playlist = await self._find_playlist(name) if update else None
+        created = playlist is None
+        current = []
+        if created:
+            userid = self._current_user
+            playlist = await self._post(f'{API_URL}/users/{userid}/playlists',
+                                        {'name': name, 'public': False,
+                                         'description': PLAYLIST_MARKER})
+        else:
+            [pages] = await gather_playlists(self._session, [playlist],
+                                             session=self._client_session())
+            current = [item['track']['uri'] for page in pages for item in page['items']
+                       if item.get('track')]
+
+        url = f"{API_URL}/playlists/{playlist['id']}/tracks"
+        diff = playlist_diff(current, uris)
+
+        await asyncio.gather(*[
+            self._post(url, {'tracks': [{'uri': uri} for uri in diff.removed[i:i + 100]]}, 'DELETE')
+            for i in range(0, len(diff.removed), 100)
+        ])
+        for range_start, insert_before in diff.moves:
+            await self._post(url, {'range_start': range_start, 'insert_before': insert_before},
+                             'PUT')
+        for position, added in diff.added:
+            for i in range(0, len(added), 100):
+                await self._post(url, {'uris': added[i:i + 100], 'position': position + i})
+
+        return SavedPlaylist(playlist['id'], created)
+
+
+def _track_uri(trackid: str) -> str:
+    if trackid.startswith('spotify:track:'):
+        return trackid
+    return f'spotify:track:{trackid}'
+
+
+class SavedPlaylist(NamedTuple):
+    """
+    :param id: id of the playlist the songs were written to
+    :param created: False if an existing playlist was updated
+    """
+    id: str
+    created: bool
+
+
+class PlaylistDiff(NamedTuple):
+    """
+    Changes that turn the songs of a playlist into other songs.
+
+    :param removed: uris removed from the playlist, with all their occurrences
+    :param moves: (range_start, insert_before) of the songs moved after the
+        removals, in order, as in the reorder endpoint of the API
+    :param added: (position, uris) of the songs inserted after the moves, in order
+    """
+    removed: List[str]
+    moves: List[Tuple[int, int]]
+    added: List[Tuple[int, List[str]]]
+
+
+def _increasing_subsequence(values: List[int]) -> List[int]:
+    """
+    :return: indexes of a longest increasing subsequence of values
+    """
+    # tails[k] is the index of the smallest value ending an increasing
+    # subsequence of length k + 1
+    tails, tail_values, previous = [], [], [-1] * len(values)
+    for i, value in enumerate(values):
+        position = bisect.bisect_left(tail_values, value)
+        if position > 0:
+            previous[i] = tails[position - 1]
+        if position == len(tails):
+            tails.append(i)
+            tail_values.append(value)
+        else:
+            tails[position] = i
+            tail_values[position] = value
+
+    result = []
+    i = tails[-1] if tails else -1
+    while i >= 0:
+        result.append(i)
+        i = previous[i]
+    return result[::-1]
+
+
+def playlist_diff(current: List[str], target: List[str]) -> PlaylistDiff:
+    """
+    Finds few changes that turn the current songs of a playlist into the
+    target songs. The songs in both lists are kept, and only the ones out
+    of a longest increasing subsequence of their target positions are
+    moved. Songs repeated in current are removed and added again, since
+    the API removes all occurrences of a song at once.
+
+    Local files in current are left untouched, in between the same songs
+    as before, and the positions of the changes account for them.
+
+    :param current: uris of the songs in the playlist
+    :param target: uris of the songs wanted in the playlist
+    """
+    songs = [uri for uri in current if not uri.startswith(_local_prefix)]
+    diff = _songs_diff(songs, target)
+    if len(songs) == len(current):
+        return diff
+
+    removed = set(diff.removed)
+    playlist = [(uri, uri.startswith(_local_prefix)) for uri in current
+                if uri.startswith(_local_prefix) or uri not in removed]
+
+    def position(index):
+        # Position in the playlist of the song at index, ignoring local files
+        positions = [i for i, (_, local) in enumerate(playlist) if not local]
+        return positions[index] if index < len(positions) else len(playlist)
+
+    moves = []
+    for start, before in diff.moves:
+        start, before = position(start), position(before)
+        moves.append((start, before))
+        playlist.insert(before, playlist[start])
+        del playlist[start if start < before else start + 1]
+
+    added = []
+    for index, uris in diff.added:
+        at = position(index)
+        added.append((at, uris))
+        playlist[at:at] = [(uri, False) for uri in uris]
+
+    return PlaylistDiff(diff.removed, moves, added)
+
+
+def _songs_diff(current: List[str], target: List[str]) -> PlaylistDiff:
+    counts = collections.Counter(current)
+    kept = {uri for uri in dict.fromkeys(target) if counts[uri] == 1}
+    removed = [uri for uri in dict.fromkeys(current) if uri not in kept]
+
+    remaining = [uri for uri in current if uri in kept]
+    order = [uri for uri in dict.fromkeys(target) if uri in kept]
+    rank = {uri: i for i, uri in enumerate(order)}
+    in_place = {remaining[i] for i in
+                _increasing_subsequence([rank[uri] for uri in remaining])}
+
+    moves = []
+    for i, uri in enumerate(order):
+        if uri in in_place:
+            continue
+        start = remaining.index(uri)
+        before = remaining.index(order[i - 1]) + 1 if i > 0 else 0
+        moves.append((start, before))
+        remaining.insert(before, uri)
+        del remaining[start if start < before else start + 1]
+        in_place.add(uri)
+
+    added, seen = [], set()
+    for position, uri in enumerate(target):
+        if uri in kept and uri not in seen:
+            seen.add(uri)
+        elif added and added[-1][0] + len(added[-1][1]) == position:
+            added[-1][1].append(uri)
+        else:
+            added.append((position, [uri]))
+
+    return PlaylistDiff(removed, moves, added)
+
+
+class SpotifySession:
+    """
+    Synchronous interface of AsyncSpotifySession, which runs its coroutines
+    in an event loop in a background thread.
+    """
+    _get_song_info = staticmethod(AsyncSpotifySession._get_song_info)
+    _filter_audio_features = staticmethod(AsyncSpotifySession._filter_audio_features)
+    _seed_groups = staticmethod(AsyncSpotifySession._seed_groups)
+
+    def __init__(
+            self,
+            authenticate: bool = True,
+            cache: Optional[TrackCache] = None,
+            pool_limits: Optional[PoolLimits] = None,
+            cassette: Optional[Cassette] = None
+    ):
+        """
+        Logs the user to the Spotify WEB API with permissions declared in
+        scope. Default permissions are 'user-library-read' and
+        'playlist-modify-private'.
+
+        If the authenticate is false, it'll get information from cache. In
+        other words, it assumes it's already logged. The profile of the user
+        is cached with the login, so no request is made to create the session.
+
+        :param authenticate: If true, use web browser authentication,
+            else cached info.
+        :param cache: TrackCache where tracks and audio features are kept
+            between runs. If None, everything is requested from the API.
+        :param pool_limits: limits of the connection pool shared by all
+            concurrent requests of the session
+        :param cassette: Cassette where the responses of the API are
+            recorded or replayed from
+        """
+
+        self._session = _get_session(authenticate, cassette)
+        self._current_user = _user_profile(self._session)['id']
+        self._cache = cache
+        self._pool_limits = pool_limits or PoolLimits()
+        self._cassette = cassette
+        self._client = None
+        self._async = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        """
+        Closes the connections kept open by the session.
+        """
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+            self._async = None
+
+    def _async_session(self) -> AsyncSpotifySession:
+        """
+        The AsyncSpotifySession wrapped by the session, which is created on
+        first use with a pooled aiohttp client kept for the lifetime of the
+        session.
+        """
+        if self._async is None:
+            self._client = AsyncClient(self._pool_limits)
+            session = self._client.session
+            if self._cassette is not None:
+                session = self._cassette.wrap(session)
+            self._async = AsyncSpotifySession(
+                self._session, self._current_user, self._cache, session=session)
+        return self._async
+
+    def _refresh_token(self) -> None:
+        """
+        Refreshes the token before running a method if it expires soon,
+        so the event loop isn't blocked by the refresh.
+        """
+        manager = self._session.auth_manager
+        if isinstance(manager, utils.TokenManager):
+            manager.get_access_token()
+
+    def _run(self, coroutine_function, *args, **kwargs):
+        """
+        Runs a method of the AsyncSpotifySession in the background event
+        loop and waits for its result.
+        """
+        spfy = self._async_session()
+        self._refresh_token()
+        return self._client.run(coroutine_function(spfy, *args, **kwargs))
+
+    def _iter(self, async_generator_function, *args, **kwargs) -> Iterator[Any]:
+        """
+        Iterates over an async generator method of the AsyncSpotifySession.
+        """
+        spfy = self._async_session()
+        self._refresh_token()
+        return self._client.iterate(async_generator_function(spfy, *args, **kwargs))
+
+    def _for_all(
+            self,
+            json_response: JsonObject,
+            func: Callable[[JsonObject], List[Any]]
+    ) -> List[Any]:
+        return self._run(AsyncSpotifySession._for_all, json_response, func)
+
+    @staticmethod
+    def _write_csv(featarray: Iterable[AudioFeatures], filename: str) -> None:
+        """
+        Write the filtered features in the file described by the
+        path in filename.
+
+        :param featarray: List with filtered features
+        :param filename: path where the features will be written
+        :return: None
+        """
+
+        with open(filename, 'w') as csvfile:
+            csvwriter = csv.DictWriter(csvfile, fieldnames=_fields)
+            csvwriter.writeheader()
+
+            for features in featarray:
+                csvwriter.writerow(features)
+
+            csvfile.close()
+
+    def get_features(
+            self,
+            tracks: List[SongMetadata],
+            limit: int = 100,
+            concurrency: int = 10
+    ) -> List[AudioFeatures]:
+        return self._run(AsyncSpotifySession.get_features, tracks, limit, concurrency)
+
+    def iter_features(
+            self,
+            tracks: Iterable[SongMetadata],
+            limit: int = 100,
+            concurrency: int = 10
+    ) -> Iterator[AudioFeatures]:
+        """
+        Generator version of get_features. The songs are consumed in chunks
+        of limit * concurrency, whose features are requested concurrently and
+        yielded before the next chunk is consumed, so it works with songs
+        that are also being generated and keeps memory bounded.
+
+        :param tracks: iterable with songs (dicts with id and name keys)
+        :param limit: number of songs per request, at most 100
+        :param concurrency: maximum number of requests in flight
+        :return: audio features in the same order as tracks (Generator)
+        """
+        tracks = iter(tracks)
+        chunk_size = limit * concurrency
+        while True:
+            chunk = list(itertools.islice(tracks, chunk_size))
+            if not chunk:
+                return
+            yield from self.get_features(chunk, limit, concurrency)
+
+    def get_favorite_songs(
+        self,
+        features: bool = False
+    ) -> Union[List[SongMetadata], SongWithFeatures]:
+        return self._run(AsyncSpotifySession.get_favorite_songs, features)
+
+    def iter_favorite_songs(self, concurrency: int = 10) -> Iterator[SongMetadata]:
+        return self._iter(AsyncSpotifySession.iter_favorite_songs, concurrency)
+
+    def get_user_playlists(
+            self,
+            userid: Optional[str] = None,
+            limit: int = 10,
+            features: bool = False,
+            flat: bool = False,
+            concurrency: int = 10,
+            unique: bool = False
+    ):
+        return self._run(AsyncSpotifySession.get_user_playlists,
+                         userid, limit, features, flat, concurrency, unique)
+
+    def get_new_songs(self,
+                      seed_tracks: List[SongMetadata],
+                      country: Optional[str] = None,
+                      features: bool = False):
+        return self._run(AsyncSpotifySession.get_new_songs, seed_tracks, country, features)
+
+    def get_candidate_pool(
+            self,
+            users_tracks: List[List[SongMetadata]],
+            target_size: int = 2000,
+            country: Optional[str] = None,
+            concurrency: int = 10
+    ) -> SongWithFeatures:
+        return self._run(AsyncSpotifySession.get_candidate_pool,
+                         users_tracks, target_size, country, concurrency)
+
     def show_tracks(self, tracks: JsonObject) -> None:
         """
 
@@ -331,6 +1029,17 @@ class SpotifySession:
         features = self.get_features(playlist)
         self._write_csv(features, filename or 'csvfiles/playlistfeatures.csv')
 
+    def features_to_csv(self, features: Iterable[AudioFeatures], filename: str) -> None:
+        """
+        Writes audio features, which may be generated while the file is
+        written, in the path described by filename.
+
+        :param features: iterable with audio features as returned by get_features
+        :param filename: path where the features will be written
+        :return: None
+        """
+        self._write_csv(features, filename)
+
     def get_genres(self, artists_ids) -> Iterator[str]:
         """
         The spofify API currently does not have genres available.
@@ -349,12 +1058,13 @@ class SpotifySession:
                 else:
                     yield 'Not available'
 
-    def tracks_to_playlist(self, trackids: List[SongMetadata], name: Optional[str] = None) -> None:
-        if name is None:
-            name = 'Diversify playlist'
-        userid = self._current_user
-        result = self._session.user_playlist_create(userid, name, public=False)
-        self._session.user_playlist_add_tracks(userid, result['id'], trackids)
+    def tracks_to_playlist(
+            self,
+            trackids: List[str],
+            name: Optional[str] = None,
+            update: bool = True
+    ) -> SavedPlaylist:
+        return self._run(AsyncSpotifySession.tracks_to_playlist, trackids, name, update)
 
 
 class HighLimitException(Exception):
@@ -396,4 +1106,4 @@ if __name__ == '__main__':
     pprint.pprint(dfsongs)
 
     path = 'csvfiles/' + fname + '.csv'
-    sp.playlist_to_csv(fsongs.features, filename=path)
+    sp.features_to_csv(fsongs.features, filename=path)
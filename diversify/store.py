@@ -0,0 +1,135 @@
+"""
+    Columnar store of the audio features of the users' songs, replacing the
+    csvfiles/<userid>features.csv files.
+
+    Each column is stored with its type, so loading a user's songs doesn't
+    parse text, and only the columns that are asked for are read. With
+    pyarrow installed the songs are stored as Parquet (or Feather) files,
+    otherwise as numpy .npz files, which are also read column by column.
+
+    The CSV files are migrated to the store the first time they are read,
+    and again whenever they're written after that, e.g. by [diversify download],
+    or all at once with [diversify migrate].
+"""
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+import diversify.utils as utils
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+FEATURES_FOLDER = Path('csvfiles')
+
+_extensions = {'parquet': '.parquet', 'feather': '.feather', 'npz': '.npz'}
+
+
+class FeatureStore:
+    """
+    Stores the songs of each user as a table with one file per user.
+
+    :param folder: folder with the files of the store and the old CSV files
+    :param fmt: parquet, feather or npz. If None, parquet is used when
+        pyarrow is installed and npz otherwise.
+    """
+    def __init__(self, folder: Path = FEATURES_FOLDER, fmt: Optional[str] = None):
+        if fmt is None:
+            fmt = 'parquet' if HAS_PYARROW else 'npz'
+        if fmt not in _extensions:
+            raise utils.DiversifyError(f"Unknown feature store format: {fmt}")
+        if fmt != 'npz' and not HAS_PYARROW:
+            raise utils.DiversifyError(f"The {fmt} format needs pyarrow, install it with pip")
+
+        self.folder = Path(folder)
+        self.fmt = fmt
+
+    def path(self, userid: str) -> Path:
+        return self.folder / f'{userid}features{_extensions[self.fmt]}'
+
+    def csv_path(self, userid: str) -> Path:
+        return self.folder / f'{userid}features.csv'
+
+    def write(self, userid: str, songs: pd.DataFrame) -> None:
+        """
+        Stores the songs of the user, replacing the previous ones.
+
+        :param songs: DataFrame with one song per row
+        """
+        self.folder.mkdir(parents=True, exist_ok=True)
+        songs = songs.reset_index(drop=True)
+        path = self.path(userid)
+
+        if self.fmt == 'parquet':
+            songs.to_parquet(path, index=False)
+        elif self.fmt == 'feather':
+            songs.to_feather(path)
+        else:
+            # Text columns are stored as fixed size unicode instead of
+            # python objects, so they can be loaded without pickle. Missing
+            # text is stored empty and read as missing, as in the CSV files
+            np.savez(path, **{
+                column: values.fillna('').to_numpy(dtype=str) if values.dtype == object
+                else values.to_numpy()
+                for column, values in songs.items()
+            })
+
+    def read(self, userid: str, columns: Optional[List[str]] = None) -> Optional[pd.DataFrame]:
+        """
+        Loads the songs of the user, migrating them from the CSV file if
+        they're not in the store yet or the CSV file is newer.
+
+        :param columns: the only columns that are loaded, all if None
+        :return: DataFrame with the songs, or None if the user has no songs stored
+        """
+        path = self.path(userid)
+        if self._outdated(userid) and not self.migrate(userid) and not path.exists():
+            return None
+
+        if self.fmt == 'parquet':
+            return pd.read_parquet(path, columns=columns)
+        elif self.fmt == 'feather':
+            return pd.read_feather(path, columns=columns)
+
+        with np.load(path) as data:
+            songs = pd.DataFrame({column: data[column] for column in columns or data.files})
+        text = [column for column, values in songs.items() if values.dtype == object]
+        songs[text] = songs[text].replace('', np.nan)
+        return songs
+
+    def _outdated(self, userid: str) -> bool:
+        try:
+            stored = self.path(userid).stat().st_mtime_ns
+        except FileNotFoundError:
+            return True
+        try:
+            return self.csv_path(userid).stat().st_mtime_ns > stored
+        except FileNotFoundError:
+            return False
+
+    def migrate(self, userid: str) -> bool:
+        """
+        Copies the songs of the user from the CSV file to the store.
+
+        :return: False if the user has no CSV file
+        """
+        try:
+            songs = pd.read_csv(self.csv_path(userid))
+        except FileNotFoundError:
+            return False
+        self.write(userid, songs)
+        return True
+
+    def migrate_all(self) -> List[str]:
+        """
+        Copies the songs of every user with a CSV file to the store.
+
+        :return: the ids of the migrated users
+        """
+        users = [path.name[:-len('features.csv')] for path in self.folder.glob('*features.csv')]
+        return [userid for userid in sorted(users) if self.migrate(userid)]
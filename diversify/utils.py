@@ -8,12 +8,16 @@
     and then run all other commands without specifying his username again.
 """
 import os
+import json
+import time
+import threading
 import webbrowser
 import configparser
 from configparser import ConfigParser
 from pathlib import Path
 
 from typing import Optional, NamedTuple, List
+import requests
 from spotipy import oauth2
 from diversify.constants import CACHE_FILE, SCOPE, DIVERSIFY_FOLDER
 
@@ -24,25 +28,109 @@ class SpotifyCredentials(NamedTuple):
     redirect_uri: Optional[str] = None
 
 
-def cached_token(scope: List[str] = None) -> Optional[str]:
-    credentials = load_config(DIVERSIFY_FOLDER / 'config.ini')
-
-    str_scope = ' '.join(scope)
-
-    if not credentials.client_id or not credentials.client_secret:
-        print_api_help()
-        raise DiversifyError('no credentials set')
+class TokenManager:
+    """
+    The access token of the logged user, read from the token cache file
+    and shared by the spotipy and aiohttp requests of a session, as the
+    auth_manager of its spotipy session. The token is refreshed when it's
+    about to expire, before a request fails with it.
+
+    The profile of the user is kept in the cache file with the token, so a
+    session can be created without any request to the API. The credentials
+    of the app are only read when the token must be refreshed.
+
+    :param token_info: token as saved in the cache file by spotipy
+    :param cache_path: path of the token cache file
+    :param margin: seconds before the expiration when the token is refreshed
+    """
+    def __init__(self, token_info: dict, cache_path: str = CACHE_FILE, margin: float = 60.0):
+        self._token_info = token_info
+        self.cache_path = cache_path
+        self.margin = margin
+        self._oauth = None
+        # The spotipy and aiohttp requests are made from different threads
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_cache(cls, cache_path: str = CACHE_FILE) -> Optional['TokenManager']:
+        """
+        :return: the manager for the cached token, or None if the user is not logged in
+        """
+        try:
+            with open(cache_path) as cache:
+                token_info = json.load(cache)
+        except (OSError, ValueError):
+            return None
+        if not token_info.get('access_token'):
+            return None
+        return cls(token_info, cache_path)
+
+    @property
+    def profile(self) -> Optional[dict]:
+        return self._token_info.get('profile')
+
+    def save_profile(self, profile: dict) -> None:
+        with self._lock:
+            self._token_info['profile'] = profile
+            self._save()
+
+    def expires_soon(self) -> bool:
+        return self._token_info.get('expires_at', 0) - time.time() < self.margin
+
+    def get_access_token(self, as_dict: bool = False):
+        """
+        Returns the access token, refreshing it first if it expires soon.
+        Same interface as the auth managers of spotipy.
+        """
+        with self._lock:
+            if self.expires_soon() and self._token_info.get('refresh_token'):
+                self._refresh()
+            token_info = self._token_info
+        return token_info if as_dict else token_info['access_token']
+
+    def usable(self) -> bool:
+        """
+        Checks that the token can still be used, refreshing it if it expires soon.
+
+        :return: False if the token expired and couldn't be refreshed
+        """
+        try:
+            self.get_access_token()
+        except (oauth2.SpotifyOauthError, requests.RequestException, DiversifyError):
+            return False
+        return self._token_info.get('expires_at', 0) > time.time()
+
+    def _refresh(self) -> None:
+        if self._oauth is None:
+            credentials = load_config(DIVERSIFY_FOLDER / 'config.ini')
+            self._oauth = oauth2.SpotifyOAuth(
+                *credentials, scope=' '.join(SCOPE), cache_path=self.cache_path)
+
+        profile = self.profile
+        token_info = self._oauth.refresh_access_token(self._token_info['refresh_token'])
+        if profile is not None:
+            token_info['profile'] = profile
+        self._token_info = token_info
+        self._save()
+
+    def _save(self) -> None:
+        with open(self.cache_path, 'w') as cache:
+            json.dump(self._token_info, cache)
+
+
+def token_manager() -> Optional[TokenManager]:
+    """
+    :return: the TokenManager for the logged user, or None if the user is not logged in
+    """
+    return TokenManager.from_cache(CACHE_FILE)
 
-    sp_oauth = oauth2.SpotifyOAuth(
-        *credentials,
-        scope=str_scope,
-        cache_path=CACHE_FILE
-    )
 
-    token_info = sp_oauth.get_cached_token()
+def cached_token(scope: List[str] = None) -> Optional[str]:
+    manager = token_manager()
 
-    if token_info:
-        return token_info['access_token']
+    # An expired token that can't be refreshed needs a new login
+    if manager and manager.usable():
+        return manager.get_access_token()
     else:
         return None
 
@@ -134,6 +222,27 @@ def load_config(path: Path) -> SpotifyCredentials:
     return SpotifyCredentials(client_id, client_secret, redirect_uri)
 
 
+def parse_duration(value: str) -> float:
+    """
+    Converts a duration like 1.5s, 200ms, 2m or 7d into seconds.
+    A number without unit is read as seconds.
+    """
+    units = {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0, 'd': 86400.0}
+    text = value.strip().lower()
+    number, unit = text.rstrip('smhd'), text[len(text.rstrip('smhd')):] or 's'
+
+    if unit not in units:
+        raise DiversifyError(f"Invalid duration unit in {value}")
+    try:
+        seconds = float(number) * units[unit]
+    except ValueError:
+        raise DiversifyError(f"Invalid duration: {value}")
+
+    if seconds <= 0:
+        raise DiversifyError(f"Duration must be positive: {value}")
+    return seconds
+
+
 def print_api_help():
     print('''
         You need to set your Spotify API credentials. You can do this by
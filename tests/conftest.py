@@ -1,4 +1,11 @@
+from unittest.mock import Mock
 import pytest
+import spotipy as spt
+from faker import Faker
+from diversify.session import SpotifySession
+
+fake = Faker()
+Faker.seed(0)
 
 
 @pytest.fixture()
@@ -11,3 +18,78 @@ def spotify_env(monkeypatch):
     monkeypatch.setenv('SPOTIPY_REDIRECT_URI', redirect_uri)
     return client_id, client_secret, redirect_uri
 
+
+@pytest.fixture()
+def spotify_session(mocker):
+    """
+     Creates a spotify session object with mocked dependencies
+    """
+    mocker.patch('diversify.session.spotipy.Spotify.current_user')
+    mocked_get_session = mocker.patch('diversify.session._get_session')
+    mock_token = Mock()
+    mocked_get_session.return_value = spt.Spotify(auth=mock_token)
+    with SpotifySession() as session:
+        yield session
+
+
+def audio_features(song_id=None):
+    if song_id is None:
+        song_id = fake.pyint()
+
+    features = {}
+    features['id'] = song_id
+    features['speechiness'] = fake.pyfloat(min_value=0.0, max_value=1.0)
+    features['valence'] = fake.pyfloat(min_value=0.0, max_value=1.0)
+    features['mode'] = int(fake.pybool())
+    features['liveness'] = fake.pyfloat(min_value=0.0, max_value=1.0)
+    features['key'] = fake.pyint(min_value=0.0, max_value=1.0)
+    features['danceability'] = fake.pyfloat(min_value=0.0, max_value=1.0)
+    features['instrumentalness'] = fake.pyfloat(min_value=0.0, max_value=1.0)
+    features['energy'] = fake.pyfloat(min_value=0.0, max_value=1.0)
+    features['tempo'] = fake.pyfloat(min_value=50.0, max_value=150.0)
+    features['loudness'] = fake.pyfloat(min_value=-60.0, max_value=1.0)
+    features['acousticness'] = fake.pyfloat(min_value=0.0, max_value=1.0)
+    return features
+
+
+def song_metadata():
+    song_meta = {}
+    song_meta['id'] = fake.pyint()
+    song_meta['name'] = " ".join(fake.words())
+    song_meta['popularity'] = fake.pyint(min_value=0, max_value=100)
+    song_meta['duration_ms'] = fake.pyint()
+    song_meta['album'] = " ".join(fake.words(nb=2))
+    song_meta['artist'] = fake.name()
+    song_meta['artist_id'] = fake.pyint()
+    return song_meta
+
+
+def paginated_object(values):
+    for value in values[:-1]:
+        result = {
+            'value': value,
+            'next': 'stub'
+        }
+        yield result
+    # The last page has a null field
+    yield {'value': values[-1],
+           'next': None}
+
+
+def features_api(unknown=()):
+    """
+    Fake of the audio features endpoint for asyncutils.get, which
+    returns null for the ids in unknown
+    """
+    async def fake_get(spfy, session, url):
+        ids = url.split('ids=')[1].split(',')
+        return {'audio_features': [
+            None if song_id in unknown else audio_features(song_id) for song_id in ids
+        ]}
+    return fake_get
+
+
+def playlist_page(songs):
+    return {'items': [{'track': {**song, 'album': {'name': song['album'], 'id': None},
+                                 'artists': [{'name': song['artist'], 'id': song['artist_id']}]}}
+                      for song in songs]}
@@ -0,0 +1,257 @@
+import asyncio
+import threading
+import pytest
+from diversify.asyncutils import (
+    AsyncClient, PoolLimits, offset_urls, RequestScheduler, AdaptiveLimiter, APIError,
+    gather_playlists, stream_pages, _auth_headers,
+)
+from diversify.utils import TokenManager
+
+
+def test_offset_urls_skip_first_page():
+    # WHEN: the urls for a paging object with 120 items are generated
+    urls = list(offset_urls('https://api.spotify.com/v1/me/tracks?limit=50', 120, 50))
+
+    # THEN: all pages except the first are requested
+    assert urls == [
+        'https://api.spotify.com/v1/me/tracks?offset=50&limit=50',
+        'https://api.spotify.com/v1/me/tracks?offset=100&limit=50',
+    ]
+
+
+def test_async_client_reuses_session():
+    # GIVEN: a client with custom pool limits
+    client = AsyncClient(PoolLimits(limit=3))
+
+    async def current_session():
+        await asyncio.sleep(0)
+        return client.session
+
+    # WHEN: coroutines are run more than once
+    first = client.run(current_session())
+    second = client.run(current_session())
+
+    # THEN: the same aiohttp session and pool are used by all of them
+    assert first is second
+    assert first.connector.limit == 3
+    # until the client is closed
+    client.close()
+    assert client.closed and first.closed
+
+
+class FakeResponse:
+    def __init__(self, status, body=None, headers=None):
+        self.status = status
+        self.headers = headers or {}
+        self._body = body
+
+    async def json(self):
+        return self._body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.urls = []
+
+    def request(self, method, url, headers=None, json=None):
+        self.urls.append(url)
+        return self.responses.pop(0)
+
+
+@pytest.fixture()
+def slept(monkeypatch):
+    """
+     Skips the waits of the scheduler, recording how long each would be
+    """
+    delays = []
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr('diversify.asyncutils.asyncio.sleep', fake_sleep)
+    return delays
+
+
+def test_scheduler_honours_retry_after(slept):
+    # GIVEN: an API that throttles the first request
+    session = FakeSession(FakeResponse(429, headers={'Retry-After': '2'}),
+                          FakeResponse(200, {'items': []}))
+    scheduler = RequestScheduler()
+
+    # WHEN: a request is made
+    response = asyncio.run(scheduler.request(session, 'url', {}))
+
+    # THEN: it's retried after the time asked by the API
+    assert response == {'items': []}
+    assert session.urls == ['url', 'url']
+    assert 2.0 in slept
+    assert scheduler.concurrency.limit < 4
+
+
+def test_scheduler_retries_server_errors_with_backoff(slept):
+    # GIVEN: an API failing twice before answering
+    session = FakeSession(FakeResponse(503), FakeResponse(500), FakeResponse(200, {'ok': True}))
+    scheduler = RequestScheduler(backoff=0.01)
+
+    # WHEN: a request is made
+    response = asyncio.run(scheduler.request(session, 'url', {}))
+
+    # THEN: it succeeds after two retries, each after a backoff
+    assert response == {'ok': True}
+    assert scheduler.retries == 2
+    assert len(slept) >= 2
+
+
+def test_scheduler_gives_up_on_client_errors():
+    # GIVEN: an API rejecting the request
+    session = FakeSession(FakeResponse(404))
+
+    # WHEN: a request is made
+    # THEN: the error is raised without retrying
+    with pytest.raises(APIError) as error:
+        asyncio.run(RequestScheduler().request(session, 'url', {}))
+    assert error.value.status == 404
+    assert session.urls == ['url']
+
+
+def test_scheduler_gives_up_after_max_retries(slept):
+    # GIVEN: an API that keeps failing
+    session = FakeSession(*[FakeResponse(502) for _ in range(3)])
+
+    # WHEN: a request is made
+    # THEN: it fails once the retries are exhausted
+    with pytest.raises(APIError):
+        asyncio.run(RequestScheduler(max_retries=2).request(session, 'url', {}))
+    assert len(session.urls) == 3
+
+
+def test_retry_after_http_date():
+    # GIVEN: a Retry-After header in the past
+    headers = {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+
+    # THEN: the request can be retried right away
+    assert RequestScheduler.retry_after(headers) == 0.0
+    assert RequestScheduler.retry_after({}) is None
+
+
+def test_adaptive_limiter_aimd():
+    # GIVEN: a limiter allowing 4 requests in flight
+    limiter = AdaptiveLimiter(initial=4, maximum=8)
+
+    # WHEN: a full window of requests succeeds
+    for _ in range(4):
+        limiter.success()
+
+    # THEN: the limit grows by about one
+    assert 4.9 < limiter.limit < 5.0
+
+    # WHEN: a request is throttled
+    limiter.throttled()
+
+    # THEN: the limit is halved, but never below the minimum
+    assert 2.4 < limiter.limit < 2.5
+    for _ in range(5):
+        limiter.throttled()
+    assert limiter.limit == 1
+
+
+def test_adaptive_limiter_bounds_requests_in_flight():
+    # GIVEN: a limiter allowing 2 requests in flight
+    limiter = AdaptiveLimiter(initial=2)
+    peak = 0
+
+    async def request():
+        nonlocal peak
+        async with limiter:
+            peak = max(peak, limiter.in_flight)
+            await asyncio.sleep(0.001)
+
+    async def main():
+        await asyncio.gather(*(request() for _ in range(10)))
+
+    # WHEN: many requests are made at once
+    asyncio.run(main())
+
+    # THEN: no more than 2 were in flight at the same time
+    assert peak == 2
+
+
+def test_gather_playlists_keeps_order_under_one_limit(mocker):
+    # GIVEN: playlists whose pages arrive in any order
+    playlists = [{'id': f'p{i}', 'tracks': {'total': 250 - 100 * i}} for i in range(3)]
+    in_flight, peak = 0, 0
+
+    async def fake_get(spfy, session, url):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.001 * (hash(url) % 3))
+        in_flight -= 1
+        return {'url': url}
+    mocker.patch('diversify.asyncutils.get', side_effect=fake_get)
+
+    # WHEN: the tracks of all playlists are gathered
+    result = asyncio.run(gather_playlists(None, playlists, limit=2, session=object()))
+
+    # THEN: all pages of each playlist come in playlist order
+    assert [len(pages) for pages in result] == [3, 2, 1]
+    assert all('p0/tracks' in page['url'] for page in result[0])
+    assert result[1][1]['url'].endswith('p1/tracks?offset=100&limit=100')
+    # and the requests of all playlists share the limit
+    assert peak == 2
+
+
+def test_stream_pages_in_order_with_bounded_window(mocker):
+    # GIVEN: a paging object with 10 pages
+    first_page = {'href': 'https://api.spotify.com/v1/me/tracks?offset=0&limit=50',
+                  'total': 500, 'limit': 50, 'items': []}
+    in_flight, peak = 0, 0
+
+    async def fake_get(spfy, session, url):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.001)
+        in_flight -= 1
+        return {'url': url}
+    mocker.patch('diversify.asyncutils.get', side_effect=fake_get)
+
+    async def consume():
+        return [page async for page in stream_pages(None, first_page, limit=3, session=object())]
+
+    # WHEN: the pages are streamed
+    pages = asyncio.run(consume())
+
+    # THEN: they come in order, starting with the first page
+    assert pages[0] is first_page
+    assert [page['url'].split('offset=')[1] for page in pages[1:]] == \
+        [f'{offset}&limit=50' for offset in range(50, 500, 50)]
+    # and only a few pages are requested ahead
+    assert peak <= 3
+
+
+def test_token_refreshed_off_the_event_loop(mocker):
+    # GIVEN: a token that expires soon, whose refresh blocks
+    manager = TokenManager({'access_token': 'old', 'expires_at': 0})
+    threads = []
+
+    def auth_headers():
+        threads.append(threading.get_ident())
+        return {'Authorization': 'Bearer new'}
+    spfy = mocker.Mock(auth_manager=manager, _auth_headers=auth_headers)
+
+    # WHEN: the headers of a request are made
+    async def request():
+        return threading.get_ident(), await _auth_headers(spfy)
+    loop_thread, headers = asyncio.run(request())
+
+    # THEN: the token is refreshed in another thread
+    assert headers == {'Authorization': 'Bearer new'}
+    assert threads and threads[0] != loop_thread
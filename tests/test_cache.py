@@ -0,0 +1,92 @@
+import pytest
+from unittest.mock import patch
+from diversify.cache import TrackCache
+from conftest import audio_features, song_metadata, features_api, playlist_page
+
+
+@pytest.fixture()
+def cache(tmpdir):
+    return TrackCache(tmpdir.join('tracks.sqlite'), ttl=60)
+
+
+def test_cache_stores_features(cache):
+    # GIVEN: some audio features in the cache
+    features = [audio_features(f'id{i}') for i in range(3)]
+    cache.put_features(features)
+
+    # WHEN: they are read back with an unknown id
+    result = cache.get_features(['id2', 'id0', 'unknown'])
+
+    # THEN: only the cached features are returned
+    assert result == {'id0': features[0], 'id2': features[2]}
+
+
+def test_cache_expires_entries(cache):
+    # GIVEN: the features of a track stored in the cache
+    cache.put_features([audio_features('id0')])
+
+    # WHEN: the ttl has passed
+    with patch('diversify.cache.time.time', return_value=10 ** 12):
+        result = cache.get_features(['id0'])
+
+    # THEN: the features are not returned
+    assert result == {}
+
+
+def test_get_features_only_requests_missing(mocker, spotify_session, cache):
+    # GIVEN: a session with some of the songs already cached
+    songs = [{**song_metadata(), 'id': f'id{i}'} for i in range(20)]
+    cache.put_features([audio_features(song['id']) for song in songs[:15]])
+    spotify_session._cache = cache
+    mocked_get = mocker.patch('diversify.asyncutils.get', side_effect=features_api())
+
+    # WHEN: get_features is called
+    features = spotify_session.get_features(songs)
+
+    # THEN: only the missing songs are requested
+    assert mocked_get.call_count == 1
+    assert mocked_get.call_args[0][2].endswith('ids=' + ','.join(song['id'] for song in songs[15:]))
+    # and the features are returned in the same order as the songs
+    assert [feat['id'] for feat in features] == [song['id'] for song in songs]
+
+
+def test_cache_stores_playlists_with_snapshot(cache):
+    # GIVEN: a playlist stored with its snapshot id
+    tracks = [{'id': 'id0', 'name': 'song'}]
+    cache.put_playlist('p1', 'snap1', tracks)
+
+    # WHEN: it's read back long after
+    with patch('diversify.cache.time.time', return_value=10 ** 12):
+        result = cache.get_playlists(['p1', 'p2'])
+
+    # THEN: it's returned with its snapshot id, since snapshots don't expire
+    assert result == {'p1': ('snap1', tracks)}
+
+
+def test_get_user_playlists_only_requests_changed(mocker, spotify_session, cache):
+    # GIVEN: two playlists cached in a previous run, one of them changed since
+    old, new = [song_metadata() for _ in range(2)], [song_metadata() for _ in range(2)]
+    cache.put_playlist('p1', 'snap1', [old[0]])
+    cache.put_playlist('p2', 'snap1', [old[1]])
+    spotify_session._cache = cache
+    playlists = [
+        {'id': 'p1', 'name': 'static', 'snapshot_id': 'snap1', 'owner': {'id': 'user'}},
+        {'id': 'p2', 'name': 'changed', 'snapshot_id': 'snap2', 'owner': {'id': 'user'}},
+    ]
+    mocker.patch('diversify.session.get')
+    mocker.patch('diversify.session.AsyncSpotifySession._for_all', return_value=playlists)
+
+    async def gather(spfy, changed, limit, **kwargs):
+        return [[playlist_page(new)] for _ in changed]
+    mocked_gather = mocker.patch('diversify.session.gather_playlists', side_effect=gather)
+
+    # WHEN: the playlists are requested
+    result = spotify_session.get_user_playlists('user')
+
+    # THEN: only the changed playlist is requested
+    assert mocked_gather.call_args[0][1] == [playlists[1]]
+    assert [name for name, _ in result] == ['static', 'changed']
+    assert result[0][1] == [old[0]]
+    assert [song['id'] for song in result[1][1]] == [song['id'] for song in new]
+    # and it's stored with its new snapshot
+    assert cache.get_playlists(['p2'])['p2'][0] == 'snap2'
@@ -0,0 +1,261 @@
+import asyncio
+import csv
+import random
+import time
+import numpy as np
+import pytest
+from click.testing import CliRunner
+from unittest.mock import Mock
+from diversify.asyncutils import get, API_URL
+from diversify.cassette import Cassette, CassetteMiss, RECORD, REPLAY
+from diversify.main import diversify
+from diversify.session import SpotifySession, _fields
+from diversify.utils import TokenManager
+from conftest import audio_features, song_metadata, playlist_page
+
+
+class FakeResponse:
+    def __init__(self, body, status=200):
+        self.status = status
+        self.headers = {}
+        self._body = body
+
+    async def json(self):
+        return self._body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeSession:
+    connector = None
+    closed = False
+
+    def __init__(self, api):
+        self.api = api
+        self.urls = []
+
+    def request(self, method, url, headers=None, json=None):
+        self.urls.append(url)
+        return FakeResponse(self.api(url))
+
+
+def features_response(url):
+    ids = url.split('ids=')[1].split(',')
+    return {'audio_features': [audio_features(song_id) for song_id in ids]}
+
+
+@pytest.fixture()
+def recorded(tmpdir):
+    """
+    A cassette with the user profile, one page of saved songs
+    and their features.
+    """
+    songs = [{**song_metadata(), 'id': f'id{i}'} for i in range(5)]
+    cassette = Cassette(tmpdir.join('run.cassette'), RECORD)
+    cassette.record('GET', f'{API_URL}/me/', None, {'id': 'user'})
+    cassette.record('GET', f'{API_URL}/me/tracks?limit=50', None, {
+        **playlist_page(songs), 'href': f'{API_URL}/me/tracks', 'total': 5, 'limit': 50})
+    cassette.record('GET', f"{API_URL}/audio-features?ids={','.join(s['id'] for s in songs)}",
+                    None, features_response(f"ids={','.join(s['id'] for s in songs)}"))
+    cassette.save()
+    return cassette.path, songs
+
+
+def test_cassette_replays_in_recorded_order(tmpdir):
+    # GIVEN: a request recorded twice and recommendations from some seeds
+    cassette = Cassette(tmpdir.join('run.cassette'), RECORD)
+    cassette.record('GET', f'{API_URL}/me/', None, {'n': 1})
+    cassette.record('GET', f'{API_URL}/me/', None, {'n': 2})
+    cassette.record('GET', f'{API_URL}/recommendations?seed_tracks=a', None, {'tracks': []})
+    cassette.record('GET', f'{API_URL}/me/tracks?offset=0', None, {'items': []})
+    cassette.save()
+
+    # WHEN: the cassette is replayed
+    replay = Cassette(cassette.path, REPLAY)
+
+    # THEN: repeated requests get the responses in order, repeating the last
+    assert [replay.replay('GET', f'{API_URL}/me/')['n'] for _ in range(3)] == [1, 2, 2]
+    # requests with other queries get the responses of the same endpoint
+    assert replay.replay('GET', f'{API_URL}/recommendations?seed_tracks=b') == {'tracks': []}
+    # and other requests with unknown queries fail
+    with pytest.raises(CassetteMiss):
+        replay.replay('GET', f'{API_URL}/me/tracks?offset=50')
+    with pytest.raises(CassetteMiss):
+        replay.replay('GET', f'{API_URL}/playlists/p1/tracks')
+
+
+def test_cassette_serves_features_by_id(tmpdir):
+    # GIVEN: features recorded in two requests, one of them unknown to the API
+    cassette = Cassette(tmpdir.join('run.cassette'), RECORD)
+    for url in ['ids=a,b', 'ids=c']:
+        cassette.record('GET', f'{API_URL}/audio-features?{url}', None, features_response(url))
+    cassette.record('GET', f'{API_URL}/audio-features?ids=unknown', None,
+                    {'audio_features': [None]})
+
+    # WHEN: they're requested in a different grouping
+    response = cassette.replay('GET', f'{API_URL}/audio-features?ids=c,a,unknown')
+
+    # THEN: the features of each recorded id are served
+    assert [feat and feat['id'] for feat in response['audio_features']] == ['c', 'a', None]
+    # and ids that were never requested fail
+    with pytest.raises(CassetteMiss):
+        cassette.replay('GET', f'{API_URL}/audio-features?ids=a,missing')
+
+
+def test_cassette_session_records_and_replays(tmpdir):
+    # GIVEN: a recording of the requests made through an aiohttp session
+    cassette = Cassette(tmpdir.join('run.cassette'), RECORD)
+    session = FakeSession(features_response)
+    spfy = Mock(**{'_auth_headers.return_value': {}})
+    url = f'{API_URL}/audio-features?ids=a,b'
+    recorded = asyncio.run(get(spfy, cassette.wrap(session), url))
+    cassette.save()
+
+    # WHEN: the same request is replayed with latency and without a session
+    replay = Cassette(cassette.path, REPLAY, latency=0.01)
+    replayed = asyncio.run(get(spfy, replay.wrap(None), url))
+
+    # THEN: the recorded response is returned
+    assert replayed == recorded
+    assert session.urls == [url]
+
+
+def test_offline_session(recorded):
+    # GIVEN: a recorded cassette
+    path, songs = recorded
+
+    # WHEN: a session replays it
+    with SpotifySession(authenticate=False, cassette=Cassette(path, REPLAY)) as spfy:
+        favorites = spfy.get_favorite_songs(features=True)
+
+    # THEN: the user and their songs are the recorded ones
+    assert spfy._current_user == 'user'
+    assert [song['id'] for song in favorites.songs] == [song['id'] for song in songs]
+    assert [feat['id'] for feat in favorites.features] == [song['id'] for song in songs]
+
+
+def test_download_offline(recorded, tmpdir):
+    # GIVEN: a recorded cassette
+    path, songs = recorded
+    filename = tmpdir.join('features.csv')
+
+    # WHEN: download is run offline
+    result = CliRunner().invoke(diversify, ['download', '--offline', str(path), str(filename)])
+
+    # THEN: the features of the recorded songs are written
+    assert result.exit_code == 0, result.output
+    with open(filename) as csvfile:
+        rows = list(csv.DictReader(csvfile))
+    assert [row['id'] for row in rows] == [song['id'] for song in songs]
+    assert list(rows[0]) == _fields
+
+
+class FakeApi:
+    """
+    aiohttp session answering the requests made to generate a playlist for
+    a user with one playlist, with recommendations that depend on the seeds.
+    """
+    connector = None
+    closed = False
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, headers=None, json=None):
+        self.requests.append((method, url, json))
+        return FakeResponse(self.answer(method, url))
+
+    def answer(self, method, url):
+        path, _, query = url[len(API_URL):].partition('?')
+        if path == '/users/user/playlists' and method == 'GET':
+            playlist = {'id': 'p0', 'name': 'mine', 'owner': {'id': 'user'},
+                        'snapshot_id': 's0', 'tracks': {'total': 30}}
+            return {'items': [playlist], 'href': url, 'total': 1, 'limit': 50}
+        if path == '/playlists/p0/tracks':
+            return playlist_page([fake_song(f'u{i}') for i in range(30)])
+        if path == '/recommendations':
+            rng = random.Random(query)
+            return {'tracks': [fake_song(f'r{i}') for i in rng.sample(range(300), 50)]}
+        if path == '/audio-features':
+            ids = query.split('ids=')[1].split(',')
+            return {'audio_features': [fake_features(song_id) for song_id in ids]}
+        if path == '/me/playlists':
+            return {'items': [], 'href': url, 'total': 0, 'limit': 50}
+        if path == '/users/user/playlists':
+            return {'id': 'new'}
+        return {'snapshot_id': 's1'}
+
+    async def close(self):
+        self.closed = True
+
+
+def fake_song(song_id):
+    return {'id': song_id, 'name': song_id, 'popularity': 50, 'duration_ms': 1000,
+            'album': 'album', 'artist': 'artist', 'artist_id': 'a0'}
+
+
+def fake_features(song_id):
+    # The same song always has the same features
+    rng = random.Random(song_id)
+    return {'id': song_id, **{column: rng.random() for column in _fields[1:]}}
+
+
+def generate_playlist(monkeypatch, tmpdir, *options):
+    """
+    Runs [diversify playlist] with the fake API.
+
+    :return: the result of the command and the requests made to the API
+    """
+    manager = TokenManager({'access_token': 'token', 'expires_at': time.time() + 3600,
+                            'profile': {'id': 'user'}}, str(tmpdir.join('token')))
+    monkeypatch.setattr('diversify.utils.token_manager', lambda: manager)
+    api = FakeApi()
+    monkeypatch.setattr('diversify.asyncutils.pooled_session', lambda limits: api)
+    result = CliRunner().invoke(diversify, ['playlist', '--pool-size', '100', *options, 'party'])
+    return result, api.requests
+
+
+def test_playlist_offline(tmpdir, monkeypatch):
+    # GIVEN: a playlist generated while recording a cassette
+    monkeypatch.chdir(tmpdir)
+    path = str(tmpdir.join('run.cassette'))
+    np.random.seed(1)
+    result, recorded = generate_playlist(monkeypatch, tmpdir, '--record', path)
+    assert result.exit_code == 0, result.output
+
+    # WHEN: it's generated again offline
+    np.random.seed(2)
+    replayed = []
+    replay = Cassette.replay
+
+    def spy(cassette, method, url, payload=None):
+        replayed.append(url)
+        return replay(cassette, method, url, payload)
+    monkeypatch.setattr(Cassette, 'replay', spy)
+    result, requests = generate_playlist(monkeypatch, tmpdir, '--offline', path)
+
+    # THEN: the same recommendations are asked for and the same playlist is
+    # written, with every response from the cassette
+    assert result.exit_code == 0, result.output
+    assert 'Playlist created' in result.output
+    assert requests == []
+    assert [url for url in replayed if '/recommendations' in url] == \
+        [url for _, url, _ in recorded if '/recommendations' in url]
+    added = [payload for _, url, payload in recorded if url.endswith('/new/tracks')]
+    assert len(added) == 1 and len(added[0]['uris']) == 20
+
+
+def test_playlist_offline_reports_misses(recorded):
+    # GIVEN: a cassette recorded without recommendations
+    path, songs = recorded
+
+    # WHEN: a playlist is generated offline
+    result = CliRunner().invoke(diversify, ['playlist', '--offline', str(path), 'party'])
+
+    # THEN: the missing response is reported without a traceback
+    assert result.exit_code == 1
+    assert 'No response recorded' in result.output
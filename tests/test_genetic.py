@@ -0,0 +1,358 @@
+import pytest
+import numpy as np
+import pandas as pd
+import diversify.genetic as gen
+from diversify.types import SongWithFeatures
+from diversify.utils import DiversifyError
+
+
+class FakeSession:
+    """
+    Serves recommendations from a local csv file instead of the Spotify API
+    """
+    def __init__(self, songs):
+        self.songs = songs
+
+    def get_candidate_pool(self, users_tracks, target_size=2000, country=None):
+        songs = self.songs[:target_size]
+        return SongWithFeatures(songs[['id']].to_dict('records'), songs.to_dict('records'))
+
+
+@pytest.fixture()
+def users():
+    user1 = pd.read_csv('csvfiles/belzedufeatures.csv')
+    user2 = pd.read_csv('csvfiles/biasusanfeatures.csv')
+    return user1, user2
+
+
+@pytest.fixture()
+def spfy():
+    songs = pd.read_csv('csvfiles/playlistfeatures.csv')
+    return FakeSession(songs[:100])
+
+
+@pytest.fixture()
+def config():
+    np.random.seed(0)
+    return gen.GeneticConfig(maxiter=5, migrants=1)
+
+
+@pytest.fixture()
+def optimizer(spfy, users, config):
+    """
+     Creates an optimizer for two users with recommendations from the fake session
+    """
+    nsongs = gen.candidate_songs(spfy, users)
+    frames = [gen._user_frame(user, config) for user in users]
+    return gen.PlaylistOptimizer.from_frames(frames, nsongs, config, seed=0)
+
+
+def test_correlation_matches_pandas(users):
+    # GIVEN: two feature matrices
+    user1, user2 = users
+    frame1 = user1[gen._columns][:20].reset_index(drop=True)
+    frame2 = user2[gen._columns][:20].reset_index(drop=True)
+
+    # WHEN: correlation is called with their values
+    result = gen.correlation(frame1.to_numpy(), frame2.to_numpy())
+
+    # THEN: the result is the same as pandas' corrwith
+    assert result == pytest.approx(frame1.corrwith(frame2).sum())
+
+
+def test_start_returns_playlist(spfy, users, config):
+    user1, user2 = users
+
+    # WHEN: the genetic algorithm is run for two users
+    result = gen.start(spfy, user1, user2=user2, config=config)
+
+    # THEN: the result is a frame of features indexed by song id
+    assert list(result.columns) == gen._columns
+    assert len(result) == config.genes_size
+    # with no repeated songs
+    assert result.index.is_unique
+
+
+def test_operators_keep_individuals_valid(optimizer, config):
+    # GIVEN: a population for two users
+    pop = optimizer.generate_population()
+
+    # WHEN: the population goes through one generation
+    children = optimizer.generate_children(optimizer.select_parents(pop))
+    mutated = optimizer.mutation(children, 1.0)
+
+    # THEN: every individual still has genes_size distinct songs
+    for population in (pop, children, mutated):
+        assert population.shape == (config.population_size, config.genes_size)
+        assert all(len(np.unique(indv)) == config.genes_size for indv in population)
+
+
+def test_fitness_cache_evicts_least_recently_used():
+    # GIVEN: a cache with room for two values
+    cache = gen.FitnessCache(maxsize=2)
+    cache.put(cache.fingerprint(['a', 'b']), 1.0)
+    cache.put(cache.fingerprint(['c', 'd']), 2.0)
+
+    # WHEN: the first value is used and a third one is added
+    assert cache.get(cache.fingerprint(['b', 'a'])) == 1.0
+    cache.put(cache.fingerprint(['e', 'f']), 3.0)
+
+    # THEN: the value used least recently is evicted
+    assert cache.get(cache.fingerprint(['c', 'd'])) is None
+    assert len(cache) == 2
+    # and the lookups are counted
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_optimizer_reuses_cached_fitness(optimizer):
+    # WHEN: the genetic algorithm is run
+    optimizer.optimize(progress=False)
+
+    # THEN: repeated individuals are not scored again
+    assert optimizer.fitness_cache.hits > 0
+    assert optimizer.fitness_cache.misses == len(optimizer.fitness_cache)
+
+
+def test_batch_fitness_matches_pairwise_correlation(users):
+    # GIVEN: a population of feature matrices and two users
+    user1, user2 = users
+    songs = user1[gen._columns].to_numpy()[:60].reshape(3, 20, -1)
+    references = [user2[gen._columns].to_numpy()[:20], user1[gen._columns].to_numpy()[-20:]]
+
+    # WHEN: the whole population is scored at once
+    result = gen.batch_fitness(songs, gen.standardize(np.stack(references)))
+
+    # THEN: each fitness is the correlation given by pandas averaged between both users
+    expected = [np.mean([pd.DataFrame(indv).corrwith(pd.DataFrame(ref)).sum()
+                         for ref in references])
+                for indv in songs]
+    np.testing.assert_allclose(result, expected)
+
+
+def test_migrate_replaces_worst_with_best_of_previous_island():
+    # GIVEN: two islands with known scores
+    populations = [np.arange(12).reshape(3, 4), np.arange(12, 24).reshape(3, 4)]
+    scores = [np.array([0.1, 0.9, 0.5]), np.array([0.3, 0.2, 0.8])]
+
+    # WHEN: one individual migrates from each island
+    migrated = gen.migrate(populations, scores, migrants=1)
+
+    # THEN: the worst individual of each island is replaced by
+    # the best one of the other island
+    np.testing.assert_array_equal(migrated[0][0], np.arange(20, 24))
+    np.testing.assert_array_equal(migrated[1][1], np.arange(4, 8))
+
+
+def test_start_with_islands(spfy, users, config):
+    user1, user2 = users
+    config = config._replace(islands=2, migration_interval=2)
+
+    # WHEN: the genetic algorithm runs with two islands
+    result = gen.start(spfy, user1, user2=user2, config=config)
+
+    # THEN: a valid playlist is still returned
+    assert len(result) == config.genes_size
+    assert result.index.is_unique
+
+
+def test_stopping_policy_patience():
+    # GIVEN: a policy that waits two generations for improvements
+    stopping = gen.StoppingPolicy(patience=2, min_delta=0.1)
+
+    # WHEN: the fitness stops improving by more than min_delta
+    # THEN: the algorithm stops after two generations
+    assert not stopping.update(1.0)
+    assert not stopping.update(1.05)
+    assert stopping.update(1.08)
+
+
+def test_start_respects_time_budget(spfy, users, config):
+    user1, user2 = users
+    config = config._replace(maxiter=10 ** 6)
+
+    # WHEN: the genetic algorithm is run with a small time budget
+    stopping = gen.StoppingPolicy(time_budget=0.2)
+    result = gen.start(spfy, user1, user2=user2, config=config, stopping=stopping)
+
+    # THEN: it stops long before maxiter with the best playlist so far
+    assert stopping.generations < config.maxiter
+    assert len(result) == config.genes_size
+
+
+def test_repair_fills_repeated_songs(optimizer, config):
+    # GIVEN: individuals where most songs are repeated
+    population = np.zeros((5, config.genes_size), dtype=int)
+    population[:, :3] = [1, 2, 3]
+
+    # WHEN: they are repaired
+    result = optimizer.repair(population)
+
+    # THEN: every individual has genes_size distinct songs from the pool
+    assert all(len(np.unique(indv)) == config.genes_size for indv in result)
+    assert np.isin(result, optimizer.pool).all()
+    # keeping the songs that were not repeated
+    assert all(np.isin([0, 1, 2, 3], indv).all() for indv in result)
+
+
+def test_repair_with_pool_of_genes_size(spfy, users, config):
+    # GIVEN: a pool of exactly genes_size songs
+    config = config._replace(genes_size=40)
+    user = gen._user_frame(users[0], config).iloc[:20]
+    nsongs = gen.candidate_songs(spfy, users)
+    nsongs = nsongs[~nsongs.index.isin(user.index)].iloc[:20]
+
+    for seed in range(50):
+        optimizer = gen.PlaylistOptimizer.from_frames([user], nsongs, config, seed=seed)
+        # and individuals missing different numbers of songs
+        population = np.tile(np.arange(40), (2, 1))
+        population[0, :20] = 20
+        population[1, 0] = 1
+
+        # WHEN: they are repaired
+        result = optimizer.repair(population)
+
+        # THEN: every individual has all the songs
+        assert (result == np.arange(40)).all()
+
+
+def test_optimize_many_shares_feature_matrix(spfy, users, config):
+    # GIVEN: songs from three users
+    user1, user2 = users
+    songs = {'user1': user1, 'user2': user2, 'user3': user1[::-1]}
+    requests = [('user1', 'user2'), ('user3', None), ('user2', 'user1')]
+
+    # WHEN: playlists are generated for all of them at once
+    results = gen.optimize_many(spfy, requests, songs, config=config, max_workers=2)
+
+    # THEN: there is a valid playlist for each request
+    assert len(results) == len(requests)
+    assert all(len(result) == config.genes_size for result in results)
+    assert all(result.index.is_unique for result in results)
+
+
+def test_start_with_group_of_users(spfy, users, config):
+    # GIVEN: songs from five users
+    user1, user2 = users
+    group = [user1, user2, user1[20:], user2[20:], user1[40:]]
+
+    # WHEN: a playlist is generated for all of them
+    result = gen.start(spfy, *group, config=config)
+
+    # THEN: the playlist is valid
+    assert len(result) == config.genes_size
+    assert result.index.is_unique
+
+
+def test_gene_split_is_configurable(spfy, users, config):
+    # GIVEN: an optimizer for three users with 60% of the genes from their songs
+    users = users + (users[0][20:],)
+    nsongs = gen.candidate_songs(spfy, users)
+    frames = [gen._user_frame(user, config) for user in users]
+    config = config._replace(user_share=0.6)
+    optimizer = gen.PlaylistOptimizer.from_frames(frames, nsongs, config)
+
+    # WHEN: the genes are split between the users
+    split = optimizer.gene_split()
+
+    # THEN: 12 genes are divided between the users
+    assert split == [4, 4, 4]
+    # and the fitness is computed for every user
+    pop = optimizer.generate_population()
+    scores = gen.user_fitness(optimizer.features[pop], optimizer.reference)
+    assert scores.shape == (3, config.population_size)
+
+
+def test_optimizer_with_as_many_songs_as_genes(spfy, users, config):
+    # GIVEN: exactly genes_size songs, half from the user and half recommended
+    user = gen._user_frame(users[0], config).iloc[:10]
+    nsongs = gen.candidate_songs(spfy, users)
+    nsongs = nsongs[~nsongs.index.isin(user.index)].iloc[:10]
+
+    # WHEN: a population is generated and evolved
+    optimizer = gen.PlaylistOptimizer.from_frames([user], nsongs, config, seed=0)
+    pop = optimizer.generate_population()
+    evolved = optimizer.evolve(pop, 2)
+
+    # THEN: every individual has all the songs
+    assert pop.shape == (config.population_size, config.genes_size)
+    assert (pop == np.arange(config.genes_size)).all()
+    assert (evolved == np.arange(config.genes_size)).all()
+
+
+def test_start_with_light_user(spfy, users, config):
+    # GIVEN: a friend with fewer songs than the playlist
+    friend = users[1][:12]
+
+    # WHEN: a playlist is generated for both
+    result = gen.start(spfy, users[0], friend, config=config)
+
+    # THEN: it has all its songs, and the friend's songs are used as their taste
+    assert len(result) == config.genes_size
+    assert result.index.is_unique
+
+
+def test_optimizer_rejects_too_few_recommendations(spfy, users, config):
+    # GIVEN: recommendations that are mostly the users' own songs
+    frames = [gen._user_frame(user, config) for user in users]
+    nsongs = pd.concat([frames[0].iloc[:50], gen.candidate_songs(spfy, users).iloc[:3]])
+
+    # THEN: the optimizer can't fill the playlists and says why
+    with pytest.raises(DiversifyError, match='recommended songs'):
+        gen.PlaylistOptimizer.from_frames(frames, nsongs, config)
+
+
+def test_greedy_playlist(optimizer, config):
+    # WHEN: a playlist is built with greedy selection
+    result = optimizer.greedy()
+
+    # THEN: it has genes_size distinct songs
+    assert len(np.unique(result)) == config.genes_size
+    # with the same split between users and recommendations as the GA
+    for pool, each in zip(optimizer.user_pools, optimizer.gene_split()):
+        assert np.isin(result, pool).sum() == each
+
+
+def test_guided_mutation_picks_neighbours(optimizer, config):
+    # GIVEN: a population where every individual will be mutated
+    pop = optimizer.generate_population()
+
+    # WHEN: half of the songs are replaced by neighbours
+    replaced = optimizer.neighbour_songs(pop[:, ::2])
+
+    # THEN: the new songs are recommended songs
+    assert replaced.shape == pop[:, ::2].shape
+    assert np.isin(replaced, optimizer.candidate_pool).all()
+    # and the mutated individuals are still valid
+    mutated = optimizer.mutation(pop, 1.0)
+    assert all(len(np.unique(indv)) == config.genes_size for indv in mutated)
+
+
+def test_fitness_stats_follow_swaps(optimizer, config):
+    # GIVEN: the running statistics of an individual
+    indv = optimizer.generate_individual()
+    stats = gen.FitnessStats(optimizer.features, optimizer.reference, indv)
+    assert stats.fitness == pytest.approx(optimizer.fitness(indv))
+
+    # WHEN: some songs are swapped
+    outside = np.setdiff1d(optimizer.pool, indv)
+    predicted = stats.swap_fitness(3, outside[:5])
+    for position, song in [(3, outside[0]), (7, outside[1]), (0, outside[2])]:
+        stats.swap(position, song)
+
+    # THEN: the fitness is the same as computing it from scratch
+    assert stats.fitness == pytest.approx(optimizer.fitness(stats.individual))
+    changed = indv.copy()
+    changed[3] = outside[4]
+    assert predicted[4] == pytest.approx(optimizer.fitness(changed))
+
+
+def test_refine_improves_fitness(optimizer, config):
+    # GIVEN: a random individual
+    indv = optimizer.generate_individual()
+
+    # WHEN: it goes through local search
+    result = optimizer.refine(indv, rounds=2)
+
+    # THEN: its fitness doesn't get worse and its songs are still distinct
+    assert optimizer.fitness(result) >= optimizer.fitness(indv)
+    assert len(np.unique(result)) == config.genes_size
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from diversify.kdtree import KDTree
+
+
+@pytest.fixture()
+def points():
+    random = np.random.RandomState(0)
+    return random.random_sample((2000, 8)), random.random_sample((25, 8))
+
+
+def test_query_matches_brute_force(points):
+    # GIVEN: a tree over some points
+    data, queries = points
+    tree = KDTree(data, leafsize=16)
+
+    # WHEN: the nearest neighbours of some points are queried
+    distances, indices = tree.query(queries, k=5)
+
+    # THEN: they are the same as comparing against every point
+    brute = np.sqrt(((queries[:, np.newaxis] - data[np.newaxis]) ** 2).sum(axis=2))
+    np.testing.assert_array_equal(indices, np.argsort(brute, axis=1)[:, :5])
+    np.testing.assert_allclose(distances, np.sort(brute, axis=1)[:, :5])
+
+
+def test_query_with_repeated_points():
+    # GIVEN: a tree where most points are the same
+    data = np.zeros((100, 3))
+    data[-1] = 1.0
+    tree = KDTree(data, leafsize=4)
+
+    # WHEN: the neighbours of the different point are queried
+    distances, indices = tree.query(np.ones(3), k=2)
+
+    # THEN: it's the nearest, followed by one of the repeated points
+    assert indices[0, 0] == 99
+    assert distances[0, 1] == pytest.approx(np.sqrt(3))
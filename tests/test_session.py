@@ -1,96 +1,59 @@
+import asyncio
+import random
+import time
 from unittest.mock import Mock, patch, call
 import pytest
-from faker import Faker
 import spotipy as spt
-from diversify.session import SpotifySession, _get_session, _fields
-
-fake = Faker()
-Faker.seed(0)
+from diversify.session import SpotifySession, AsyncSpotifySession, _get_session, _fields, \
+    playlist_diff, PLAYLIST_MARKER
+from diversify.asyncutils import gather_recommendations, API_URL
+from diversify.utils import TokenManager
+from conftest import audio_features, song_metadata, paginated_object, features_api, \
+    playlist_page
 
 # I'm using this project as a way to learn how to test functions
 # and isolate dependencies, so there might be a bunch of useless tests here
 # and overly mocked tests that tests implementation
 
-# ------  Fixtures  -------
-
-
-@pytest.fixture()
-def spotify_session(mocker):
-    """
-     Creates a spotify session object with mocked dependencies
-    """
-    mocker.patch('diversify.session.spotipy.Spotify.current_user')
-    mocked_get_session = mocker.patch('diversify.session._get_session')
-    mock_token = Mock()
-    mocked_get_session.return_value = spt.Spotify(auth=mock_token)
-    return SpotifySession()
-
-
-def audio_features(song_id=None):
-    if song_id is None:
-        song_id = fake.pyint()
-
-    features = {}
-    features['id'] = song_id
-    features['speechiness'] = fake.pyfloat(min_value=0.0, max_value=1.0)
-    features['valence'] = fake.pyfloat(min_value=0.0, max_value=1.0)
-    features['mode'] = int(fake.pybool())
-    features['liveness'] = fake.pyfloat(min_value=0.0, max_value=1.0)
-    features['key'] = fake.pyint(min_value=0.0, max_value=1.0)
-    features['danceability'] = fake.pyfloat(min_value=0.0, max_value=1.0)
-    features['instrumentalness'] = fake.pyfloat(min_value=0.0, max_value=1.0)
-    features['energy'] = fake.pyfloat(min_value=0.0, max_value=1.0)
-    features['tempo'] = fake.pyfloat(min_value=50.0, max_value=150.0)
-    features['loudness'] = fake.pyfloat(min_value=-60.0, max_value=1.0)
-    features['acousticness'] = fake.pyfloat(min_value=0.0, max_value=1.0)
-    return features
-
-
-def song_metadata():
-    song_meta = {}
-    song_meta['id'] = fake.pyint()
-    song_meta['name'] = " ".join(fake.words())
-    song_meta['popularity'] = fake.pyint(min_value=0, max_value=100)
-    song_meta['duration_ms'] = fake.pyint()
-    song_meta['album'] = " ".join(fake.words(nb=2))
-    song_meta['artist'] = fake.name()
-    song_meta['artist_id'] = fake.pyint()
-    return song_meta
-
-
-def paginated_object(values):
-    for value in values[:-1]:
-        result = {
-            'value': value,
-            'next': 'stub'
-        }
-        yield result
-    # The last page has a null field
-    yield {'value': values[-1],
-           'next': None}
-
-
 # ------  Tests  -------
 
 
-@patch('diversify.utils.cached_token')
-def test_get_session_cached_token(mock_cached_token):
+@patch('diversify.utils.token_manager')
+def test_get_session_cached_token(mock_token_manager):
     # WHEN: _get_session is called with authenticate=False
     result = _get_session(authenticate=False)
     # THEN: a Spotify object is returned
     assert isinstance(result, spt.Spotify)
-    # with a token from the cache
-    assert mock_cached_token.called
+    # with the token from the cache
+    assert result.auth_manager is mock_token_manager.return_value
 
 
+@patch('diversify.utils.token_manager')
 @patch('diversify.utils.login_user')
-def test_get_session_from_api(mock_login_user):
+def test_get_session_from_api(mock_login_user, mock_token_manager):
     # WHEN: _get_session is called with authenticate=True
     result = _get_session()
     # THEN: a Spotify object is returned
     assert isinstance(result, spt.Spotify)
     # with a token from the Spotify API instead
     assert mock_login_user.called
+    assert result.auth_manager is mock_token_manager.return_value
+
+
+def test_session_uses_cached_profile(tmpdir, mocker):
+    # GIVEN: a cached token with the user profile
+    manager = TokenManager({'access_token': 'token', 'expires_at': time.time() + 3600,
+                            'profile': {'id': 'user'}}, str(tmpdir.join('cache')))
+    mocker.patch('diversify.utils.token_manager', return_value=manager)
+    current_user = mocker.patch('diversify.session.spotipy.Spotify.current_user')
+
+    # WHEN: a session is created
+    with SpotifySession(authenticate=False) as spfy:
+        # THEN: the profile is not requested
+        assert spfy._current_user == 'user'
+        assert not current_user.called
+        # and the spotipy and aiohttp requests share the token
+        assert spfy._session._auth_headers() == {'Authorization': 'Bearer token'}
 
 
 @patch('diversify.session.spotipy.Spotify.next')
@@ -147,20 +110,21 @@ def test_filter_audio_features():
     assert result[0].get('some_other') is None
 
 
-@patch('diversify.session.spotipy.Spotify.audio_features')
-def test_session_get_features(mocked_audio_features, spotify_session):
+def test_session_get_features(mocker, spotify_session):
     # GIVEN: a spotify session and a list of spotify
-    # tracks
-    songs = [song_metadata() for _ in range(20)]
-    mocked_audio_features.side_effect = (lambda songs: [audio_features(song_id) for song_id in songs])
+    # tracks, some of them unknown to spotify
+    songs = [{**song_metadata(), 'id': f'id{i}'} for i in range(250)]
+    unknown = {'id3', 'id120'}
+    mocked_get = mocker.patch('diversify.asyncutils.get', side_effect=features_api(unknown))
 
     # WHEN: get_features is called
     features = spotify_session.get_features(songs)
 
-    # Then a list of audio features is returned for each song
-    assert all([song['id'] == audio_feat['id'] for song, audio_feat in zip(songs, features)])
-    # and the api is called twice, since the limit is 10
-    assert mocked_audio_features.call_count == 2
+    # Then a list of audio features is returned for each known song, in order
+    assert [feat['id'] for feat in features] == \
+        [song['id'] for song in songs if song['id'] not in unknown]
+    # and the api is called 3 times, since the limit is 100
+    assert mocked_get.call_count == 3
 
 
 @pytest.mark.skip(reason="still dont know how to generate base64 id from faker")
@@ -172,50 +136,461 @@ def test_get_features_should_raise_if_limit_too_high(spotify_session):
     features = spotify_session.get_features(songs, limit=101)
 
 
-@patch('diversify.session.SpotifySession._for_all')
-@patch('diversify.session.spotipy.Spotify.current_user_saved_tracks')
+@patch('diversify.session.AsyncSpotifySession._for_all')
+@patch('diversify.session.get')
 def test_get_favorite_songs(
-        mocked_saved_tracks,
+        mocked_get,
         mocked_for_all,
         spotify_session):
     songs = [song_metadata() for _ in range(20)]
     songs_po = paginated_object(songs)
     first_page = next(songs_po)
-    
-    mocked_saved_tracks.side_effect = (lambda limit: first_page)
+
+    mocked_get.return_value = first_page
     result = spotify_session.get_favorite_songs()
 
     # THEN: All of the pages with saved user songs should be gathered
     assert result == mocked_for_all.return_value
     # for all should be called with get_song_info and the first page
     assert mocked_for_all.call_args == call(first_page, SpotifySession._get_song_info)
-     
+    assert mocked_get.call_args[0][2].endswith('/me/tracks?limit=50')
+
 
-@patch('diversify.session.SpotifySession._for_all')
-@patch('diversify.session.SpotifySession.get_features')
-@patch('diversify.session.spotipy.Spotify.current_user_saved_tracks')
+@patch('diversify.session.AsyncSpotifySession._for_all')
+@patch('diversify.session.AsyncSpotifySession.get_features')
+@patch('diversify.session.get')
 def test_get_favorite_songs_features(
-        mocked_saved_tracks,
+        mocked_get,
         mocked_get_features,
         mocked_for_all,
         spotify_session):
 
-    # mocked_for_all.side_effect = (lambda page, func: 1)
     mocked_for_all.return_value = 1
 
     # WHEN: get_favorite_songs is called with features=True
     spotify_session.get_favorite_songs(features=True)
 
     # THEN: get_features should be called with the gathered songs
-    # from the api 
+    # from the api
     assert mocked_get_features.call_args == call(mocked_for_all.return_value)
 
 
-@patch('diversify.session.SpotifySession._for_all')
-@patch('diversify.session.spotipy.Spotify.user_playlists')
-def test_get_user_playlists(mocked_for_all, mocked_spotipy, spotify_session):
-    
-    # WHEN: get_user_playlists is called
-    spotify_session.get_user_playlists()
+@patch('diversify.session.gather_playlists')
+@patch('diversify.session.AsyncSpotifySession._for_all')
+@patch('diversify.session.get')
+def test_get_user_playlists(mocked_get, mocked_for_all, mocked_gather, spotify_session):
+    # GIVEN: a user with two playlists and a playlist followed from someone else
+    playlists = [
+        {'id': 'p1', 'name': 'first', 'owner': {'id': 'user'}},
+        {'id': 'p2', 'name': 'other', 'owner': {'id': 'friend'}},
+        {'id': 'p3', 'name': 'second', 'owner': {'id': 'user'}},
+    ]
+    mocked_for_all.return_value = playlists
+    songs = [song_metadata() for _ in range(3)]
+
+    async def gather(spfy, owned, limit, **kwargs):
+        return [[playlist_page(songs[:2])], [playlist_page(songs[2:])]]
+    mocked_gather.side_effect = gather
 
-    # Then the result should be tuples with name of the playlist and song_metadata 
+    # WHEN: get_user_playlists is called
+    result = spotify_session.get_user_playlists('user')
+
+    # THEN: the tracks of the owned playlists are requested together
+    assert mocked_gather.call_args[0][1] == [playlists[0], playlists[2]]
+    # and the result should be tuples with name of the playlist and song_metadata
+    assert [name for name, _ in result] == ['first', 'second']
+    assert [song['id'] for song in result[0][1]] == [song['id'] for song in songs[:2]]
+    assert [song['id'] for song in result[1][1]] == [songs[2]['id']]
+
+
+def test_iter_features_in_chunks(mocker, spotify_session):
+    # GIVEN: songs that are generated one at a time
+    songs = [song_metadata() for _ in range(25)]
+    mocked_get_features = mocker.patch.object(
+        SpotifySession, 'get_features',
+        side_effect=lambda chunk, limit, concurrency: [audio_features(s['id']) for s in chunk])
+
+    # WHEN: their features are iterated
+    features = list(spotify_session.iter_features(iter(songs), limit=5, concurrency=2))
+
+    # THEN: the features of all songs are returned in order
+    assert [feat['id'] for feat in features] == [song['id'] for song in songs]
+    # requesting a chunk of limit * concurrency songs at a time
+    assert [len(c.args[0]) for c in mocked_get_features.call_args_list] == [10, 10, 5]
+
+
+@patch('diversify.session.get')
+def test_iter_favorite_songs(mocked_session_get, mocker, spotify_session):
+    # GIVEN: saved songs in two pages
+    songs = [song_metadata() for _ in range(3)]
+    first_page = {**playlist_page(songs[:2]), 'href': 'https://api.spotify.com/v1/me/tracks',
+                  'total': 3, 'limit': 2}
+    mocked_session_get.return_value = first_page
+
+    async def fake_get(spfy, session, url):
+        return playlist_page(songs[2:])
+    mocker.patch('diversify.asyncutils.get', side_effect=fake_get)
+
+    # WHEN: the saved songs are iterated
+    result = list(spotify_session.iter_favorite_songs())
+
+    # THEN: all songs are yielded in order
+    assert [song['id'] for song in result] == [song['id'] for song in songs]
+
+
+def test_async_session_from_running_loop(mocker):
+    # GIVEN: the features api and sessions of two users
+    mocker.patch('diversify.asyncutils.get', side_effect=features_api())
+    songs = [{**song_metadata(), 'id': f'id{i}'} for i in range(150)]
+
+    async def main():
+        async with AsyncSpotifySession(Mock(), 'user1') as first, \
+                AsyncSpotifySession(Mock(), 'user2') as second:
+            return await asyncio.gather(first.get_features(songs[:50]),
+                                        second.get_features(songs[50:]))
+
+    # WHEN: their features are requested concurrently in a running event loop
+    first, second = asyncio.run(main())
+
+    # THEN: each session gets the features of its songs
+    assert [feat['id'] for feat in first + second] == [song['id'] for song in songs]
+
+
+def playlists_page(playlists):
+    return {'items': playlists, 'href': f'{API_URL}/me/playlists', 'total': len(playlists),
+            'limit': 50}
+
+
+@patch('diversify.session.get')
+@patch('diversify.session.post')
+def test_tracks_to_playlist_in_chunks(mocked_post, mocked_get, spotify_session):
+    # GIVEN: a user without playlists and the playlist created by the API
+    mocked_get.return_value = playlists_page([])
+    mocked_post.return_value = {'id': 'p1'}
+    trackids = [f'id{i}' for i in range(250)]
+
+    # WHEN: a playlist is created with 250 songs
+    spotify_session.tracks_to_playlist(trackids, name='test')
+
+    # THEN: the playlist is created and the songs are added 100 at a time, in order
+    urls = [c.args[2] for c in mocked_post.call_args_list]
+    assert urls[0].endswith('/playlists') and mocked_post.call_args_list[0].args[3]['name'] == 'test'
+    assert PLAYLIST_MARKER in mocked_post.call_args_list[0].args[3]['description']
+    assert all(url.endswith('/playlists/p1/tracks') for url in urls[1:])
+    added = [uri for c in mocked_post.call_args_list[1:] for uri in c.args[3]['uris']]
+    assert [len(c.args[3]['uris']) for c in mocked_post.call_args_list[1:]] == [100, 100, 50]
+    assert added == [f'spotify:track:{trackid}' for trackid in trackids]
+
+
+@patch('diversify.session.gather_playlists')
+@patch('diversify.session.get')
+@patch('diversify.session.post')
+def test_tracks_to_playlist_updates_existing(mocked_post, mocked_get, mocked_gather,
+                                             spotify_session):
+    # GIVEN: a playlist with the same name from a previous run
+    existing = {'id': 'p1', 'name': 'test', 'owner': {'id': spotify_session._current_user},
+                'description': PLAYLIST_MARKER}
+    mocked_get.return_value = playlists_page([existing])
+    old = [f'id{i}' for i in range(150)]
+
+    async def gather(spfy, playlists, **kwargs):
+        return [[{'items': [{'track': {'uri': f'spotify:track:{trackid}'}}
+                            for trackid in old]}]]
+    mocked_gather.side_effect = gather
+
+    # WHEN: the playlist is written again with a song replaced and two swapped
+    new = old[:10] + ['new'] + old[11:149] + [old[149]]
+    new[20], new[21] = new[21], new[20]
+    saved = spotify_session.tracks_to_playlist(new, name='test')
+
+    # THEN: the existing playlist is updated in place
+    assert saved == ('p1', False)
+    calls = [(c.args[4] if len(c.args) > 4 else 'POST', c.args[3])
+             for c in mocked_post.call_args_list]
+    # removing, moving and adding only the changed songs
+    assert calls == [
+        ('DELETE', {'tracks': [{'uri': 'spotify:track:id10'}]}),
+        ('PUT', {'range_start': 19, 'insert_before': 21}),
+        ('POST', {'uris': ['spotify:track:new'], 'position': 10}),
+    ]
+
+
+@patch('diversify.session.gather_playlists')
+@patch('diversify.session.get')
+@patch('diversify.session.post')
+def test_tracks_to_playlist_keeps_playlists_of_the_user(mocked_post, mocked_get, mocked_gather,
+                                                      spotify_session):
+    # GIVEN: a playlist made by the user with the same name
+    existing = {'id': 'p1', 'name': 'test', 'owner': {'id': spotify_session._current_user},
+                'description': 'my favourite songs'}
+    mocked_get.return_value = playlists_page([existing])
+    mocked_post.return_value = {'id': 'p2'}
+
+    # WHEN: a playlist is written with that name
+    saved = spotify_session.tracks_to_playlist(['id1'], name='test')
+
+    # THEN: a new playlist is created and the user's one is not read or changed
+    assert saved == ('p2', True)
+    mocked_gather.assert_not_called()
+    assert all('/playlists/p1' not in c.args[2] for c in mocked_post.call_args_list)
+
+
+def apply_diff(current, diff, moved=None):
+    result = [uri for uri in current if uri not in diff.removed]
+    for start, before in diff.moves:
+        if moved is not None:
+            moved.append(result[start])
+        result.insert(before, result[start])
+        del result[start if start < before else start + 1]
+    for position, added in diff.added:
+        result[position:position] = added
+    return result
+
+
+def test_playlist_diff_turns_current_into_target():
+    # GIVEN: random playlists with repeated songs
+    rng = random.Random(0)
+    songs = [f'u{i}' for i in range(15)]
+    for _ in range(500):
+        current = [rng.choice(songs) for _ in range(rng.randint(0, 12))]
+        target = [rng.choice(songs) for _ in range(rng.randint(0, 12))]
+
+        # WHEN: the changes between them are applied as the API does
+        diff = playlist_diff(current, target)
+
+        # THEN: the playlist has the target songs
+        assert apply_diff(current, diff) == target
+
+
+def test_playlist_diff_keeps_local_files():
+    # GIVEN: random playlists with local files in between the songs
+    rng = random.Random(1)
+    songs = [f'u{i}' for i in range(15)]
+    for _ in range(500):
+        current = [rng.choice(songs) for _ in range(rng.randint(0, 12))]
+        for i in range(rng.randint(1, 3)):
+            current.insert(rng.randint(0, len(current)), f'spotify:local:a:b:song{i}:1')
+        target = [rng.choice(songs) for _ in range(rng.randint(0, 12))]
+
+        # WHEN: the changes between them are applied as the API does
+        diff = playlist_diff(current, target)
+        moved = []
+        result = apply_diff(current, diff, moved)
+
+        # THEN: the local files are not removed or moved, and the other songs are the target
+        assert not any(uri.startswith('spotify:local:') for uri in diff.removed + moved)
+        assert [uri for uri in result if not uri.startswith('spotify:local:')] == target
+        assert [uri for uri in result if uri.startswith('spotify:local:')] == \
+            [uri for uri in current if uri.startswith('spotify:local:')]
+
+
+
+def test_playlist_diff_is_minimal_for_unchanged():
+    # GIVEN: the same songs, with one moved to the end
+    current = [f'u{i}' for i in range(10)]
+    target = current[1:] + current[:1]
+
+    # THEN: nothing is removed or added, and one song is moved
+    assert playlist_diff(current, current) == ([], [], [])
+    assert playlist_diff(current, target) == ([], [(0, 10)], [])
+
+
+def test_get_features_coalesces_requests(mocker):
+    # GIVEN: a slow features api
+    requested = []
+
+    async def slow_api(spfy, session, url):
+        ids = url.split('ids=')[1].split(',')
+        requested.extend(ids)
+        await asyncio.sleep(0.01)
+        return {'audio_features': [audio_features(song_id) for song_id in ids]}
+    mocker.patch('diversify.asyncutils.get', side_effect=slow_api)
+    songs = [{**song_metadata(), 'id': f'id{i}'} for i in range(30)]
+
+    async def main():
+        async with AsyncSpotifySession(Mock(), 'user') as spfy:
+            # WHEN: concurrent calls ask for overlapping songs
+            first, second = await asyncio.gather(spfy.get_features(songs[:20]),
+                                                 spfy.get_features(songs[10:]))
+            # and later calls ask for them again
+            third = await spfy.get_features(songs[::-1])
+            return first, second, third
+
+    first, second, third = asyncio.run(main())
+
+    # THEN: the features of each song are requested only once
+    assert sorted(requested) == sorted(song['id'] for song in songs)
+    # and every call gets the features of its songs in order
+    assert [feat['id'] for feat in first] == [song['id'] for song in songs[:20]]
+    assert [feat['id'] for feat in second] == [song['id'] for song in songs[10:]]
+    assert [feat['id'] for feat in third] == [song['id'] for song in songs[::-1]]
+
+
+def test_get_features_survives_cancelled_caller(mocker):
+    # GIVEN: a slow features api
+    requested = []
+
+    async def slow_api(spfy, session, url):
+        ids = url.split('ids=')[1].split(',')
+        requested.extend(ids)
+        await asyncio.sleep(0.01)
+        return {'audio_features': [audio_features(song_id) for song_id in ids]}
+    mocker.patch('diversify.asyncutils.get', side_effect=slow_api)
+    songs = [{**song_metadata(), 'id': f'id{i}'} for i in range(5)]
+
+    async def main():
+        async with AsyncSpotifySession(Mock(), 'user') as spfy:
+            # WHEN: one of two callers waiting for the same songs is cancelled
+            first = asyncio.ensure_future(spfy.get_features(songs))
+            second = asyncio.ensure_future(spfy.get_features(songs))
+            await asyncio.sleep(0)
+            first.cancel()
+            result = await second
+            # and the songs are asked for again later
+            again = await spfy.get_features(songs)
+            return first, result, again
+
+    first, result, again = asyncio.run(main())
+
+    # THEN: the other caller still gets the features
+    assert first.cancelled()
+    assert [feat['id'] for feat in result] == [song['id'] for song in songs]
+    # and they're requested only once
+    assert [feat['id'] for feat in again] == [song['id'] for song in songs]
+    assert sorted(requested) == sorted(song['id'] for song in songs)
+
+
+def test_get_features_forgets_least_recently_used(mocker):
+    # GIVEN: a session that keeps the features of at most 3 songs
+    mocker.patch('diversify.session._max_features', 3)
+    mocker.patch('diversify.asyncutils.get', side_effect=features_api())
+    songs = [{**song_metadata(), 'id': f'id{i}'} for i in range(5)]
+
+    async def main():
+        async with AsyncSpotifySession(Mock(), 'user') as spfy:
+            await spfy.get_features(songs)
+            return list(spfy._features)
+
+    # WHEN: the features of more songs are requested
+    kept = asyncio.run(main())
+
+    # THEN: only the most recent ones are kept
+    assert kept == ['id2', 'id3', 'id4']
+
+
+def test_get_features_retries_after_failure(mocker):
+    # GIVEN: a features api that fails the first time
+    mocked_get = mocker.patch('diversify.asyncutils.get', side_effect=Exception('API down'))
+    songs = [{**song_metadata(), 'id': f'id{i}'} for i in range(3)]
+
+    async def main():
+        async with AsyncSpotifySession(Mock(), 'user') as spfy:
+            with pytest.raises(Exception):
+                await spfy.get_features(songs)
+            mocked_get.side_effect = features_api()
+            return await spfy.get_features(songs)
+
+    # WHEN: the features are requested again after the failure
+    features = asyncio.run(main())
+
+    # THEN: they're requested again instead of reusing the failure
+    assert [feat['id'] for feat in features] == ['id0', 'id1', 'id2']
+
+
+@patch('diversify.session.gather_playlists')
+@patch('diversify.session.AsyncSpotifySession._for_all')
+@patch('diversify.session.get')
+def test_get_user_playlists_unique(mocked_get, mocked_for_all, mocked_gather, mocker,
+                                   spotify_session):
+    # GIVEN: two playlists sharing a song
+    mocked_for_all.return_value = [{'id': f'p{i}', 'name': f'p{i}', 'owner': {'id': 'user'}}
+                                   for i in range(2)]
+    songs = [{**song_metadata(), 'id': f'id{i}'} for i in range(3)]
+
+    async def gather(spfy, owned, limit, **kwargs):
+        return [[playlist_page(songs[:2])], [playlist_page(songs[1:])]]
+    mocked_gather.side_effect = gather
+    mocked_api = mocker.patch('diversify.asyncutils.get', side_effect=features_api())
+
+    # WHEN: the flattened features of the playlists are requested without repeats
+    result = spotify_session.get_user_playlists('user', features=True, flat=True, unique=True)
+
+    # THEN: each song appears once, where it first appeared
+    assert [feat['id'] for feat in result] == ['id0', 'id1', 'id2']
+    # and the features of all playlists are requested together
+    assert mocked_api.call_count == 1
+
+
+def test_seed_groups_take_turns_between_users():
+    # GIVEN: songs from two users
+    user1 = [{'id': f'a{i}'} for i in range(6)]
+    user2 = [{'id': f'b{i}'} for i in range(4)]
+
+    # WHEN: seed groups are generated
+    groups = SpotifySession._seed_groups([user1, user2])
+    first_round = [next(groups) for _ in range(2)]
+
+    # THEN: each group has distinct seeds from both users
+    assert all(len(set(group)) == len(group) <= 5 for group in first_round)
+    assert {seed[0] for seed in first_round[0]} == {'a', 'b'}
+    # and all songs are used before repeating
+    assert len({seed for group in first_round for seed in group}) == 10
+
+
+@patch('diversify.session.gather_recommendations')
+def test_get_candidate_pool(mocked_gather, spotify_session):
+    # GIVEN: recommendations returned by the API
+    tracks = [song_metadata() for _ in range(30)]
+    features = [audio_features(track['id']) for track in tracks]
+
+    async def gather(*args, **kwargs):
+        return tracks, features
+    mocked_gather.side_effect = gather
+
+    # WHEN: a candidate pool is built
+    pool = spotify_session.get_candidate_pool([tracks[:5], tracks[5:10]], target_size=30)
+
+    # THEN: songs and features are returned in the same order
+    assert [song['id'] for song in pool.songs] == [feat['id'] for feat in pool.features]
+    assert len(pool.features) == 30
+    # and at most 3 requests are made for every 100 songs
+    assert mocked_gather.call_args[0][3] == 3
+
+
+def test_gather_recommendations_deduplicates(mocker):
+    # GIVEN: recommendations that repeat songs between requests
+    async def fake_get(spfy, session, url):
+        if 'recommendations' in url:
+            return {'tracks': [{'id': str(i)} for i in range(8)]}
+        ids = url.split('ids=')[1].split(',')
+        return {'audio_features': [audio_features(song_id) for song_id in ids]}
+    mocker.patch('diversify.asyncutils.get', side_effect=fake_get)
+    groups = iter([['s1'], ['s2'], ['s3']])
+
+    # WHEN: the recommendations are gathered concurrently
+    tracks, features = asyncio.run(
+        gather_recommendations(Mock(), groups, target_size=5, max_requests=3))
+
+    # THEN: the pool has target_size distinct songs with their features
+    assert [track['id'] for track in tracks] == ['0', '1', '2', '3', '4']
+    assert [feat['id'] for feat in features] == ['0', '1', '2', '3', '4']
+
+
+def test_gather_recommendations_in_request_order(mocker):
+    # GIVEN: recommendations whose responses arrive in the reverse order
+    async def fake_get(spfy, session, url):
+        if 'recommendations' in url:
+            seed = url.split('seed_tracks=')[1].split('&')[0]
+            await asyncio.sleep(0.01 * (3 - int(seed)))
+            return {'tracks': [{'id': f'{seed}-{i}'} for i in range(2)]}
+        ids = url.split('ids=')[1].split(',')
+        return {'audio_features': [audio_features(song_id) for song_id in ids]}
+    mocker.patch('diversify.asyncutils.get', side_effect=fake_get)
+    groups = iter([['1'], ['2'], ['3']])
+
+    # WHEN: the recommendations are gathered concurrently
+    tracks, _ = asyncio.run(
+        gather_recommendations(Mock(), groups, target_size=6, max_requests=3))
+
+    # THEN: the songs are in the order of the requests
+    assert [track['id'] for track in tracks] == ['1-0', '1-1', '2-0', '2-1', '3-0', '3-1']
@@ -0,0 +1,144 @@
+import os
+import pandas as pd
+import pytest
+from unittest.mock import Mock
+from diversify.genetic import _columns
+from diversify.main import get_songs
+from diversify.store import FeatureStore
+from diversify.utils import DiversifyError
+from conftest import audio_features
+
+
+@pytest.fixture()
+def songs():
+    return pd.DataFrame([audio_features(f'id{i}') for i in range(20)])
+
+
+@pytest.fixture(params=['npz', 'parquet', 'feather'])
+def store(request, tmpdir):
+    if request.param != 'npz':
+        pytest.importorskip('pyarrow')
+    return FeatureStore(tmpdir, request.param)
+
+
+def test_store_reads_only_projected_columns(store, songs):
+    # GIVEN: the songs of a user in the store
+    store.write('user', songs)
+
+    # WHEN: some of their columns are read
+    result = store.read('user', columns=['id', 'energy', 'mode'])
+
+    # THEN: only those columns are loaded, with their types
+    assert list(result.columns) == ['id', 'energy', 'mode']
+    assert result['id'].tolist() == songs['id'].tolist()
+    assert result['energy'].dtype == 'float64' and result['mode'].dtype == 'int64'
+    assert result['energy'].tolist() == songs['energy'].tolist()
+
+
+def test_store_migrates_csv_on_first_read(store, songs):
+    # GIVEN: the songs of a user in the old csv file
+    songs.to_csv(store.csv_path('user'), index=False)
+
+    # WHEN: they're read from the store
+    result = store.read('user')
+
+    # THEN: they're migrated to the store
+    assert store.path('user').exists()
+    pd.testing.assert_frame_equal(result, pd.read_csv(store.csv_path('user')))
+    # and users without songs have none
+    assert store.read('unknown') is None
+
+
+def test_store_migrates_all_csv(tmpdir, songs):
+    # GIVEN: csv files of two users and other csv files
+    store = FeatureStore(tmpdir, 'npz')
+    for userid in ['first', 'second']:
+        songs.to_csv(store.csv_path(userid), index=False)
+    songs.to_csv(tmpdir.join('songs_to_cluster.csv'), index=False)
+
+    # WHEN: all of them are migrated
+    users = store.migrate_all()
+
+    # THEN: only the features of the users are in the store
+    assert users == ['first', 'second']
+    assert all(store.path(userid).exists() for userid in users)
+
+
+def test_store_needs_pyarrow_for_parquet(tmpdir, mocker):
+    # GIVEN: pyarrow is not installed
+    mocker.patch('diversify.store.HAS_PYARROW', False)
+
+    # THEN: the store falls back to npz, and parquet can't be asked for
+    assert FeatureStore(tmpdir).fmt == 'npz'
+    with pytest.raises(DiversifyError):
+        FeatureStore(tmpdir, 'parquet')
+
+
+def test_get_songs_loads_generator_columns(tmpdir, monkeypatch, songs):
+    # GIVEN: the songs of a user in the default csv folder
+    monkeypatch.chdir(tmpdir)
+    tmpdir.mkdir('csvfiles')
+    songs.to_csv(tmpdir.join('csvfiles', 'userfeatures.csv'), index=False)
+    spfy = Mock()
+
+    # WHEN: the songs of the user are loaded
+    result = get_songs(spfy, 'user')
+
+    # THEN: only the id and the columns used by the generators are loaded
+    assert list(result.columns) == ['id'] + _columns
+    assert not spfy.get_user_playlists.called
+
+
+def test_store_migrates_csv_written_again(tmpdir, songs):
+    # GIVEN: the songs of a user migrated to the store
+    store = FeatureStore(tmpdir, 'npz')
+    songs.to_csv(store.csv_path('user'), index=False)
+    store.read('user')
+
+    # WHEN: the csv file is written again with other songs
+    newer = songs.iloc[:5]
+    newer.to_csv(store.csv_path('user'), index=False)
+    stored = store.path('user').stat().st_mtime_ns
+    os.utime(store.csv_path('user'), ns=(stored + 10**9, stored + 10**9))
+
+    # THEN: the store has the new songs
+    assert store.read('user')['id'].tolist() == newer['id'].tolist()
+
+
+def test_store_keeps_missing_text(store, songs):
+    # GIVEN: songs with missing text
+    songs['name'] = [None] * 2 + ['song'] * 18
+
+    # WHEN: they're stored and read
+    store.write('user', songs)
+    result = store.read('user', columns=['name'])
+
+    # THEN: the text is still missing, as in a csv file
+    assert result['name'].isna().tolist() == [True] * 2 + [False] * 18
+
+
+def test_get_songs_fetches_playlists_every_time(tmpdir, monkeypatch, songs):
+    # GIVEN: a user without downloaded songs
+    monkeypatch.chdir(tmpdir)
+    spfy = Mock()
+    spfy.get_user_playlists.return_value = songs.to_dict('records')
+
+    # WHEN: the songs of the user are loaded twice
+    get_songs(spfy, 'user')
+    result = get_songs(spfy, 'user')
+
+    # THEN: the playlists are read both times, so their changes are seen
+    assert spfy.get_user_playlists.call_count == 2
+    assert list(result.columns) == ['id'] + _columns
+    assert not FeatureStore().path('user').exists()
+
+
+def test_get_songs_names_users_without_songs(tmpdir, monkeypatch):
+    # GIVEN: a friend without public playlists
+    monkeypatch.chdir(tmpdir)
+    spfy = Mock()
+    spfy.get_user_playlists.return_value = []
+
+    # THEN: the friend is named in the error
+    with pytest.raises(DiversifyError, match='friend'):
+        get_songs(spfy, 'friend')
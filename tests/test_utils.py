@@ -0,0 +1,121 @@
+import json
+import time
+from unittest.mock import Mock, patch
+import pytest
+from click.testing import CliRunner
+from spotipy import oauth2
+from diversify.main import diversify
+from diversify.utils import TokenManager
+
+
+def write_cache(path, **token_info):
+    with open(path, 'w') as cache:
+        json.dump(token_info, cache)
+
+
+def test_token_manager_without_cache(tmpdir):
+    # WHEN: the user never logged in
+    # THEN: there is no token
+    assert TokenManager.from_cache(str(tmpdir.join('missing'))) is None
+
+
+def test_token_manager_keeps_valid_token(tmpdir):
+    # GIVEN: a token that expires in an hour
+    path = str(tmpdir.join('cache'))
+    write_cache(path, access_token='token', refresh_token='refresh',
+                expires_at=time.time() + 3600)
+    manager = TokenManager.from_cache(path)
+
+    # WHEN: the token is used
+    with patch.object(TokenManager, '_refresh') as refresh:
+        token = manager.get_access_token()
+
+    # THEN: it's not refreshed
+    assert token == 'token'
+    assert not refresh.called
+
+
+@patch('diversify.utils.load_config')
+@patch('diversify.utils.oauth2.SpotifyOAuth')
+def test_token_manager_refreshes_before_expiry(mocked_oauth, mocked_config, tmpdir):
+    # GIVEN: a token about to expire, cached with the user profile
+    path = str(tmpdir.join('cache'))
+    write_cache(path, access_token='old', refresh_token='refresh',
+                expires_at=time.time() + 10, profile={'id': 'user'})
+    mocked_config.return_value = ('id', 'secret', 'uri')
+    mocked_oauth.return_value.refresh_access_token.return_value = {
+        'access_token': 'new', 'refresh_token': 'refresh', 'expires_at': time.time() + 3600}
+    manager = TokenManager.from_cache(path)
+
+    # WHEN: the token is used
+    token = manager.get_access_token()
+
+    # THEN: a new token is used, before the old one expires
+    assert token == 'new'
+    assert mocked_oauth.return_value.refresh_access_token.call_args[0] == ('refresh',)
+    # and it's cached with the profile
+    cached = TokenManager.from_cache(path)
+    assert cached.get_access_token() == 'new'
+    assert cached.profile == {'id': 'user'}
+
+
+
+@patch('diversify.utils.load_config')
+@patch('diversify.utils.oauth2.SpotifyOAuth')
+def test_token_manager_unusable_when_refresh_fails(mocked_oauth, mocked_config, tmpdir):
+    # GIVEN: an expired token whose refresh token was revoked
+    path = str(tmpdir.join('cache'))
+    write_cache(path, access_token='old', refresh_token='revoked',
+                expires_at=time.time() - 10, profile={'id': 'user'})
+    mocked_config.return_value = ('id', 'secret', 'uri')
+    mocked_oauth.return_value.refresh_access_token.side_effect = \
+        oauth2.SpotifyOauthError('invalid_grant')
+    manager = TokenManager.from_cache(path)
+
+    # THEN: the token can't be used, so the user must log in again
+    assert not manager.usable()
+
+
+@pytest.fixture()
+def expired_login(tmpdir, monkeypatch):
+    """
+    Cache file with an expired token of a logged user, and a new login
+    through the browser that succeeds
+    """
+    path = str(tmpdir.join('cache'))
+    monkeypatch.setattr('diversify.utils.CACHE_FILE', path)
+    monkeypatch.setattr('diversify.utils.load_config', lambda path: ('id', 'secret', 'uri'))
+    auth_token = Mock(return_value='new')
+    monkeypatch.setattr('diversify.utils.auth_token', auth_token)
+    return path, auth_token
+
+
+@patch('diversify.utils.oauth2.SpotifyOAuth')
+def test_login_again_when_refresh_token_revoked(mocked_oauth, expired_login):
+    # GIVEN: an expired token whose refresh token was revoked
+    path, auth_token = expired_login
+    write_cache(path, access_token='old', refresh_token='revoked',
+                expires_at=time.time() - 10, profile={'id': 'user'})
+    mocked_oauth.return_value.refresh_access_token.side_effect = \
+        oauth2.SpotifyOauthError('invalid_grant')
+
+    # WHEN: the user logs in
+    result = CliRunner().invoke(diversify, ['login'])
+
+    # THEN: they're logged in through the browser
+    assert result.exit_code == 0, result.output
+    assert auth_token.called
+    assert 'Logged in successfully' in result.output
+
+
+def test_login_again_when_token_expired_without_refresh(expired_login):
+    # GIVEN: an expired token that can't be refreshed
+    path, auth_token = expired_login
+    write_cache(path, access_token='old', expires_at=time.time() - 10, profile={'id': 'user'})
+
+    # WHEN: the user logs in
+    result = CliRunner().invoke(diversify, ['login'])
+
+    # THEN: they're logged in through the browser instead of using the old token
+    assert result.exit_code == 0, result.output
+    assert auth_token.called